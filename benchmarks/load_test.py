@@ -0,0 +1,370 @@
+# end to end load and soak test driving lambda_function.handler with synthetic or replayed s3 events
+#
+# usage:
+#   python -m benchmarks.load_test --events 500 --concurrency 4
+#   python -m benchmarks.load_test --rate 20 --duration 300 --concurrency 8 --duplicate-rate 0.2 --error-rate 0.05
+#   python -m benchmarks.load_test --replay captured-events.jsonl --concurrency 4
+#
+# every worker process stands in for one lambda execution environment: it has its own s3 client, rds connection and
+# module state, and its memory is measured against the lambda memory limit
+# s3 is served by moto and rds by an in-memory stand-in unless --mysql-host is given
+#
+# a replay file holds one event per line, either the event itself or a captured log line with the event under "event"
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import subprocess
+import sys
+import time
+from unittest.mock import patch
+
+import boto3
+from moto import mock_aws
+
+from lambda_code import db_helpers
+from benchmarks.run_benchmarks import create_quiet_logger, percentile, read_peak_rss_mb, reset_peak_rss
+from benchmarks.synthetic import FILE_EXTENSIONS, IMAGE_FORMATS, StandInDatabase, make_image, make_s3_event, parse_size
+
+LOAD_TEST_BUCKET = 'load-test-bucket'
+# image sizes of the synthetic corpus and how often each one is uploaded
+DEFAULT_SIZE_MIX = {'10KB': 0.4, '100KB': 0.35, '1MB': 0.2, '5MB': 0.05}
+# number of distinct images generated for every format and size
+DEFAULT_IMAGES_PER_SIZE = 3
+# size of the images created for keys in a replay file that are not in the bucket yet
+REPLAY_IMAGE_SIZE = '100KB'
+# the memory configured for the lambda in the dev performance profile
+DEFAULT_MEMORY_LIMIT_MB = 128
+
+# formats picked from a key's file extension when replaying
+EXTENSION_FORMATS = {extension: image_format for image_format, extension in FILE_EXTENSIONS.items()}
+EXTENSION_FORMATS['jpeg'] = 'JPEG'
+
+
+# upload the synthetic corpus: every format in every size, plus objects the handler has to reject
+# returns the keys of the images and the keys of the error objects
+def create_corpus(s3_client, size_mix, images_per_size, seed):
+    image_keys, error_keys = {}, []
+    for size in size_mix:
+        image_keys[size] = []
+        for image_format, content_type in IMAGE_FORMATS.items():
+            for index in range(images_per_size):
+                object_key = f"images/load/{size}/{index}.{FILE_EXTENSIONS[image_format]}"
+                body = make_image(image_format, parse_size(size), seed=seed + index)
+                s3_client.put_object(Bucket=LOAD_TEST_BUCKET, Key=object_key, Body=body, ContentType=content_type)
+                image_keys[size].append(object_key)
+
+    # a file that is not an image, an empty file and a truncated image
+    s3_client.put_object(Bucket=LOAD_TEST_BUCKET, Key='images/load/errors/not-an-image.jpg', Body=b'not an image', ContentType='image/jpeg')
+    s3_client.put_object(Bucket=LOAD_TEST_BUCKET, Key='images/load/errors/empty.png', Body=b'', ContentType='image/png')
+    truncated = make_image('PNG', parse_size('10KB'), seed=seed)[:64]
+    s3_client.put_object(Bucket=LOAD_TEST_BUCKET, Key='images/load/errors/truncated.png', Body=truncated, ContentType='image/png')
+    error_keys.extend(['images/load/errors/not-an-image.jpg', 'images/load/errors/empty.png', 'images/load/errors/truncated.png'])
+    # a notification for an object that was deleted before it was processed
+    error_keys.append('images/load/errors/missing.jpg')
+    return image_keys, error_keys
+
+
+# generate s3 events with a mix of image sizes, repeated keys and error objects
+# duplicate_rate is the chance a record repeats a key already sent, error_rate the chance it points at an error object
+def generate_events(image_keys, error_keys, size_mix, event_count, records_per_event, duplicate_rate, error_rate, seed):
+    rng = random.Random(seed)
+    sizes, weights = list(size_mix), list(size_mix.values())
+    sent_keys = []
+    sequencer = 1
+    for _ in range(event_count):
+        object_keys = []
+        for _ in range(records_per_event):
+            roll = rng.random()
+            if sent_keys and roll < duplicate_rate:
+                object_keys.append(rng.choice(sent_keys))
+            elif roll < duplicate_rate + error_rate:
+                object_keys.append(rng.choice(error_keys))
+            else:
+                object_keys.append(rng.choice(image_keys[rng.choices(sizes, weights)[0]]))
+        sent_keys.extend(object_keys)
+        yield make_s3_event(LOAD_TEST_BUCKET, object_keys, sequencer_start=sequencer)
+        sequencer += records_per_event
+
+
+# read the events of a replay file, skipping lines that are not events
+def load_replay_events(replay_path):
+    events = []
+    with open(replay_path) as replay_file:
+        for line in replay_file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            event = entry.get('event', entry) if isinstance(entry, dict) else None
+            if isinstance(event, dict) and isinstance(event.get('Records'), list):
+                events.append(event)
+    return events
+
+
+# return the (bucket, key) of every object an event refers to, looking inside sqs message bodies
+def get_event_objects(event):
+    objects = []
+    for record in event['Records']:
+        s3_records = [record]
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                s3_records = json.loads(record['body']).get('Records', [])
+            except (TypeError, ValueError):
+                continue
+        for s3_record in s3_records:
+            try:
+                objects.append((s3_record['s3']['bucket']['name'], s3_record['s3']['object']['key']))
+            except (KeyError, TypeError):
+                continue
+    return objects
+
+
+# create an image for every object of the replayed events that is not in moto yet, in the format of its extension
+def create_replay_objects(s3_client, events, seed):
+    created = set()
+    for bucket_name, object_key in {obj for event in events for obj in get_event_objects(event)}:
+        if bucket_name not in created:
+            try:
+                s3_client.create_bucket(Bucket=bucket_name)
+            except s3_client.exceptions.BucketAlreadyOwnedByYou:
+                pass
+            created.add(bucket_name)
+        image_format = EXTENSION_FORMATS.get(object_key.rsplit('.', 1)[-1].lower(), 'JPEG')
+        body = make_image(image_format, parse_size(REPLAY_IMAGE_SIZE), seed=seed)
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=body, ContentType=IMAGE_FORMATS[image_format])
+
+
+# wrap the s3 records of an event into sqs messages, one record per message, like the sqs ingestion mode delivers them
+def wrap_in_sqs(event):
+    return {'Records': [
+        {
+            'eventSource': 'aws:sqs',
+            'messageId': f"message-{index}",
+            'body': json.dumps({'Records': [record]}),
+        }
+        for index, record in enumerate(event['Records'])
+    ]}
+
+
+# run events through the handler in a worker process until the queue hands out None
+# every worker has its own module state, like one lambda execution environment
+def run_worker(worker_id, task_queue, result_queue, args):
+    from lambda_code import lambda_function
+
+    # the error objects are expected to fail, keep their errors out of the report
+    logger = create_quiet_logger()
+    logger.setLevel(logging.CRITICAL)
+    if args.mysql_host:
+        credentials = (args.mysql_user, args.mysql_password, args.mysql_host, args.mysql_database)
+        database = None
+        connect_patch = patch('pymysql.connect', wraps=db_helpers.pymysql.connect)
+    else:
+        credentials = ('load-test', 'load-test', 'stand-in', 'metadataDB')
+        database = StandInDatabase(latency_ms=args.db_latency_ms, connect_latency_ms=args.db_connect_latency_ms)
+        connect_patch = patch('pymysql.connect', side_effect=database.connect)
+
+    # the worker starts with the memory of the parent it was forked from, only its growth is the handler's
+    reset_peak_rss()
+    start_rss_mb = current_rss_mb()
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=credentials), connect_patch as mock_connect, \
+         patch('lambda_code.lambda_function.create_logger', return_value=logger):
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            scheduled, event = task
+            started = time.perf_counter()
+            response = lambda_function.handler(event)
+            finished = time.perf_counter()
+            failed = len(response.get('batchItemFailures', [])) if 'batchItemFailures' in response else None
+            # the latency is measured from the time the event was due, so a backlog shows up as latency
+            result_queue.put(('event', finished - (scheduled or started), finished - started, len(event['Records']), failed))
+        lambda_function.connection_manager.close()
+        result_queue.put(('worker', worker_id, {
+            'connections_opened': mock_connect.call_count,
+            'rows_stored': len(database.rows) if database else None,
+            'start_rss_mb': start_rss_mb,
+            'peak_rss_mb': read_peak_rss_mb(),
+        }))
+
+
+# read the current resident set size of this process in MB
+def current_rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+# measure the resident memory of a fresh interpreter that imported the handler, what a cold lambda starts with
+def measure_import_rss_mb():
+    code = ("import lambda_code.lambda_function\n"
+            "for line in open('/proc/self/status'):\n"
+            "    if line.startswith('VmRSS:'): print(int(line.split()[1]) / 1024)")
+    try:
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        return round(float(result.stdout.strip()), 2)
+    except (subprocess.CalledProcessError, ValueError):
+        return None
+
+
+# hand the events to the workers, at a fixed rate when one is given or as fast as the workers take them
+def dispatch_events(events, task_queue, workers, rate, duration):
+    started = time.perf_counter()
+    dispatched = 0
+    for index, event in enumerate(events):
+        scheduled = None
+        if rate:
+            scheduled = started + index / rate
+            if duration and scheduled - started > duration:
+                break
+            time.sleep(max(0.0, scheduled - time.perf_counter()))
+        elif duration and time.perf_counter() - started > duration:
+            break
+        task_queue.put((scheduled, event))
+        dispatched += 1
+    for _ in range(workers):
+        task_queue.put(None)
+    return dispatched
+
+
+# summarize the collected results
+def build_report(event_results, worker_stats, elapsed, import_rss_mb, memory_limit_mb):
+    latencies = sorted(result[0] for result in event_results)
+    records = sum(result[2] for result in event_results)
+    failures = [result[3] for result in event_results if result[3] is not None]
+    peak_growth_mb = max(stats['peak_rss_mb'] - stats['start_rss_mb'] for stats in worker_stats)
+    estimated_peak_mb = import_rss_mb + peak_growth_mb if import_rss_mb is not None else None
+    return {
+        'events': len(event_results),
+        'records': records,
+        'failed_records': sum(failures) if failures else None,
+        'elapsed_s': round(elapsed, 3),
+        'events_per_second': round(len(event_results) / elapsed, 2) if elapsed else 0,
+        'records_per_second': round(records / elapsed, 2) if elapsed else 0,
+        'latency_p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'latency_p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'latency_max_ms': round(latencies[-1] * 1000, 2) if latencies else None,
+        'db_connections_opened': sum(stats['connections_opened'] for stats in worker_stats),
+        'rows_stored': sum(stats['rows_stored'] or 0 for stats in worker_stats),
+        'import_rss_mb': import_rss_mb,
+        'worker_peak_growth_mb': round(peak_growth_mb, 2),
+        'estimated_peak_mb': round(estimated_peak_mb, 2) if estimated_peak_mb is not None else None,
+        'memory_limit_mb': memory_limit_mb,
+        'within_memory_limit': estimated_peak_mb <= memory_limit_mb if estimated_peak_mb is not None else None,
+    }
+
+
+# run the load test and return its report
+def run_load_test(args):
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    size_mix = parse_size_mix(args.size_mix)
+    with mock_aws():
+        s3_client = boto3.client('s3')
+        if args.replay:
+            events = load_replay_events(args.replay)
+            print(f"Replaying {len(events)} events from {args.replay}...")
+            create_replay_objects(s3_client, events, args.seed)
+        else:
+            s3_client.create_bucket(Bucket=LOAD_TEST_BUCKET)
+            image_keys, error_keys = create_corpus(s3_client, size_mix, args.images_per_size, args.seed)
+            # with a duration and a rate the events are generated until the duration is over
+            event_count = args.events if not (args.duration and args.rate) else int(args.duration * args.rate) + 1
+            events = generate_events(image_keys, error_keys, size_mix, event_count, args.records_per_event,
+                                     args.duplicate_rate, args.error_rate, args.seed)
+        if args.event_source == 'sqs':
+            events = (wrap_in_sqs(event) if event['Records'] and event['Records'][0].get('eventSource') != 'aws:sqs' else event for event in events)
+
+        # fork the workers after the objects are uploaded so they share moto's state
+        context = multiprocessing.get_context('fork')
+        task_queue = context.Queue(maxsize=args.concurrency * 2)
+        result_queue = context.Queue()
+        workers = [context.Process(target=run_worker, args=(worker_id, task_queue, result_queue, args)) for worker_id in range(args.concurrency)]
+        for worker in workers:
+            worker.start()
+
+        started = time.perf_counter()
+        dispatched = dispatch_events(events, task_queue, args.concurrency, args.rate, args.duration)
+        event_results, worker_stats = [], []
+        while len(worker_stats) < len(workers):
+            try:
+                message = result_queue.get(timeout=args.worker_timeout)
+            except queue.Empty:
+                raise RuntimeError(f"No result from the workers for {args.worker_timeout} s, {len(event_results)} of {dispatched} events finished")
+            if message[0] == 'event':
+                event_results.append(message[1:])
+            else:
+                worker_stats.append(message[2])
+        elapsed = time.perf_counter() - started
+        for worker in workers:
+            worker.join()
+
+    return build_report(event_results, worker_stats, elapsed, measure_import_rss_mb(), args.memory_limit_mb)
+
+
+# parse a size mix such as "10KB=0.5,1MB=0.5"
+def parse_size_mix(size_mix):
+    if not size_mix:
+        return dict(DEFAULT_SIZE_MIX)
+    mix = {}
+    for entry in size_mix.split(','):
+        size, weight = entry.split('=')
+        mix[size.strip()] = float(weight)
+    return mix
+
+
+# print the report
+def print_report(report):
+    print(f"Events: {report['events']}  Records: {report['records']}  Failed records: {report['failed_records']}  Elapsed: {report['elapsed_s']} s")
+    print(f"Throughput: {report['events_per_second']} events/s  {report['records_per_second']} records/s")
+    print(f"Latency: p50 {report['latency_p50_ms']} ms  p95 {report['latency_p95_ms']} ms  p99 {report['latency_p99_ms']} ms  max {report['latency_max_ms']} ms")
+    print(f"DB connections opened: {report['db_connections_opened']}  Rows stored: {report['rows_stored']}")
+    print(f"Memory: {report['import_rss_mb']} MB after import + {report['worker_peak_growth_mb']} MB peak growth = "
+          f"{report['estimated_peak_mb']} MB of the {report['memory_limit_mb']} MB limit")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive the lambda handler with synthetic or replayed s3 events")
+    parser.add_argument('--events', type=int, default=200, help="number of events to send")
+    parser.add_argument('--records-per-event', type=int, default=10, help="s3 records in every event")
+    parser.add_argument('--concurrency', type=int, default=4, help="worker processes, each one a lambda execution environment")
+    parser.add_argument('--rate', type=float, default=None, help="events per second, as fast as the workers take them when not set")
+    parser.add_argument('--duration', type=float, default=None, help="seconds to keep sending events for, for soak tests")
+    parser.add_argument('--size-mix', default=None, help="image sizes and their share, e.g. 10KB=0.5,1MB=0.5")
+    parser.add_argument('--images-per-size', type=int, default=DEFAULT_IMAGES_PER_SIZE, help="distinct images per format and size")
+    parser.add_argument('--duplicate-rate', type=float, default=0.1, help="share of records repeating a key already sent")
+    parser.add_argument('--error-rate', type=float, default=0.02, help="share of records pointing at objects that cannot be processed")
+    parser.add_argument('--event-source', choices=['s3', 'sqs'], default='sqs', help="deliver the records directly or as sqs messages")
+    parser.add_argument('--replay', default=None, help="replay the events of this jsonl file instead of generating them")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory-limit-mb', type=int, default=DEFAULT_MEMORY_LIMIT_MB, help="lambda memory the peak is compared with")
+    parser.add_argument('--worker-timeout', type=float, default=300, help="seconds to wait for a result before giving up")
+    parser.add_argument('--db-latency-ms', type=float, default=1.0, help="round trip latency of the stand-in database")
+    parser.add_argument('--db-connect-latency-ms', type=float, default=20.0, help="handshake latency of the stand-in database")
+    parser.add_argument('--mysql-host', help="write to this mysql instance, e.g. a local container, instead of the stand-in")
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--mysql-database', default='metadataDB')
+    parser.add_argument('--output', help="write the report to this json file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run_load_test(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    # fail when the lambda would have run out of memory
+    return 1 if report['within_memory_limit'] is False else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+# micro benchmarks for the extraction and persistence hot paths of the lambda
+#
+# usage:
+#   python -m benchmarks.run_benchmarks --quick
+#   python -m benchmarks.run_benchmarks --save-baseline benchmarks/baseline.json
+#   python -m benchmarks.run_benchmarks --baseline benchmarks/baseline.json --threshold 0.25
+#
+# s3 is served by moto and rds by an in-memory stand-in unless --mysql-host is given
+import argparse
+import json
+import logging
+import platform
+import resource
+import statistics
+import sys
+import time
+from unittest.mock import patch
+
+import boto3
+from moto import mock_aws
+
+from lambda_code import db_helpers
+from lambda_code.db_helpers import write_to_rds, write_batch_to_rds
+from lambda_code.s3_helpers import fetch_file_contents, probe_image_size
+from lambda_code.utils import extract_metadata, get_image_size, parse_image_header
+from benchmarks.synthetic import FILE_EXTENSIONS, IMAGE_FORMATS, StandInDatabase, make_image, parse_size
+
+DEFAULT_SIZES = ['10KB', '100KB', '1MB', '10MB', '50MB']
+QUICK_SIZES = ['10KB', '100KB', '1MB']
+BENCHMARK_BUCKET = 'benchmark-bucket'
+# number of records written per call in the batch write benchmark
+WRITE_BATCH_SIZE = 100
+# extra memory allowed on top of the relative threshold before a stage counts as regressed
+RSS_SLACK_MB = 5.0
+
+
+# create a logger that drops the info messages so log output does not skew the timings
+def create_quiet_logger():
+    logger = logging.getLogger('benchmarks')
+    logger.setLevel(logging.ERROR)
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler(sys.stderr))
+    return logger
+
+
+# reset the peak resident set size of this process, only supported on linux
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# read the peak resident set size of this process in MB
+def read_peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux and in bytes on mac os
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if platform.system() == 'Darwin' else peak / 1024
+
+
+# return the given percentile of a sorted list of latencies
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+# run a function repeatedly and report ops/s, latency percentiles in ms and the peak rss while it ran
+# ops_per_call is the number of items handled per call, e.g. the records in a batch write
+def measure(function, min_time, max_iterations, ops_per_call=1):
+    # warm up caches and lazy imports before measuring
+    function()
+    reset_peak_rss()
+
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_iterations and (len(latencies) < 3 or time.perf_counter() - started < min_time):
+        call_started = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'iterations': len(latencies),
+        'ops_per_second': round(len(latencies) * ops_per_call / elapsed, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 4),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 4),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 4),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 4),
+        'peak_rss_mb': round(read_peak_rss_mb(), 2),
+    }
+
+
+# benchmark the extraction stages for every format and size
+def run_extraction_benchmarks(s3_client, formats, sizes, args, logger):
+    results = {}
+    for image_format in formats:
+        for size in sizes:
+            image_bytes = make_image(image_format, parse_size(size))
+            object_key = f"images/benchmark-{size}.{FILE_EXTENSIONS[image_format]}"
+            s3_client.put_object(Bucket=BENCHMARK_BUCKET, Key=object_key, Body=image_bytes, ContentType=IMAGE_FORMATS[image_format])
+            s3_response = {'ContentLength': len(image_bytes), 'ContentType': IMAGE_FORMATS[image_format]}
+            header = image_bytes[:16 * 1024]
+
+            stages = {
+                'parse_image_header': lambda: parse_image_header(header),
+                'get_image_size': lambda: get_image_size(image_bytes, logger),
+                'extract_metadata': lambda: extract_metadata(s3_response, image_bytes, object_key, logger),
+                'fetch_file_contents': lambda: fetch_file_contents(s3_client, BENCHMARK_BUCKET, object_key, logger),
+                'probe_image_size': lambda: probe_image_size(s3_client, BENCHMARK_BUCKET, object_key, logger),
+            }
+            for stage, function in stages.items():
+                key = f"{stage}/{image_format}/{size}"
+                results[key] = measure(function, args.min_time, args.max_iterations)
+                print_result(key, results[key])
+            # drop the image before generating the next one to keep memory down
+            del image_bytes, header
+    return results
+
+
+# benchmark the rds write paths against the stand-in database or a real mysql instance
+def run_persistence_benchmarks(args, logger):
+    metadata = [{
+        'imageId': f"images/benchmark-{index}.jpg",
+        'fileName': f"benchmark-{index}.jpg",
+        'fileSize': 1024 * 1024,
+        'fileType': 'image/jpeg',
+        'width': 4032,
+        'height': 3024,
+        'timestamp': '2024-01-01T00:00:00.000000',
+    } for index in range(WRITE_BATCH_SIZE)]
+
+    if args.mysql_host:
+        credentials = (args.mysql_user, args.mysql_password, args.mysql_host, args.mysql_database)
+        connect_patch = patch('pymysql.connect', wraps=db_helpers.pymysql.connect)
+    else:
+        database = StandInDatabase(latency_ms=args.db_latency_ms, connect_latency_ms=args.db_connect_latency_ms)
+        credentials = ('benchmark', 'benchmark', 'stand-in', 'metadataDB')
+        connect_patch = patch('pymysql.connect', side_effect=database.connect)
+
+    results = {}
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=credentials), connect_patch:
+        stages = {
+            'write_to_rds': (lambda: write_to_rds(metadata[0], logger), 1),
+            'write_batch_to_rds': (lambda: write_batch_to_rds(metadata, logger), WRITE_BATCH_SIZE),
+        }
+        for stage, (function, ops_per_call) in stages.items():
+            key = f"{stage}/rows/{ops_per_call}"
+            results[key] = measure(function, args.min_time, args.max_iterations, ops_per_call)
+            print_result(key, results[key])
+    db_helpers.connection_manager.close()
+    return results
+
+
+# print one benchmark result on a single line
+def print_result(key, result):
+    print(f"{key:<45} {result['ops_per_second']:>12.2f} ops/s  p50 {result['p50_ms']:>10.3f} ms  "
+          f"p95 {result['p95_ms']:>10.3f} ms  p99 {result['p99_ms']:>10.3f} ms  peak rss {result['peak_rss_mb']:>8.1f} MB")
+
+
+# compare results with a stored baseline
+# a stage regresses when its p50 latency or peak rss grew by more than the threshold
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['p50_ms'] > base['p50_ms'] * (1 + threshold):
+            regressions.append(f"{key}: p50 {result['p50_ms']} ms vs baseline {base['p50_ms']} ms")
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold) + RSS_SLACK_MB:
+            regressions.append(f"{key}: peak rss {result['peak_rss_mb']} MB vs baseline {base['peak_rss_mb']} MB")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the image metadata extraction and persistence stages")
+    parser.add_argument('--formats', nargs='+', default=list(IMAGE_FORMATS), choices=list(IMAGE_FORMATS))
+    parser.add_argument('--sizes', nargs='+', default=None, help="image sizes such as 10KB 1MB 50MB")
+    parser.add_argument('--quick', action='store_true', help=f"only benchmark {', '.join(QUICK_SIZES)} images")
+    parser.add_argument('--min-time', type=float, default=0.5, help="seconds each stage is measured for")
+    parser.add_argument('--max-iterations', type=int, default=200)
+    parser.add_argument('--output', help="write the results to this json file")
+    parser.add_argument('--baseline', help="compare the results with this baseline json file")
+    parser.add_argument('--save-baseline', help="store the results as a baseline json file")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed relative regression, 0.25 is 25%%")
+    parser.add_argument('--db-latency-ms', type=float, default=1.0, help="round trip latency of the stand-in database")
+    parser.add_argument('--db-connect-latency-ms', type=float, default=20.0, help="handshake latency of the stand-in database")
+    parser.add_argument('--mysql-host', help="benchmark against this mysql instance instead of the stand-in")
+    parser.add_argument('--mysql-user', default='root')
+    parser.add_argument('--mysql-password', default='')
+    parser.add_argument('--mysql-database', default='metadataDB')
+    parser.add_argument('--skip-extraction', action='store_true')
+    parser.add_argument('--skip-persistence', action='store_true')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    logger = create_quiet_logger()
+    if not reset_peak_rss():
+        print("Peak RSS cannot be reset on this platform, memory figures are process wide peaks...")
+
+    results = {}
+    if not args.skip_extraction:
+        with mock_aws():
+            s3_client = boto3.client('s3', region_name='us-east-1')
+            s3_client.create_bucket(Bucket=BENCHMARK_BUCKET)
+            results.update(run_extraction_benchmarks(s3_client, args.formats, sizes, args, logger))
+    if not args.skip_persistence:
+        results.update(run_persistence_benchmarks(args, logger))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.save_baseline}...")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} stages regressed by more than {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No stage regressed by more than {args.threshold:.0%}...")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import io
+import math
+import os
+import threading
+import time
+from PIL import Image
+
+from lambda_code.db_helpers import METADATA_COLUMNS
+
+# formats the synthetic images are generated in, paired with their content type
+IMAGE_FORMATS = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'WEBP': 'image/webp',
+    'GIF': 'image/gif',
+    'TIFF': 'image/tiff',
+}
+
+# rough number of bytes a noisy pixel takes up once encoded, used to pick dimensions for a target file size
+BYTES_PER_PIXEL = {
+    'JPEG': 1.4,
+    'PNG': 3.0,
+    'WEBP': 1.2,
+    'GIF': 1.0,
+    'TIFF': 3.0,
+}
+
+# file extension used for each format
+FILE_EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'WEBP': 'webp',
+    'GIF': 'gif',
+    'TIFF': 'tiff',
+}
+
+
+# parse a size such as "10KB", "1MB" or "512" into a number of bytes
+def parse_size(size):
+    size = size.strip().upper()
+    for suffix, multiplier in (('GB', 1024 ** 3), ('MB', 1024 ** 2), ('KB', 1024), ('B', 1)):
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * multiplier)
+    return int(size)
+
+
+# generate an image of noise in the given format whose encoded size is close to the target size
+# noise barely compresses, so the encoded size follows the number of pixels
+def make_image(image_format, target_bytes, seed=0):
+    pixels = max(16, int(target_bytes / BYTES_PER_PIXEL[image_format]))
+    # use a 4:3 aspect ratio like most camera images, webp is limited to 16383 pixels per side
+    width = min(16383, max(4, int(math.sqrt(pixels * 4 / 3))))
+    height = min(16383, max(3, pixels // width))
+
+    mode = 'P' if image_format == 'GIF' else 'RGB'
+    channels = 1 if mode == 'P' else 3
+    # repeat a random block instead of generating every byte so large images are created quickly
+    block = os.urandom(min(width * height * channels, 1024 * 1024))
+    repeats = -(-width * height * channels // len(block))
+    image = Image.frombytes(mode, (width, height), (block * repeats)[:width * height * channels])
+
+    buffer = io.BytesIO()
+    save_kwargs = {'quality': 95} if image_format in ('JPEG', 'WEBP') else {}
+    image.save(buffer, format=image_format, **save_kwargs)
+    return buffer.getvalue()
+
+
+# build the s3 event lambda receives when an object is created
+def make_s3_event(bucket_name, object_keys, sequencer_start=1):
+    return {
+        "Records": [
+            {
+                "eventSource": "aws:s3",
+                "eventName": "ObjectCreated:Put",
+                "s3": {
+                    "bucket": {"name": bucket_name},
+                    "object": {"key": object_key, "sequencer": format(sequencer_start + index, '018X')}
+                }
+            }
+            for index, object_key in enumerate(object_keys)
+        ]
+    }
+
+
+# stand-in for a pymysql cursor that keeps the rows it was given and simulates the round trip latency of rds
+# besides the upserts it answers the lookups by image id and the keyset pages of image ids the shard rebalance reads
+class StandInCursor:
+
+    def __init__(self, database):
+        self.database = database
+        self.results = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, args=None):
+        self.database.round_trip()
+        statement = ' '.join(sql.split()).upper()
+        self.results = ()
+        if args is not None and statement.startswith('INSERT'):
+            self.database.store([args])
+        elif statement.startswith('SELECT IMAGE_ID FROM IMAGE_METADATA WHERE IMAGE_ID > %S'):
+            last_image_id, limit = args
+            self.results = [(image_id,) for image_id in sorted(self.database.rows) if image_id > last_image_id][:limit]
+        elif statement.startswith('SELECT') and 'WHERE IMAGE_ID IN' in statement:
+            # return the selected columns of the stored rows, which are kept in the order of METADATA_COLUMNS
+            positions = {column: index for index, (column, _) in enumerate(METADATA_COLUMNS)}
+            selected = [positions[column.strip().lower()] for column in sql.split('SELECT', 1)[1].split('FROM', 1)[0].split(',')]
+            rows = [self.database.rows[image_id] for image_id in args if image_id in self.database.rows]
+            self.results = [tuple(row[index] for index in selected) for row in rows]
+        elif statement.startswith('DELETE') and 'WHERE IMAGE_ID IN' in statement:
+            self.database.delete(args)
+
+    def executemany(self, sql, rows):
+        self.database.round_trip()
+        self.database.store(rows)
+
+    def fetchall(self):
+        return self.results
+
+
+# stand-in for a pymysql connection
+class StandInConnection:
+
+    def __init__(self, database):
+        self.database = database
+        self.open = True
+
+    def cursor(self, *args):
+        return StandInCursor(self.database)
+
+    def commit(self):
+        self.database.round_trip()
+
+    def rollback(self):
+        self.database.round_trip()
+
+    def ping(self, reconnect=False):
+        self.database.round_trip()
+
+    def close(self):
+        self.open = False
+
+
+# stand-in database used in place of a mysql instance
+# it keeps the written rows by image id and counts connections and round trips
+class StandInDatabase:
+
+    def __init__(self, latency_ms=0.0, connect_latency_ms=0.0):
+        self.latency = latency_ms / 1000
+        self.connect_latency = connect_latency_ms / 1000
+        self.rows = {}
+        self.connections_opened = 0
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    # simulate the time a statement spends on the network
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    # keep the rows keyed by image id, like the upsert does
+    def store(self, rows):
+        with self.lock:
+            for row in rows:
+                self.rows[row[0]] = row
+
+    def delete(self, image_ids):
+        with self.lock:
+            for image_id in image_ids:
+                self.rows.pop(image_id, None)
+
+    # replacement for pymysql.connect
+    def connect(self, **kwargs):
+        with self.lock:
+            self.connections_opened += 1
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        return StandInConnection(self)
@@ -1,8 +1,26 @@
-from .lambda_function import handler
-from .logging_helpers import create_logger
-from .s3_helpers import fetch_file_contents
-from .db_helpers import write_to_rds
-from .utils import extract_metadata
+import importlib
 
+# the helpers are imported on first use so importing the package does not pay for pillow, pymysql and boto3 up front
+LAZY_EXPORTS = {
+    'handler': '.lambda_function',
+    'create_logger': '.logging_helpers',
+    'fetch_file_contents': '.s3_helpers',
+    'write_to_rds': '.db_helpers',
+    'write_batch_to_rds': '.db_helpers',
+    'extract_metadata': '.utils',
+    'get_metadata': '.query_helpers',
+    'get_many': '.query_helpers',
+}
 
 
+# import the module of an exported helper the first time it is accessed
+def __getattr__(name):
+    if name not in LAZY_EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(LAZY_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + list(LAZY_EXPORTS))
@@ -0,0 +1,163 @@
+# backfill or reindex the image metadata of every object under a bucket prefix
+#
+# usage:
+#   RDS_SECRET_NAME=<secret> python -m lambda_code.backfill --bucket penn-entertainment-bucket --prefix images/ \
+#       --checkpoint backfill-checkpoint.json --workers 16 --batch-size 1000
+#
+# the listing is checkpointed after every page, running the same command again resumes where it stopped
+import argparse
+import json
+import os
+import sys
+import time
+
+import boto3
+from botocore.config import Config
+
+from .db_helpers import write_batch_to_rds, get_stored_etags
+from .lambda_function import process_records, SKIPPED_RECORD
+from .logging_helpers import create_logger
+
+# number of objects requested per ListObjectsV2 page, 1000 is the most s3 returns
+DEFAULT_PAGE_SIZE = 1000
+# number of objects fetched and extracted at the same time
+DEFAULT_BACKFILL_WORKERS = 16
+# number of rows per multi-row upsert, larger than the handler's since a page holds up to 1000 records
+DEFAULT_BACKFILL_BATCH_SIZE = 1000
+
+
+# load the checkpoint of a previous run, or start a new one
+def load_checkpoint(checkpoint_path, bucket_name, prefix):
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        # a checkpoint of another bucket or prefix cannot be resumed
+        if checkpoint.get('bucket') == bucket_name and checkpoint.get('prefix') == prefix:
+            return checkpoint
+    return {
+        'bucket': bucket_name,
+        'prefix': prefix,
+        'continuation_token': None,
+        'complete': False,
+        'pages': 0,
+        'objects_listed': 0,
+        'records_written': 0,
+        'records_skipped': 0,
+        'records_failed': 0,
+        'failed_keys': [],
+    }
+
+
+# write the checkpoint to a temporary file first so a crash never leaves a half written checkpoint
+def save_checkpoint(checkpoint_path, checkpoint):
+    if not checkpoint_path:
+        return
+    temp_path = f"{checkpoint_path}.tmp"
+    with open(temp_path, 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file, indent=2)
+    os.replace(temp_path, checkpoint_path)
+
+
+# build the s3 notification record the handler would receive for a listed object
+def make_record(bucket_name, s3_object):
+    return {
+        's3': {
+            'bucket': {'name': bucket_name},
+            'object': {'key': s3_object['Key'], 'eTag': s3_object.get('ETag'), 'size': s3_object.get('Size')},
+        }
+    }
+
+
+# page through every object under the prefix, extract their metadata concurrently and bulk load it into rds
+# returns the checkpoint with the totals of the run
+def backfill(s3_client, bucket_name, prefix, logger, checkpoint_path=None, workers=DEFAULT_BACKFILL_WORKERS,
+             batch_size=DEFAULT_BACKFILL_BATCH_SIZE, page_size=DEFAULT_PAGE_SIZE, skip_unchanged=False, max_pages=None):
+    checkpoint = load_checkpoint(checkpoint_path, bucket_name, prefix)
+    if checkpoint['complete']:
+        logger.info("Backfill of %s/%s is already complete... Remove %s to run it again...", bucket_name, prefix, checkpoint_path)
+        return checkpoint
+    if checkpoint['continuation_token']:
+        logger.info("Resuming backfill of %s/%s after %s objects...", bucket_name, prefix, checkpoint['objects_listed'])
+
+    started = time.monotonic()
+    processed_this_run = 0
+    pages_this_run = 0
+    while max_pages is None or pages_this_run < max_pages:
+        # list the next page of objects, continuing from the checkpointed token
+        list_kwargs = {'Bucket': bucket_name, 'Prefix': prefix, 'MaxKeys': page_size}
+        if checkpoint['continuation_token']:
+            list_kwargs['ContinuationToken'] = checkpoint['continuation_token']
+        page = s3_client.list_objects_v2(**list_kwargs)
+
+        # folder placeholders have no image to extract
+        records = [make_record(bucket_name, s3_object) for s3_object in page.get('Contents', []) if not s3_object['Key'].endswith('/')]
+
+        # look up the etags already in rds so unchanged objects are not fetched again
+        stored_etags = None
+        if skip_unchanged:
+            stored_etags = get_stored_etags([record['s3']['object']['key'] for record in records], logger)
+
+        # fetch and extract the page with the same code path as the handler
+        results = process_records(s3_client, records, logger, stored_etags, max_workers=workers)
+        pending_metadata = [image_metadata for image_metadata in results if isinstance(image_metadata, dict)]
+        written_ids, failed_ids = write_batch_to_rds(pending_metadata, logger, batch_size=batch_size)
+
+        # keep the keys that failed so they can be retried later
+        extraction_failures = [record['s3']['object']['key'] for record, result in zip(records, results) if result is None]
+        checkpoint['failed_keys'].extend(extraction_failures + failed_ids)
+        checkpoint['records_written'] += len(written_ids)
+        checkpoint['records_failed'] += len(extraction_failures) + len(failed_ids)
+        checkpoint['records_skipped'] += sum(1 for result in results if result == SKIPPED_RECORD)
+        checkpoint['objects_listed'] += len(page.get('Contents', []))
+        checkpoint['pages'] += 1
+        pages_this_run += 1
+        processed_this_run += len(records)
+
+        # only move the checkpoint forward once the page is written
+        checkpoint['continuation_token'] = page.get('NextContinuationToken')
+        checkpoint['complete'] = not page.get('IsTruncated')
+        save_checkpoint(checkpoint_path, checkpoint)
+
+        elapsed = time.monotonic() - started
+        logger.info("Backfill page %s: %s objects listed, %s written, %s skipped, %s failed... %.1f objects/s...",
+                    checkpoint['pages'], checkpoint['objects_listed'], checkpoint['records_written'],
+                    checkpoint['records_skipped'], checkpoint['records_failed'], processed_this_run / elapsed if elapsed else 0)
+        if checkpoint['complete']:
+            break
+
+    logger.info("Backfill of %s/%s %s... %s objects in %.1f s...", bucket_name, prefix,
+                'complete' if checkpoint['complete'] else 'paused', processed_this_run, time.monotonic() - started)
+    return checkpoint
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Extract and store the metadata of every object under a bucket prefix")
+    parser.add_argument('--bucket', required=True, help="bucket to backfill")
+    parser.add_argument('--prefix', default='images/', help="only backfill objects under this prefix")
+    parser.add_argument('--checkpoint', default='backfill-checkpoint.json', help="file the progress is saved to and resumed from")
+    parser.add_argument('--workers', type=int, default=DEFAULT_BACKFILL_WORKERS, help="objects fetched at the same time")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BACKFILL_BATCH_SIZE, help="rows per multi-row upsert")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE, help="objects per ListObjectsV2 page")
+    parser.add_argument('--skip-unchanged', action='store_true', help="skip objects whose etag is already stored in rds")
+    parser.add_argument('--max-pages', type=int, default=None, help="stop after this many pages, resume later from the checkpoint")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logger = create_logger()
+    # give every worker its own connection to s3
+    s3_client = boto3.client('s3', config=Config(max_pool_connections=max(10, args.workers)))
+    checkpoint = backfill(s3_client, args.bucket, args.prefix, logger,
+        checkpoint_path=args.checkpoint,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        page_size=args.page_size,
+        skip_unchanged=args.skip_unchanged,
+        max_pages=args.max_pages,
+    )
+    return 0 if checkpoint['records_failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
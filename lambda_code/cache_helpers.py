@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+# small thread safe least recently used cache
+# used to remember recently processed objects so repeated notifications can be skipped without a network call
+# entries expire ttl_seconds after they were put when a ttl is given, and are kept until evicted otherwise
+class LRUCache:
+
+    def __init__(self, max_size, ttl_seconds=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # counters to monitor how well the cache is doing
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    # return the cached value for the key and mark it as recently used, or the default if it is not cached or expired
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self.entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return default
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    # return the cached value without counting a lookup or marking it as recently used
+    def peek(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (entry[1] is not None and time.monotonic() >= entry[1]):
+                return default
+            return entry[0]
+
+    # cache a value, evicting the least recently used entry when the cache is full
+    def put(self, key, value):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    # remove a key from the cache if it is there
+    def pop(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # remove every entry from the cache
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    # return a copy of the counters with the hit rate and the number of entries
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats, size=len(self.entries))
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    # reset the counters, the entries are kept
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self.entries)
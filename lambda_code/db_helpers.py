@@ -2,95 +2,640 @@ import json
 import pymysql
 import boto3
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 
+from .cache_helpers import LRUCache
+from .metrics_helpers import collect_worker_metrics, merge_metrics, put_metric, stage_timer
+from .shard_helpers import get_shard_ring
+from .utils import get_env_flag, get_env_int
 
-# get RDS credentials from secrets manager
-def get_rds_credentials(secret_name, logger):
-    try:
-        # create secret client using boto3
+# columns of the image_metadata table paired with the metadata keys they are filled from
+METADATA_COLUMNS = [
+    ('image_id', 'imageId'),
+    ('file_name', 'fileName'),
+    ('file_size', 'fileSize'),
+    ('file_type', 'fileType'),
+    ('width', 'width'),
+    ('height', 'height'),
+    ('timestamp', 'timestamp'),
+    ('etag', 'etag'),
+    ('version_id', 'versionId'),
+    ('sequencer', 'sequencer'),
+    ('phash', 'perceptualHash'),
+    ('renditions', 'renditions'),
+    ('is_valid', 'isValid'),
+    ('validation_error', 'validationError'),
+]
+
+# content types stored in the file_type enum column, anything else is stored as 'other'
+FILE_TYPES = (
+    'image/jpeg',
+    'image/png',
+    'image/gif',
+    'image/webp',
+    'image/tiff',
+    'image/bmp',
+    'image/heic',
+    'image/svg+xml',
+    'application/octet-stream',
+    'other',
+)
+
+# number of rows written per multi-row upsert when writing a batch
+DEFAULT_BATCH_SIZE = 100
+
+# add the deltas of every write to the image_metadata_rollup table, set MAINTAIN_ROLLUPS once migration 6 is applied
+# the count and bytes are exact, the dimension bounds only ever widen since a replaced row's dimensions cannot be
+# subtracted from a min or max
+ROLLUP_UPSERT_SQL = """
+            INSERT INTO image_metadata_rollup (image_prefix, file_type, day, image_count, total_bytes, min_width, max_width, min_height, max_height)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+            image_count = image_count + VALUES(image_count),
+            total_bytes = total_bytes + VALUES(total_bytes),
+            min_width = COALESCE(LEAST(min_width, VALUES(min_width)), min_width, VALUES(min_width)),
+            max_width = COALESCE(GREATEST(max_width, VALUES(max_width)), max_width, VALUES(max_width)),
+            min_height = COALESCE(LEAST(min_height, VALUES(min_height)), min_height, VALUES(min_height)),
+            max_height = COALESCE(GREATEST(max_height, VALUES(max_height)), max_height, VALUES(max_height))
+            """
+
+# how long rds credentials are cached before they are fetched from secrets manager again
+DEFAULT_SECRET_TTL_SECONDS = 300
+# credentials this close to expiring are refreshed ahead of time, the cached value is kept if the refresh fails
+DEFAULT_SECRET_REFRESH_SECONDS = 30
+# mysql error code returned when the username or password is rejected
+MYSQL_ACCESS_DENIED_ERROR = 1045
+
+# secrets manager client created once per lambda container
+secrets_client = None
+
+# cached rds credentials keyed by secret name, each entry holds the credentials and the time they were fetched
+credentials_cache = {}
+credentials_cache_lock = threading.Lock()
+# counters to monitor how often secrets manager is called
+credentials_cache_stats = {
+    'hits': 0,
+    'misses': 0,
+    'refreshes': 0,
+    'invalidations': 0,
+}
+
+
+# sql condition true when the row being upserted is not older than the stored one
+# s3 sequencers of the same key grow with every event and can differ in length, they are compared after left padding
+# them with zeros, rows without a sequencer (backfills and reindexes, which read the object as it is now) always apply
+NEWER_SEQUENCER_SQL = "(sequencer IS NULL OR VALUES(sequencer) IS NULL OR LPAD(VALUES(sequencer), 64, '0') >= LPAD(sequencer, 64, '0'))"
+
+
+# build the upsert statement for the image_metadata table
+# check to ensure the partition key (imageId) does not already exist in the table, if so overwrite the contents with the newly extracted contents
+# a stored row written from a later s3 event is kept, so a late retry or a spool replay cannot overwrite it
+# a write without a sequencer keeps the stored one, so a backfill does not let an older event replace the row afterwards
+# mysql applies the assignments in order and later ones see the new values, so the sequencer is assigned last
+def build_upsert_sql():
+    columns = [column for column, _ in METADATA_COLUMNS]
+    placeholders = ', '.join(['%s'] * len(columns))
+    updates = [f"{column} = IF({NEWER_SEQUENCER_SQL}, VALUES({column}), {column})" for column in columns[1:] if column != 'sequencer']
+    updates.append(f"sequencer = IF({NEWER_SEQUENCER_SQL}, COALESCE(VALUES(sequencer), sequencer), sequencer)")
+    updates = ',\n            '.join(updates)
+    return f"""
+            INSERT INTO image_metadata ({', '.join(columns)}) 
+            VALUES ({placeholders})
+            ON DUPLICATE KEY UPDATE
+            {updates}
+            """
+
+
+# check if a write carries an older s3 event than the stored row, the upsert leaves the row alone then
+def is_older_sequencer(sequencer, stored_sequencer):
+    if not sequencer or not stored_sequencer:
+        return False
+    return int(sequencer, 16) < int(stored_sequencer, 16)
+
+
+# map a content type onto one of the values of the file_type enum column
+def normalize_file_type(file_type):
+    if file_type is None:
+        return None
+    file_type = file_type.split(';')[0].strip().lower()
+    return file_type if file_type in FILE_TYPES else 'other'
+
+
+# convert an image metadata dict into a row tuple ordered like METADATA_COLUMNS
+def metadata_to_row(image_metadata):
+    row = {key: image_metadata.get(key) for _, key in METADATA_COLUMNS}
+    row['fileType'] = normalize_file_type(row['fileType'])
+    # the keys and dimensions of the renditions are stored as a json array
+    if row['renditions'] is not None:
+        row['renditions'] = json.dumps(row['renditions'], separators=(',', ':'))
+    return tuple(row.values())
+
+
+# return the rollup group of an image: the folder part of its key like the image_prefix column, its file type and day
+def get_rollup_key(image_id, file_type, time_stamp):
+    day = time_stamp.date().isoformat() if isinstance(time_stamp, datetime) else str(time_stamp)[:10]
+    return image_id[:image_id.rfind('/') + 1], normalize_file_type(file_type), day
+
+
+# work out how a list of upserts changes the rollups
+# stored_rows maps the image ids already in the table to their (file_type, timestamp, file_size, sequencer), a replaced
+# image is subtracted from the group it was counted in before it is added to its new one
+# upserts older than the stored row are left out like the upsert leaves them out
+# returns a dict of rollup key to [count, bytes, min width, max width, min height, max height]
+def compute_rollup_deltas(stored_rows, image_metadata_list):
+    deltas = {}
+    current_rows = dict(stored_rows)
+    for image_metadata in image_metadata_list:
+        image_id = image_metadata['imageId']
+        previous = current_rows.get(image_id)
+        if previous is not None and is_older_sequencer(image_metadata.get('sequencer'), previous[3]):
+            continue
+        if previous is not None:
+            delta = deltas.setdefault(get_rollup_key(image_id, *previous[:2]), [0, 0, None, None, None, None])
+            delta[0] -= 1
+            delta[1] -= previous[2] or 0
+
+        width, height = image_metadata.get('width'), image_metadata.get('height')
+        delta = deltas.setdefault(get_rollup_key(image_id, image_metadata['fileType'], image_metadata['timestamp']), [0, 0, None, None, None, None])
+        delta[0] += 1
+        delta[1] += image_metadata.get('fileSize') or 0
+        delta[2] = width if delta[2] is None else min(delta[2], width)
+        delta[3] = width if delta[3] is None else max(delta[3], width)
+        delta[4] = height if delta[4] is None else min(delta[4], height)
+        delta[5] = height if delta[5] is None else max(delta[5], height)
+        # like the upsert, a write without a sequencer keeps the stored one
+        sequencer = image_metadata.get('sequencer') or (previous[3] if previous is not None else None)
+        current_rows[image_id] = (image_metadata['fileType'], image_metadata['timestamp'], image_metadata.get('fileSize'), sequencer)
+
+    # a re-upload into the same group with the same size and no dimensions changes nothing
+    return {key: delta for key, delta in deltas.items() if delta[0] or delta[1] or delta[2] is not None}
+
+
+# apply the rollup deltas of a list of upserts, on the cursor of the transaction that runs the upsert
+# the stored rows are locked so a concurrent write of the same image cannot subtract the same old row twice
+# the rollup rows are updated in key order so concurrent transactions lock them in the same order
+def apply_rollup_deltas(cursor, image_metadata_list):
+    image_ids = [image_metadata['imageId'] for image_metadata in image_metadata_list]
+    placeholders = ', '.join(['%s'] * len(image_ids))
+    cursor.execute(
+        f"SELECT image_id, file_type, timestamp, file_size, sequencer FROM image_metadata WHERE image_id IN ({placeholders}) FOR UPDATE",
+        tuple(image_ids)
+    )
+    stored_rows = {row[0]: row[1:] for row in cursor.fetchall()}
+    deltas = compute_rollup_deltas(stored_rows, image_metadata_list)
+    if deltas:
+        cursor.executemany(ROLLUP_UPSERT_SQL, [key + tuple(delta) for key, delta in sorted(deltas.items())])
+
+
+# keeps a mysql connection open across warm lambda invocations
+# the connection is checked with a ping before it is handed out and is transparently re-opened when it went stale
+class ConnectionManager:
+
+    def __init__(self, secret_name=None):
+        # name of the secrets manager secret holding the rds credentials, defaults to RDS_SECRET_NAME
+        self.secret_name = secret_name
+        self.connection = None
+        # counters to monitor how often the connection is reused or re-opened
+        self.stats = {
+            'reused': 0,
+            'reconnects': 0,
+            'handshakes': 0,
+            'handshake_ms_total': 0.0,
+            'handshake_ms_last': 0.0,
+        }
+
+    # open a new connection to rds using credentials from secrets manager
+    # if the cached password is rejected the secret was probably rotated, so refetch it once and try again
+    def connect(self, logger):
+        secret_name = self.secret_name or os.getenv('RDS_SECRET_NAME')
+        for attempt in range(2):
+            # get the rds credentials, skipping the cache when retrying after an authentication error
+            db_user, db_password, db_host, db_name = get_rds_credentials(secret_name, logger, force_refresh=attempt > 0)
+
+            # check if any of the credentials are none, if so the connection will not be possible
+            if any(value is None for value in [db_user, db_password, db_host, db_name]):
+                logger.error("All or some of RDS credentials were not received from secrets manager...")
+                return None
+
+            # connect through the rds proxy set in RDS_ENDPOINT when there is one, it shares the secret's credentials
+            # shards have their own secrets and always connect to the host in them
+            if self.secret_name is None:
+                db_host = os.getenv('RDS_ENDPOINT') or db_host
+
+            # time the tcp, tls and authentication handshake
+            start = time.perf_counter()
+            try:
+                with stage_timer('RdsConnect'):
+                    self.connection = pymysql.connect(
+                        host=db_host, 
+                        user=db_user, 
+                        password=db_password, 
+                        database=db_name
+                    )
+            except pymysql.OperationalError as e:
+                if attempt == 0 and e.args and e.args[0] == MYSQL_ACCESS_DENIED_ERROR:
+                    logger.info("RDS rejected the cached credentials, refetching %s...", secret_name)
+                    invalidate_rds_credentials(secret_name)
+                    continue
+                raise
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.stats['handshakes'] += 1
+            self.stats['handshake_ms_total'] += elapsed_ms
+            self.stats['handshake_ms_last'] = elapsed_ms
+            logger.info("Opened new RDS connection in %.1f ms...", elapsed_ms)
+            return self.connection
+
+    # return an open connection, reusing the one from a previous invocation if it still answers a ping
+    def get_connection(self, logger):
+        if self.connection is not None:
+            try:
+                # ping without reconnecting so a dead connection is replaced with fresh credentials
+                self.connection.ping(reconnect=False)
+                self.stats['reused'] += 1
+                return self.connection
+            except Exception as e:
+                logger.info("Cached RDS connection is no longer usable, reconnecting: %s...", e)
+                self.stats['reconnects'] += 1
+                self.close()
+        return self.connect(logger)
+
+    # close the connection and forget it so the next call opens a new one
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+        self.connection = None
+
+    # return a copy of the reuse, reconnect and handshake latency counters
+    def get_stats(self):
+        return dict(self.stats)
+
+
+# module level connection manager shared by all invocations in this lambda container
+connection_manager = ConnectionManager()
+
+# metadata of recently written and looked up images, read through by query_helpers.get_many
+# entries expire so the writes of other containers are picked up, METADATA_CACHE_SIZE=0 turns the cache off
+DEFAULT_METADATA_CACHE_SIZE = 4096
+DEFAULT_METADATA_CACHE_TTL_SECONDS = 300
+metadata_cache = LRUCache(
+    get_env_int('METADATA_CACHE_SIZE', DEFAULT_METADATA_CACHE_SIZE),
+    ttl_seconds=get_env_int('METADATA_CACHE_TTL_SECONDS', DEFAULT_METADATA_CACHE_TTL_SECONDS)
+)
+
+
+# drop the cached metadata of written images so the next lookup reads the stored row
+# the upsert leaves a row alone for an older s3 event, so the written metadata is not necessarily what is stored
+def invalidate_cached_metadata(image_ids):
+    for image_id in image_ids:
+        metadata_cache.pop(image_id)
+
+# connection managers of the shards keyed by secret name, shared by all invocations like connection_manager
+shard_managers = {}
+shard_managers_lock = threading.Lock()
+
+
+# return the connection manager of a shard, creating it on first use
+def get_shard_manager(shard_name):
+    with shard_managers_lock:
+        if shard_name not in shard_managers:
+            shard_managers[shard_name] = ConnectionManager(shard_name)
+        return shard_managers[shard_name]
+
+
+# close the connections of every shard
+def close_shard_managers():
+    with shard_managers_lock:
+        for manager in shard_managers.values():
+            manager.close()
+        shard_managers.clear()
+
+
+# return the connection manager of the database an image is stored in
+def get_manager_for_image(image_id):
+    ring = get_shard_ring()
+    return connection_manager if ring is None else get_shard_manager(ring.get_node(image_id))
+
+
+# return the connection managers of every database in use, the shards when sharding is on
+def get_all_managers():
+    ring = get_shard_ring()
+    return [connection_manager] if ring is None else [get_shard_manager(shard_name) for shard_name in ring.nodes]
+
+
+# run func(items, manager) for the items of every shard at the same time
+# returns the results keyed by shard name, the shards are separate databases so one slow shard does not hold up the others
+def map_shards(groups, func):
+    if len(groups) == 1:
+        shard_name, items = next(iter(groups.items()))
+        return {shard_name: func(items, get_shard_manager(shard_name))}
+    # the metrics the shards report on the worker threads are added to the caller's once they are done
+    run = collect_worker_metrics(func)
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = {shard_name: executor.submit(run, items, get_shard_manager(shard_name)) for shard_name, items in groups.items()}
+        results = {}
+        for shard_name, future in futures.items():
+            results[shard_name], record = future.result()
+            merge_metrics(record)
+        return results
+
+
+# check if a mysql error means the connection was lost and the statement can be retried on a new one
+def is_connection_error(error):
+    return isinstance(error, (pymysql.OperationalError, pymysql.InterfaceError))
+
+
+# check if every database in use, or the one of the manager passed in, hands out a connection that answers a ping
+# tells a database that is down apart from records the database rejected
+def is_rds_available(logger, manager=None):
+    for database_manager in ([manager] if manager else get_all_managers()):
+        try:
+            if database_manager.get_connection(logger) is None:
+                return False
+        except Exception as e:
+            logger.info("RDS is not available: %s...", e)
+            database_manager.close()
+            return False
+    return True
+
+
+# return the secrets manager client, creating it on first use and reusing it across warm invocations
+def get_secrets_client():
+    global secrets_client
+    if secrets_client is None:
         secrets_client = boto3.client('secretsmanager')
-        logger.info(f"Getting RDS credentials from {secret_name}...")
+    return secrets_client
+
+
+# fetch RDS credentials from secrets manager
+def fetch_rds_credentials(secret_name, logger):
+    try:
+        # get the shared secrets manager client
+        secrets_client = get_secrets_client()
+    except Exception as e:
+        logger.error("Error creating secrets manager client: %s...", e)
+        return None, None, None, None
+    try:
+        logger.info("Getting RDS credentials from %s...", secret_name)
         # make request to secrets manager using the secret name
         response = secrets_client.get_secret_value(SecretId=secret_name)
         # extract the and parse the secret string containing rds credentials
         credentials = json.loads(response['SecretString'])
-        logger.info(f"Done getting RDS credentials from {secret_name}...")
+        logger.info("Done getting RDS credentials from %s...", secret_name)
         return credentials['username'], credentials['password'], credentials['host'], credentials['dbname']
     except secrets_client.exceptions.AccessDeniedException:
         # log an error if access to the secret was denied
-        logger.error(f"Access denied for secret {secret_name}...")
+        logger.error("Access denied for secret %s...", secret_name)
         return None, None, None, None
     except secrets_client.exceptions.ResourceNotFoundException:
         # log an error if the secret was not found
-        logger.error(f"Secret {secret_name} not found...")
+        logger.error("Secret %s not found...", secret_name)
         return None, None, None, None
     except Exception as e:
         # log an any other error
-        logger.error(f"Error getting RDS credentials from {secret_name}: {e}...")
+        logger.error("Error getting RDS credentials from %s: %s...", secret_name, e)
         return None, None, None, None
     
 
-# write the image metadata to rds 
-# potential improvement for scaling: when traffic is high we could consider batching the inserts instead of handling them one at a time
-def write_to_rds(image_metadata, logger):
-    # initialize connection to none
-    connection = None 
+# get RDS credentials, served from an in-process cache while they are younger than the ttl
+# force_refresh skips the cache, e.g. after the cached password was rejected because the secret was rotated
+def get_rds_credentials(secret_name, logger, force_refresh=False):
+    with stage_timer('SecretLookup'):
+        return get_cached_rds_credentials(secret_name, logger, force_refresh)
+
+
+# look up the credentials in the cache and fetch them from secrets manager when they are missing, expired or about to expire
+def get_cached_rds_credentials(secret_name, logger, force_refresh):
+    ttl = get_env_int('RDS_SECRET_TTL_SECONDS', DEFAULT_SECRET_TTL_SECONDS)
+    refresh_margin = min(get_env_int('RDS_SECRET_REFRESH_SECONDS', DEFAULT_SECRET_REFRESH_SECONDS), ttl)
+
+    with credentials_cache_lock:
+        cached = credentials_cache.get(secret_name)
+        age = time.monotonic() - cached[1] if cached else None
+
+        # serve the cached credentials while they are fresh
+        if cached and not force_refresh and age < ttl - refresh_margin:
+            credentials_cache_stats['hits'] += 1
+            return cached[0]
+
+        # the credentials are about to expire, refresh them but keep serving the cached ones if secrets manager fails
+        if cached and not force_refresh and age < ttl:
+            credentials_cache_stats['refreshes'] += 1
+            credentials = fetch_rds_credentials(secret_name, logger)
+            if any(value is None for value in credentials):
+                return cached[0]
+        else:
+            credentials_cache_stats['misses'] += 1
+            credentials = fetch_rds_credentials(secret_name, logger)
+
+        # only cache complete credentials so a failed lookup is retried on the next call
+        if ttl > 0 and not any(value is None for value in credentials):
+            credentials_cache[secret_name] = (credentials, time.monotonic())
+        return credentials
+
+
+# drop cached credentials so the next lookup goes to secrets manager, drops every secret when no name is given
+def invalidate_rds_credentials(secret_name=None):
+    with credentials_cache_lock:
+        if secret_name is None:
+            credentials_cache.clear()
+        else:
+            credentials_cache.pop(secret_name, None)
+        credentials_cache_stats['invalidations'] += 1
+
+
+# return a copy of the credential cache hit, miss, refresh and invalidation counters
+def get_credential_cache_stats():
+    with credentials_cache_lock:
+        return dict(credentials_cache_stats)
+
+
+# roll back the open transaction of a failed write, a connection that cannot roll back is closed instead
+# the rollback error is only logged so it does not hide the error of the write
+# returns the connection, or None if there was none or it was closed
+def rollback(connection, manager, logger):
+    if connection is None:
+        return None
     try:
-        logger.info(f"Writing metadata to RDS...")
-        
-        # get the rds credentials from secrets manager
-        db_user, db_password, db_host, db_name = get_rds_credentials(os.getenv('RDS_SECRET_NAME'), logger)
-
-        # check if any of the credentials are none
-        # if so the connection will not be possible, log error and exit 
-        if any(value is None for value in [db_user, db_password, db_host, db_name]):
-            logger.error(f"All or some of RDS credentials were not received from secrets manager...")
+        connection.rollback()
+        return connection
+    except Exception as e:
+        logger.error("Error rolling back the RDS transaction, closing the connection: %s", e)
+        manager.close()
+        return None
+
+
+# write the image metadata to rds 
+def write_to_rds(image_metadata, logger, manager=None):
+    manager = manager or get_manager_for_image(image_metadata['imageId'])
+    # retry once on a fresh connection if the cached one dropped (e.g. after an idle timeout)
+    for attempt in range(2):
+        connection = None
+        try:
+            logger.info("Writing metadata to RDS...")
+
+            # get a connection to rds, if none could be created log error and exit
+            connection = manager.get_connection(logger)
+            if connection is None:
+                return
+
+            # write the image metadata to the image_metadata table 
+            # use place holders for the data types (%s), the mysql driver should infer the data types
+            with stage_timer('RdsWrite'), connection.cursor() as cursor:
+                # update the rollups in the same transaction so they never disagree with the table
+                if get_env_flag('MAINTAIN_ROLLUPS'):
+                    apply_rollup_deltas(cursor, [image_metadata])
+                cursor.execute(build_upsert_sql(), metadata_to_row(image_metadata))
+                
+                connection.commit() 
+                logger.info("Metadata written to RDS successfully...")
+            put_metric('RowsWritten', 1)
+            invalidate_cached_metadata([image_metadata['imageId']])
+            return
+
+        # catch any mysql errors and log them 
+        except pymysql.MySQLError as e:
+            # the row may or may not have changed
+            invalidate_cached_metadata([image_metadata['imageId']])
+            # drop the broken connection so it is not handed out again
+            if is_connection_error(e):
+                manager.close()
+                if attempt == 0:
+                    logger.info("Lost RDS connection while writing metadata, retrying: %s...", e)
+                    put_metric('DbRetries', 1)
+                    continue
+            else:
+                # roll back the failed statement so the cached connection is not handed out mid transaction
+                rollback(connection, manager, logger)
+            logger.error("Error writing metadata to RDS: %s", e)  
             return
+        # catch any general errors and log them 
+        except Exception as e:
+            logger.error("General error writing metadata to RDS: %s", e)  
+            return
+
+
+# write a batch of image metadata to rds using chunked multi-row upserts
+# every chunk is written and committed in its own transaction so a failing chunk does not discard the others
+# returns the image ids that were written and the image ids that failed
+def write_batch_to_rds(image_metadata_list, logger, batch_size=None, manager=None):
+    written_ids, failed_ids = [], []
+    if not image_metadata_list:
+        return written_ids, failed_ids
+
+    batch_size = batch_size or get_env_int('RDS_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    # with SHARD_SECRET_NAMES set the batch is split by shard and the shards are written in parallel
+    if manager is None and get_shard_ring() is not None:
+        return write_batch_to_shards(image_metadata_list, logger, batch_size)
+    maintain_rollups = get_env_flag('MAINTAIN_ROLLUPS')
+    manager = manager or connection_manager
+    connection = None
+    try:
+        logger.info("Writing %s metadata records to RDS in chunks of %s...", len(image_metadata_list), batch_size)
+
+        # reuse the connection from previous invocations when it is still alive
+        connection = manager.get_connection(logger)
 
-        # create connection to rds mysql instance using credentials from secrets manager
-        connection = pymysql.connect(
-            host=db_host, 
-            user=db_user, 
-            password=db_password, 
-            database=db_name
-        )
-
-        # write the image metadata to the image_metadata table 
-        # use place holders for the data types (%s), the mysql driver should infer the data types
-        # check to ensure the partition key (imageId) does not already exist in the table, if so overwrite the contents with the newly extracted contents
+        # without a connection none of the records can be written
+        if connection is None:
+            return written_ids, [image_metadata['imageId'] for image_metadata in image_metadata_list]
+
+        sql = build_upsert_sql()
+        for start in range(0, len(image_metadata_list), batch_size):
+            chunk = image_metadata_list[start:start + batch_size]
+            chunk_ids = [image_metadata['imageId'] for image_metadata in chunk]
+            rows = [metadata_to_row(image_metadata) for image_metadata in chunk]
+            # retry a chunk once on a fresh connection if the cached one dropped
+            for attempt in range(2):
+                try:
+                    # executemany rewrites the statement into a single multi-row insert
+                    with stage_timer('RdsWrite'):
+                        with connection.cursor() as cursor:
+                            # update the rollups in the same transaction so they never disagree with the table
+                            if maintain_rollups:
+                                apply_rollup_deltas(cursor, chunk)
+                            cursor.executemany(sql, rows)
+                        connection.commit()
+                    written_ids.extend(chunk_ids)
+                    put_metric('RowsWritten', len(chunk_ids))
+                    invalidate_cached_metadata(chunk_ids)
+                    break
+                except pymysql.MySQLError as e:
+                    # the rows may or may not have changed
+                    invalidate_cached_metadata(chunk_ids)
+                    if is_connection_error(e):
+                        manager.close()
+                        if attempt == 0:
+                            logger.info("Lost RDS connection while writing a chunk, retrying: %s...", e)
+                            put_metric('DbRetries', 1)
+                            connection = manager.get_connection(logger)
+                            if connection is not None:
+                                continue
+                    else:
+                        # roll back the failed chunk and carry on with the next one
+                        connection = rollback(connection, manager, logger)
+                    logger.error("Error writing chunk of %s metadata records to RDS: %s", len(chunk), e)
+                    failed_ids.extend(chunk_ids)
+                    break
+            # stop early if the connection could not be re-opened
+            if connection is None:
+                break
+
+        logger.info("Metadata batch written to RDS... Written: %s Failed: %s...", len(written_ids), len(failed_ids))
+
+    # catch any errors that stop the batch and close the connection so the next invocation starts clean
+    except Exception as e:
+        logger.error("General error writing metadata batch to RDS: %s", e)
+        manager.close()
+
+    # mark the records that were never attempted as failed
+    done = set(written_ids) | set(failed_ids)
+    failed_ids.extend(image_metadata['imageId'] for image_metadata in image_metadata_list if image_metadata['imageId'] not in done)
+    return written_ids, failed_ids
+
+
+# write a batch of image metadata to the shards the image ids hash to, every shard with its own multi-row upserts
+# returns the image ids that were written and the image ids that failed, in the order of the batch
+def write_batch_to_shards(image_metadata_list, logger, batch_size=None):
+    groups = get_shard_ring().group_by_node(image_metadata_list, key=lambda image_metadata: image_metadata['imageId'])
+    logger.info("Writing %s metadata records to %s shards...", len(image_metadata_list), len(groups))
+    results = map_shards(groups, lambda shard_metadata, manager: write_batch_to_rds(shard_metadata, logger, batch_size, manager))
+    written = {image_id for written_ids, _ in results.values() for image_id in written_ids}
+    written_ids = [image_metadata['imageId'] for image_metadata in image_metadata_list if image_metadata['imageId'] in written]
+    failed_ids = [image_metadata['imageId'] for image_metadata in image_metadata_list if image_metadata['imageId'] not in written]
+    return written_ids, failed_ids
+
+
+# look up the etags stored in rds for a list of image ids with a single query
+# returns a dict of image id to etag, images that are not in the table are left out
+def get_stored_etags(image_ids, logger, manager=None):
+    if not image_ids:
+        return {}
+    # with sharding on every shard is asked for the etags of its own image ids
+    ring = get_shard_ring()
+    if manager is None and ring is not None:
+        results = map_shards(ring.group_by_node(image_ids), lambda shard_ids, shard_manager: get_stored_etags(shard_ids, logger, shard_manager))
+        return {image_id: etag for shard_etags in results.values() for image_id, etag in shard_etags.items()}
+    manager = manager or connection_manager
+    try:
+        connection = manager.get_connection(logger)
+        if connection is None:
+            return {}
         with connection.cursor() as cursor:
-            sql = """
-            INSERT INTO image_metadata (image_id, file_name, file_size, file_type, width, height, timestamp) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            ON DUPLICATE KEY UPDATE
-            file_name = VALUES(file_name),
-            file_size = VALUES(file_size),
-            file_type = VALUES(file_type),
-            width = VALUES(width),
-            height = VALUES(height),
-            timestamp = VALUES(timestamp)
-            """
-            cursor.execute(sql, 
-                image_metadata['imageId'],
-                image_metadata['fileName'],
-                image_metadata['fileSize'],
-                image_metadata['fileType'],
-                image_metadata['width'],
-                image_metadata['height'],
-                image_metadata['timestamp']
-            )
-            
-            connection.commit() 
-            logger.info(f"Metadata written to RDS successfully...")
-
-    # catch any mysql errors and log them 
+            placeholders = ', '.join(['%s'] * len(image_ids))
+            cursor.execute(f"SELECT image_id, etag FROM image_metadata WHERE image_id IN ({placeholders})", tuple(image_ids))
+            rows = cursor.fetchall()
+        # end the read so the next statement sees fresh data
+        connection.commit()
+        return {image_id: etag for image_id, etag in rows if etag}
     except pymysql.MySQLError as e:
-        logger.error(f"Error writing metadata to RDS: {e}")  
-    # catch any general errors and log them 
-    except Exception as e:
-        logger.error(f"General error writing metadata to RDS: {e}")  
-    # check if the connection was created
-    # close the connection if it was created
-    finally:
-        if connection:  
-            connection.close()
+        # without the stored etags every record is processed as usual
+        logger.error("Error reading stored etags from RDS: %s", e)
+        if is_connection_error(e):
+            manager.close()
+        return {}
@@ -0,0 +1,274 @@
+# export the image metadata to s3 for analytics, as date partitioned parquet or csv.gz when pyarrow is not installed
+#
+# usage:
+#   RDS_SECRET_NAME=<secret> python -m lambda_code.export --bucket penn-analytics --prefix exports/image_metadata/
+#   EXPORT_SECRET_NAME=<read replica secret> python -m lambda_code.export --bucket penn-analytics --full
+#
+# rows are streamed from a server side cursor in (updated_at, image_id) order and written to s3 with multipart uploads as
+# they arrive, so the export runs in constant memory however large the table is
+# every run writes <prefix>date=<day updated>/<run id>.<ext> objects and stores the last row it exported in
+# <prefix>_high_water_mark.json, the next run only exports the rows written or changed after it, so a changed row is
+# exported again by the run after the change
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sys
+import uuid
+from datetime import datetime, timezone
+
+import boto3
+import pymysql
+from botocore.exceptions import ClientError
+
+from .db_helpers import METADATA_COLUMNS, ConnectionManager, rollback
+from .logging_helpers import create_logger
+from .s3_helpers import LARGE_OBJECT_PART_BYTES, MultipartUploadWriter
+
+# rows fetched from the server side cursor at a time, and rows per parquet row group
+DEFAULT_EXPORT_BATCH_ROWS = 10000
+# rows written in the last seconds are left for the next run so a write that is still in flight is not skipped
+# updated_at is set by mysql when the row is written, a transaction open for longer than this can still be missed
+DEFAULT_SETTLE_SECONDS = 60
+# name of the object holding the high water mark, under the export prefix
+HIGH_WATER_MARK_NAME = '_high_water_mark.json'
+
+# updated_at is the time mysql wrote the row, see migration 8
+EXPORT_COLUMNS = [column for column, _ in METADATA_COLUMNS] + ['updated_at']
+
+# parquet type of every exported column, columns not listed are written as strings
+PARQUET_TYPES = {
+    'file_size': 'int64',
+    'width': 'int32',
+    'height': 'int32',
+    'timestamp': 'timestamp',
+    'phash': 'uint64',
+    'is_valid': 'bool',
+    'updated_at': 'timestamp',
+}
+
+# content type and file extension of the export formats
+EXPORT_FORMATS = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'csv': ('application/gzip', 'csv.gz'),
+}
+
+
+# import pyarrow if it is installed, the csv.gz format is used without it
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+# build the parquet schema of the exported columns
+def build_parquet_schema(pyarrow):
+    types = {
+        'int64': pyarrow.int64(),
+        'int32': pyarrow.int32(),
+        'uint64': pyarrow.uint64(),
+        'timestamp': pyarrow.timestamp('us'),
+        'bool': pyarrow.bool_(),
+    }
+    return pyarrow.schema([(column, types.get(PARQUET_TYPES.get(column), pyarrow.string())) for column in EXPORT_COLUMNS])
+
+
+# writes the rows of one partition as parquet, a row group at a time
+class ParquetPartitionWriter:
+
+    def __init__(self, sink, batch_rows):
+        self.pyarrow = load_pyarrow()
+        self.schema = build_parquet_schema(self.pyarrow)
+        self.writer = self.pyarrow.parquet.ParquetWriter(self.pyarrow.PythonFile(sink, mode='w'), self.schema, compression='snappy')
+        self.batch_rows = batch_rows
+        self.rows = []
+
+    def write_row(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_rows:
+            self.write_row_group()
+
+    def write_row_group(self):
+        if self.rows:
+            columns = [list(values) for values in zip(*self.rows)]
+            # mysql returns booleans as 0 and 1, which pyarrow does not accept for a bool column
+            for index, column in enumerate(EXPORT_COLUMNS):
+                if PARQUET_TYPES.get(column) == 'bool':
+                    columns[index] = [None if value is None else bool(value) for value in columns[index]]
+            self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.write_row_group()
+        self.writer.close()
+
+
+# writes the rows of one partition as gzip compressed csv with a header row
+class CsvPartitionWriter:
+
+    def __init__(self, sink, batch_rows):
+        # mtime=0 keeps the gzip header the same for the same rows
+        self.text = io.TextIOWrapper(gzip.GzipFile(fileobj=sink, mode='wb', mtime=0), encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(EXPORT_COLUMNS)
+
+    def write_row(self, row):
+        self.writer.writerow([value.isoformat() if isinstance(value, datetime) else value for value in row])
+
+    def close(self):
+        # closing the gzip file writes its trailer and leaves the sink open
+        self.text.close()
+
+
+PARTITION_WRITERS = {
+    'parquet': ParquetPartitionWriter,
+    'csv': CsvPartitionWriter,
+}
+
+
+# return the key of the object holding the high water mark of an export prefix
+def get_high_water_mark_key(prefix):
+    return f"{prefix}{HIGH_WATER_MARK_NAME}"
+
+
+# load the high water mark of the previous run, None if nothing was exported yet
+def load_high_water_mark(s3_client, bucket_name, prefix):
+    try:
+        body = s3_client.get_object(Bucket=bucket_name, Key=get_high_water_mark_key(prefix))['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+            return None
+        raise
+    return json.loads(body)
+
+
+def save_high_water_mark(s3_client, bucket_name, prefix, high_water_mark):
+    s3_client.put_object(Bucket=bucket_name, Key=get_high_water_mark_key(prefix), Body=json.dumps(high_water_mark, indent=2).encode('utf-8'), ContentType='application/json')
+
+
+# build the query reading the rows written after the high water mark and before the settle window in write order
+# the extraction timestamp is set before the write and a replayed or retried write can land long after it, so rows
+# are ordered by updated_at, which mysql sets when the row is written, and the settle window is on the database clock
+# the (updated_at, image_id) order is served by the updated_at index, which holds the primary key
+# a high water mark written before updated_at existed has no updated_at, every row is exported again then
+def build_export_query(high_water_mark, settle_seconds):
+    conditions, args = ["updated_at < NOW(6) - INTERVAL %s SECOND"], [settle_seconds]
+    if high_water_mark is not None and high_water_mark.get('updated_at') is not None:
+        conditions.append("(updated_at > %s OR (updated_at = %s AND image_id > %s))")
+        args.extend([high_water_mark['updated_at'], high_water_mark['updated_at'], high_water_mark['image_id']])
+    sql = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM image_metadata WHERE {' AND '.join(conditions)} ORDER BY updated_at, image_id"
+    return sql, tuple(args)
+
+
+# stream the rows of image_metadata written after the high water mark to s3, one object per day the rows were written
+# the high water mark only moves once every object of the run is complete, a failed run removes what it wrote so the
+# next run exports the same rows again without duplicates
+# returns a dict with the objects and rows exported and whether the run completed
+def export_image_metadata(s3_client, bucket_name, prefix, logger, incremental=True, export_format=None,
+                          batch_rows=DEFAULT_EXPORT_BATCH_ROWS, settle_seconds=DEFAULT_SETTLE_SECONDS,
+                          part_size=LARGE_OBJECT_PART_BYTES, manager=None):
+    export_format = export_format or ('parquet' if load_pyarrow() is not None else 'csv')
+    content_type, extension = EXPORT_FORMATS[export_format]
+    # the streaming cursor holds its connection until every row is read, so the export never shares the ingest connection
+    # EXPORT_SECRET_NAME points the export at a read replica so it does not compete with the ingest path
+    owns_manager = manager is None
+    manager = manager or ConnectionManager(os.getenv('EXPORT_SECRET_NAME'))
+    high_water_mark = load_high_water_mark(s3_client, bucket_name, prefix) if incremental else None
+    run_id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    totals = {'format': export_format, 'objects': [], 'rows': 0, 'complete': False}
+
+    connection = manager.get_connection(logger)
+    if connection is None:
+        logger.error("Could not connect to RDS to export image metadata...")
+        return totals
+
+    sql, args = build_export_query(high_water_mark, settle_seconds)
+    logger.info("Exporting image metadata after %s as %s to %s/%s...", high_water_mark, export_format, bucket_name, prefix)
+    sink = partition_writer = None
+    current_day = last_row = None
+    try:
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+            cursor.execute(sql, args)
+            while True:
+                rows = cursor.fetchmany(batch_rows)
+                if not rows:
+                    break
+                for row in rows:
+                    updated_at = row[EXPORT_COLUMNS.index('updated_at')]
+                    day = updated_at.date().isoformat() if isinstance(updated_at, datetime) else str(updated_at)[:10]
+                    # rows arrive in updated_at order, so a partition is complete once the day changes
+                    if day != current_day:
+                        if partition_writer is not None:
+                            partition_writer.close()
+                            sink.close()
+                        object_key = f"{prefix}date={day}/{run_id}.{extension}"
+                        sink = MultipartUploadWriter(s3_client, bucket_name, object_key, part_size=part_size, content_type=content_type)
+                        partition_writer = PARTITION_WRITERS[export_format](sink, batch_rows)
+                        totals['objects'].append(object_key)
+                        current_day = day
+                    partition_writer.write_row(row)
+                    last_row = row
+                totals['rows'] += len(rows)
+        if partition_writer is not None:
+            partition_writer.close()
+            sink.close()
+        # end the read so the snapshot is released
+        connection.commit()
+    except Exception as e:
+        logger.error("Error exporting image metadata after %s rows: %s...", totals['rows'], e)
+        if sink is not None:
+            sink.abort()
+        # remove the partitions this run completed so they are not exported twice
+        for object_key in totals['objects']:
+            s3_client.delete_object(Bucket=bucket_name, Key=object_key)
+        # a manager passed in is shared with the caller, so its connection is rolled back rather than closed
+        if owns_manager:
+            manager.close()
+        else:
+            rollback(connection, manager, logger)
+        return totals
+
+    if last_row is not None:
+        updated_at = last_row[EXPORT_COLUMNS.index('updated_at')]
+        save_high_water_mark(s3_client, bucket_name, prefix, {
+            'updated_at': updated_at.isoformat(sep=' ') if isinstance(updated_at, datetime) else updated_at,
+            'image_id': last_row[EXPORT_COLUMNS.index('image_id')],
+            'run_id': run_id,
+            'rows': totals['rows'],
+        })
+    if owns_manager:
+        manager.close()
+    totals['complete'] = True
+    logger.info("Exported %s rows to %s objects...", totals['rows'], len(totals['objects']))
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export the image metadata to s3 as date partitioned parquet or csv.gz")
+    parser.add_argument('--bucket', required=True, help="bucket the export is written to")
+    parser.add_argument('--prefix', default='exports/image_metadata/', help="prefix of the exported objects and the high water mark")
+    parser.add_argument('--format', choices=sorted(EXPORT_FORMATS), default=None, help="defaults to parquet when pyarrow is installed, csv otherwise")
+    parser.add_argument('--full', action='store_true', help="export every row instead of the rows after the high water mark")
+    parser.add_argument('--batch-rows', type=int, default=DEFAULT_EXPORT_BATCH_ROWS, help="rows fetched at a time and rows per parquet row group")
+    parser.add_argument('--settle-seconds', type=int, default=DEFAULT_SETTLE_SECONDS, help="leave the rows written in the last seconds for the next run")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    totals = export_image_metadata(boto3.client('s3'), args.bucket, args.prefix, create_logger(),
+        incremental=not args.full,
+        export_format=args.format,
+        batch_rows=args.batch_rows,
+        settle_seconds=args.settle_seconds,
+    )
+    return 0 if totals['complete'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
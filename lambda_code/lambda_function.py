@@ -1,51 +1,356 @@
-import boto3
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .logging_helpers import create_logger
-from .s3_helpers import fetch_file_contents
-from .db_helpers import write_to_rds
-from .utils import extract_metadata
+# boto3, pymysql and the rds, spool, rendition and verify helpers are imported by the code paths that use them,
+# so a cold start only pays for the features that are turned on, see scripts/measure_import_time.py
+from .logging_helpers import create_logger, flush_logs, set_object_key, set_request_id
+from .s3_helpers import fetch_file_contents, probe_image_size
+from .cache_helpers import LRUCache
+from .metrics_helpers import start_metrics, flush_metrics, current_metrics, put_metric, set_dimension, set_property, stage_timer, get_size_bucket
+from .utils import extract_metadata, get_env_flag, get_env_int, get_perceptual_hash_algorithm, normalize_etag, load_pillow, is_within_pixel_limit
 
+# number of records fetched and extracted at the same time, 1 processes the records one after another
+DEFAULT_RECORD_WORKERS = 1
+# number of recently processed objects remembered by this lambda container
+DEFAULT_PROCESSED_CACHE_SIZE = 1024
+# seconds an etag written by this container is trusted without asking rds, another container may write a newer
+# version of the object in the meantime
+DEFAULT_PROCESSED_CACHE_TTL_SECONDS = 60
 
-def handler(event):
-    logger = create_logger()
-    logger.info(f"Invoking image metadata extractor lambda...")
+# returned by process_record when the object was already processed and nothing needs to be written
+SKIPPED_RECORD = 'skipped'
 
-    s3_client = boto3.client('s3')
+# etags of recently written objects keyed by object key, shared by the warm invocations of this container
+processed_etags = LRUCache(
+    get_env_int('PROCESSED_CACHE_SIZE', DEFAULT_PROCESSED_CACHE_SIZE),
+    ttl_seconds=get_env_int('PROCESSED_CACHE_TTL_SECONDS', DEFAULT_PROCESSED_CACHE_TTL_SECONDS)
+)
 
-    # itterate through the records array from the triggering event
-    for record in event['Records']:
+# s3 client created once per lambda container
+s3_client = None
+
+# a PERCEPTUAL_HASH the extraction does not know fails the cold start instead of leaving every image without a hash
+get_perceptual_hash_algorithm()
+
+
+# return the s3 client, creating it on first use and reusing it across warm invocations
+def get_s3_client():
+    global s3_client
+    if s3_client is None:
+        import boto3
+        s3_client = boto3.client('s3')
+    return s3_client
+
+
+# do the expensive one off work during the lambda init phase, which is not billed at the invocation's duration
+# creates the s3 client, imports pillow, fetches the rds credentials and opens the rds connections
+def warmup(logger):
+    from .db_helpers import get_all_managers
+    try:
+        logger.info("Warming up image metadata extractor lambda...")
+        get_s3_client()
+        load_pillow()
+        # open the connection of every shard when the metadata is sharded
+        for manager in get_all_managers():
+            manager.get_connection(logger)
+    except Exception as e:
+        # a failed warmup is not fatal, the invocation will retry whatever is missing
+        logger.error("Error warming up lambda: %s...", e)
+
+
+# convert an s3 event sequencer into a number, sequencers of the same key grow with every event
+# sequencers can differ in length, comparing them as hex numbers is the same as padding the shorter one with leading zeros
+def sequencer_value(record):
+    sequencer = record.get('s3', {}).get('object', {}).get('sequencer')
+    try:
+        return int(sequencer, 16)
+    except (TypeError, ValueError):
+        return -1
+
+
+# collapse records of the same object within a batch to the one with the latest sequencer
+# s3 can deliver duplicate or out of order notifications and every copy would otherwise be fetched and written again
+def collapse_duplicate_records(s3_records):
+    latest = {}
+    for message_id, record in s3_records:
         try:
-            # extract the bucket name and object key from the record
-            bucket_name = record['s3']['bucket']['name']
-            object_key = record['s3']['object']['key']
+            key = (record['s3']['bucket']['name'], record['s3']['object']['key'])
+        except (KeyError, TypeError):
+            # let process_record report malformed records
+            key = id(record)
+        if key not in latest or sequencer_value(record) >= sequencer_value(latest[key][1]):
+            latest[key] = (message_id, record)
+    return list(latest.values())
+
+
+# check if the object of a record was already processed with the same content
+# the etag is compared against the recently processed objects first and then against the etag stored in rds,
+# the current etag comes from the notification and falls back to a HEAD request when the notification has none
+def is_unchanged(s3_client, record, stored_etags, logger):
+    bucket_name = record['s3']['bucket']['name']
+    object_key = record['s3']['object']['key']
+    # the etag stored in rds is authoritative, the one this container wrote is only used when rds was not asked
+    known_etag = stored_etags.get(object_key) or processed_etags.get(object_key)
+    if known_etag is None:
+        return False
 
-            # use the bucket name and object key to fetch the file from s3 
+    current_etag = normalize_etag(record['s3']['object'].get('eTag'))
+    if current_etag is None:
+        current_etag = normalize_etag(s3_client.head_object(Bucket=bucket_name, Key=object_key).get('ETag'))
+    return current_etag == known_etag
+
+
+# fetch a single record from s3 and extract its metadata, timing the record when metrics are enabled
+# returns the image metadata, SKIPPED_RECORD if the object is unchanged, or None if the record failed
+# stored_etags holds the etags already in rds, passing it turns on skipping of unchanged objects
+def process_record(s3_client, record, logger, stored_etags=None):
+    start_metrics()
+    with stage_timer('Record'):
+        result = fetch_and_extract_record(s3_client, record, logger, stored_etags)
+    set_object_key(None)
+
+    # break the record metrics down by file type and size
+    if isinstance(result, dict) and current_metrics() is not None:
+        set_dimension('FileType', result.get('fileType'))
+        set_dimension('SizeBucket', get_size_bucket(result.get('fileSize') or 0))
+        set_property('objectKey', result['imageId'])
+    flush_metrics()
+    return result
+
+
+# fetch a single record from s3 and extract its metadata
+# errors are logged here so one record cannot fail the others
+def fetch_and_extract_record(s3_client, record, logger, stored_etags):
+    object_key = None
+    try:
+        # extract the bucket name and object key from the record
+        bucket_name = record['s3']['bucket']['name']
+        object_key = record['s3']['object']['key']
+        # tag the log records of this object with its key
+        set_object_key(object_key)
+
+        # skip objects whose content was already processed before fetching their body
+        if stored_etags is not None and is_unchanged(s3_client, record, stored_etags, logger):
+            logger.info("Skipping file %s... Object is unchanged since it was last processed...", object_key)
+            return SKIPPED_RECORD
+
+        s3_file_content = None
+        image_size = None
+        image = None
+        renditions = []
+        if os.getenv('RENDITIONS'):
+            from .rendition_helpers import get_renditions, open_rendition_source, create_renditions
+            renditions = get_renditions(logger)
+        verify = get_env_flag('VERIFY_IMAGES')
+
+        # when header probing is enabled, read the dimensions from a ranged get instead of downloading the whole file
+        # perceptual hashing, renditions and verification need the whole image, so the probe is only used when they are off
+        if get_env_flag('IMAGE_HEADER_PROBE') and not os.getenv('PERCEPTUAL_HASH') and not renditions and not verify:
+            s3_response, width, height = probe_image_size(s3_client, bucket_name, object_key, logger)
+            if s3_response is not None:
+                # reject decompression bombs without fetching the rest of the file
+                if not is_within_pixel_limit(width, height, logger):
+                    logger.error("Skipping file %s... Image is too large to process...", object_key)
+                    return None
+                image_size = (width, height)
+
+        # fall back to fetching the whole file when probing is disabled or the header could not be parsed
+        if image_size is None:
+            # use the bucket name and object key to fetch the file from s3
             s3_response, s3_file_content = fetch_file_contents(s3_client, bucket_name, object_key, logger)
 
             # check to see if we got a response from s3
-            # even if we got a response from s3 we want to ensure we also recieved the file contents (the image) 
-            # if either is none, log an error and continue to the next record
+            # even if we got a response from s3 we want to ensure we also recieved the file contents (the image)
+            # if either is none, log an error and skip the record
             if s3_response is None or s3_file_content is None:
-                logger.error(f"Skipping file {object_key}... Could not fetch file contents...")
-                continue
-            
-            # extract the file metadata 
-            image_metadata = extract_metadata(s3_response, s3_file_content, object_key, logger)
-
-            # check if metadata extraction was successfull 
-            # if unnsuccesful skip writing to rds, log an error and continue to the next record
-            if image_metadata is None:
-                logger.error(f"Skipping file {object_key}... Could not extract file metadata...")
-                continue
-            
-            # write the image metadata to rds if extraction was successfull 
-            write_to_rds(image_metadata, logger)
-        
-        except Exception as e:
-            # handle any unexpected errors
-            logger.error(f"Error processing file {object_key}: {e}...")
+                logger.error("Skipping file %s... Could not fetch file contents...", object_key)
+                return None
+
+        # extract the file metadata
+        try:
+            # open the image once and share it between the metadata, the perceptual hash and the renditions
+            if renditions and s3_file_content is not None:
+                image, image_size = open_rendition_source(s3_file_content, renditions, logger)
+                if image is None:
+                    logger.error("Skipping file %s... Could not open image...", object_key)
+                    return None
+            with stage_timer('ExtractMetadata'):
+                image_metadata = extract_metadata(s3_response, s3_file_content, object_key, logger, image_size=image_size, image=image)
+            # write the renditions from the already decoded image instead of downloading and decoding it again elsewhere
+            if image_metadata is not None and image is not None:
+                image_metadata['renditions'] = create_renditions(s3_client, bucket_name, object_key, image, renditions, logger)
+            # decode the whole image in a worker process, a corrupt image is still recorded but flagged as invalid
+            if image_metadata is not None and verify:
+                from .verify_helpers import verify_image_contents
+                image_metadata['isValid'], image_metadata['validationError'] = verify_image_contents(s3_file_content, object_key, logger)
+        finally:
+            # release the decoded pixels before the buffer they were read from
+            if image is not None:
+                image.close()
+            # large objects are memory mapped from /tmp, release the mapping and its disk space
+            if hasattr(s3_file_content, 'close'):
+                s3_file_content.close()
+
+        # check if metadata extraction was successfull
+        # if unnsuccesful skip writing to rds and log an error
+        if image_metadata is None:
+            logger.error("Skipping file %s... Could not extract file metadata...", object_key)
+            return None
+
+        # keep the event sequencer next to the metadata so the order of notifications can be traced
+        image_metadata['sequencer'] = record['s3']['object'].get('sequencer')
+        return image_metadata
+
+    except Exception as e:
+        # handle any unexpected errors
+        logger.error("Error processing file %s: %s...", object_key, e)
+        return None
+
+
+# fetch and extract every record, on a bounded thread pool when more than one worker is configured
+# with VERIFY_IMAGES the records default to one thread per verify worker so every worker process has an image to decode
+# the results keep the order of the records so the writes happen in the same order as the event
+def process_records(s3_client, records, logger, stored_etags=None, max_workers=None):
+    default_workers = DEFAULT_RECORD_WORKERS
+    if get_env_flag('VERIFY_IMAGES'):
+        from .verify_helpers import get_verify_workers
+        default_workers = get_verify_workers()
+    max_workers = min(max_workers or get_env_int('RECORD_WORKERS', default_workers), len(records))
+    if max_workers <= 1:
+        return [process_record(s3_client, record, logger, stored_etags) for record in records]
+
+    logger.info("Processing %s records with %s workers...", len(records), max_workers)
+    # the records are almost entirely waiting on s3, so threads overlap that wait (boto3 clients are thread safe)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda record: process_record(s3_client, record, logger, stored_etags), records))
+
+
+# unwrap the s3 records from the triggering event
+# direct s3 notifications carry the records themselves, sqs messages carry an s3 notification as json in their body
+# returns a list of (message id, s3 record) pairs, the message id is None for direct s3 notifications,
+# and the ids of sqs messages whose body could not be read
+def unwrap_records(event, logger):
+    s3_records, invalid_message_ids = [], []
+    for record in event['Records']:
+        if record.get('eventSource') != 'aws:sqs':
+            s3_records.append((None, record))
+            continue
+
+        message_id = record['messageId']
+        try:
+            body = json.loads(record['body'])
+        except (TypeError, ValueError) as e:
+            logger.error("Could not read s3 notification from message %s: %s...", message_id, e)
+            invalid_message_ids.append(message_id)
+            continue
+
+        # s3 sends a test event when the notification is configured, there is nothing to process in it
+        if body.get('Event') == 's3:TestEvent':
+            continue
+        for s3_record in body.get('Records', []):
+            s3_records.append((message_id, s3_record))
+    return s3_records, invalid_message_ids
+
+
+def handler(event, context=None):
+    logger = create_logger()
+    # tag the log records of this invocation with its request id
+    set_request_id(getattr(context, 'aws_request_id', None))
+    try:
+        return handle_event(event, logger)
+    finally:
+        # write out the queued log records before lambda freezes the container
+        flush_logs()
+
+
+# process the records of an event and write their metadata to rds
+def handle_event(event, logger):
+    logger.info("Invoking image metadata extractor lambda...")
+    # collect the invocation wide metrics, the records collect their own
+    start_metrics()
+
+    s3_client = get_s3_client()
+
+    # get the s3 records from the event, whether they arrived directly from s3 or through sqs
+    s3_records, failed_message_ids = unwrap_records(event, logger)
+    # only process the latest notification of every object in the batch
+    s3_records = collapse_duplicate_records(s3_records)
+    records = [s3_record for _, s3_record in s3_records]
+
+    # when skipping unchanged objects, look up the stored etags of the objects this container has not processed recently
+    stored_etags = None
+    if get_env_flag('SKIP_UNCHANGED_OBJECTS'):
+        from .db_helpers import get_stored_etags
+        unknown_keys = []
+        for record in records:
+            object_key = record.get('s3', {}).get('object', {}).get('key')
+            if object_key is not None and processed_etags.get(object_key) is None:
+                unknown_keys.append(object_key)
+        stored_etags = get_stored_etags(unknown_keys, logger)
+
+    # fetch and extract the records from the triggering event
+    # keep the metadata of every successful record so it can be written to rds in one batch
+    results = process_records(s3_client, records, logger, stored_etags)
+    pending_metadata = [image_metadata for image_metadata in results if isinstance(image_metadata, dict)]
+
+    # write all successfully extracted metadata to rds using multi-row upserts
+    # with the write-behind spool enabled rds is skipped while the circuit is open
+    from .db_helpers import write_batch_to_rds
+    spool_enabled = get_env_flag('WRITE_BEHIND_SPOOL')
+    if spool_enabled:
+        from .spool_helpers import rds_circuit_breaker, spool_metadata
+    if spool_enabled and pending_metadata and not rds_circuit_breaker.allow_request():
+        logger.info("RDS circuit is open, spooling %s metadata records...", len(pending_metadata))
+        written_ids, failed_ids = [], [image_metadata['imageId'] for image_metadata in pending_metadata]
+    else:
+        started = time.perf_counter()
+        with stage_timer('RdsBatch'):
+            written_ids, failed_ids = write_batch_to_rds(pending_metadata, logger)
+        if spool_enabled and pending_metadata:
+            # a batch where nothing could be written means the database itself is failing
+            rds_circuit_breaker.record_result(bool(written_ids), (time.perf_counter() - started) * 1000, logger)
+
+    # spool the metadata that could not be written so the fetch and decode work is not lost, the replayer writes it later
+    if spool_enabled and failed_ids:
+        failed = set(failed_ids)
+        if spool_metadata(s3_client, [image_metadata for image_metadata in pending_metadata if image_metadata['imageId'] in failed], logger):
+            failed_ids = []
+    for image_id in failed_ids:
+        logger.error("Error writing metadata for file %s to RDS...", image_id)
+
+    # count the outcome of every record
+    put_metric('RecordsSucceeded', len(written_ids))
+    put_metric('RecordsSkipped', sum(1 for result in results if result == SKIPPED_RECORD))
+    put_metric('RecordsFailed', len(failed_ids) + sum(1 for result in results if result is None))
+    flush_metrics()
+
+    # remember the etags of the written objects so repeated notifications for them are skipped
+    written = set(written_ids)
+    for image_metadata in pending_metadata:
+        if image_metadata['imageId'] in written and image_metadata.get('etag'):
+            processed_etags.put(image_metadata['imageId'], image_metadata['etag'])
+
+    # when consuming from sqs report the messages with a failed record so only those are retried
+    if any(record.get('eventSource') == 'aws:sqs' for record in event['Records']):
+        failed_ids = set(failed_ids)
+        for (message_id, _), result in zip(s3_records, results):
+            failed = result is None or (isinstance(result, dict) and result['imageId'] in failed_ids)
+            if failed and message_id not in failed_message_ids:
+                failed_message_ids.append(message_id)
+        if failed_message_ids:
+            logger.error("%s messages failed and will be retried...", len(failed_message_ids))
+        return {
+            'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]
+        }
 
     return {
         'statusCode': 200,
         'body': 'Image metadata processing completed...'
     }
+
+
+# warm up when the module is loaded by the lambda runtime if WARMUP_ON_INIT is set
+if get_env_flag('WARMUP_ON_INIT'):
+    warmup(create_logger())
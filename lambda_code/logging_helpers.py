@@ -1,4 +1,30 @@
+import itertools
+import json
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+# log settings read from the environment when the logger is first created
+#   LOG_FORMAT=json writes every record as one compact json line with the correlation fields
+#   ASYNC_LOGGING=true hands records to a background thread so writing them never blocks a record
+#   LOG_INFO_SAMPLE_RATE=100 keeps 1 in 100 info and debug records, warnings and errors are always kept
+DEFAULT_LOG_INFO_SAMPLE_RATE = 1
+
+# correlation fields added to every record, the request id is set per invocation and the object key per thread
+log_context = threading.local()
+request_id = None
+
+# background listener writing the queued records, None when logging is synchronous
+log_queue = None
+log_listener = None
+# the handlers the root logger had before logging was configured and their formatters, restored by reset_logging
+original_handlers = None
+original_formatters = []
+added_filters = []
+
 
 # create logger using logging library
 def create_logger():
@@ -7,14 +33,153 @@ def create_logger():
     # capture log messages of info or higher
     logger.setLevel(logging.INFO)
 
-    # check to see if the logger has an associated handler 
+    # configure the json, sampled or asynchronous logging once per container
+    if original_handlers is None and (os.getenv('LOG_FORMAT') == 'json' or is_flag_set('ASYNC_LOGGING') or get_sample_rate() > 1):
+        configure_logging(logger)
+        return logger
+
+    # check to see if the logger has an associated handler
     if not logger.hasHandlers():
         # create a logger handler to output log messages to the console
         handler = logging.StreamHandler()
-        # create and set log message formatter 
+        # create and set log message formatter
         formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
         handler.setFormatter(formatter)
-        # attach the handler to the logger 
+        # attach the handler to the logger
         logger.addHandler(handler)
-    
-    return logger
\ No newline at end of file
+
+    return logger
+
+
+# read a boolean flag from the environment variables, utils is not imported here so logging stays import-light
+def is_flag_set(name):
+    return os.getenv(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# number of info and debug records per record kept, 1 keeps them all
+def get_sample_rate():
+    try:
+        return max(1, int(os.getenv('LOG_INFO_SAMPLE_RATE', DEFAULT_LOG_INFO_SAMPLE_RATE)))
+    except ValueError:
+        return DEFAULT_LOG_INFO_SAMPLE_RATE
+
+
+# set the id of the invocation being handled, added to every record as requestId
+def set_request_id(value):
+    global request_id
+    request_id = value
+
+
+# set the object key the current thread is working on, added to every record as objectKey
+def set_object_key(object_key):
+    log_context.object_key = object_key
+
+
+# add the correlation fields to a record, runs in the thread that logged it
+class CorrelationFilter(logging.Filter):
+
+    def filter(self, record):
+        record.request_id = request_id
+        record.object_key = getattr(log_context, 'object_key', None)
+        return True
+
+
+# keep 1 in sample_rate records below warning, warnings and errors are always kept
+# dropped records are never formatted
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, sample_rate):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.counter = itertools.count()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or self.sample_rate <= 1:
+            return True
+        return next(self.counter) % self.sample_rate == 0
+
+
+# format records as one compact json object per line
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            entry['requestId'] = record.request_id
+        if getattr(record, 'object_key', None):
+            entry['objectKey'] = record.object_key
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+# queue handler that leaves the formatting to the listener thread
+# the standard QueueHandler formats every record before queueing it, which is the cost this is meant to move off the record
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    # arguments that cannot change after the call are safe to format later, anything else is formatted now
+    IMMUTABLE_TYPES = (str, int, float, bool, type(None), BaseException)
+
+    def prepare(self, record):
+        if record.args and not (isinstance(record.args, tuple) and all(isinstance(arg, self.IMMUTABLE_TYPES) for arg in record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+# replace the root logger's handlers with the configured format, sampling and queue
+# the handlers already installed (the lambda runtime installs one) keep writing the records
+def configure_logging(logger):
+    global log_queue, log_listener, original_handlers
+    original_handlers = list(logger.handlers)
+    original_formatters[:] = [(handler, handler.formatter) for handler in original_handlers]
+    handlers = original_handlers or [logging.StreamHandler()]
+
+    if os.getenv('LOG_FORMAT') == 'json':
+        for handler in handlers:
+            handler.setFormatter(JsonFormatter())
+    elif not original_handlers:
+        handlers[0].setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    if is_flag_set('ASYNC_LOGGING'):
+        log_queue = queue.Queue()
+        log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        log_listener.start()
+        handlers = [DeferredQueueHandler(log_queue)]
+
+    # the filters run on the handlers that receive the records first, in the thread that logged them
+    for handler in handlers:
+        for log_filter in (CorrelationFilter(), SamplingFilter(get_sample_rate())):
+            handler.addFilter(log_filter)
+            added_filters.append((handler, log_filter))
+    logger.handlers = handlers
+
+
+# wait until every queued record is written, called before the handler returns since lambda freezes the container after
+def flush_logs():
+    if log_queue is not None:
+        log_queue.join()
+    for handler in logging.getLogger().handlers + (list(log_listener.handlers) if log_listener else []):
+        handler.flush()
+
+
+# stop the listener and restore the handlers the root logger had before logging was configured
+def reset_logging():
+    global log_queue, log_listener, original_handlers
+    if log_listener is not None:
+        log_listener.stop()
+    if original_handlers is not None:
+        logging.getLogger().handlers = original_handlers
+    for handler, formatter in original_formatters:
+        handler.setFormatter(formatter)
+    for handler, log_filter in added_filters:
+        handler.removeFilter(log_filter)
+    original_formatters.clear()
+    added_filters.clear()
+    log_queue = log_listener = original_handlers = None
+    set_request_id(None)
+    set_object_key(None)
@@ -0,0 +1,183 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+
+# cloudwatch namespace the metrics are published under
+DEFAULT_METRICS_NAMESPACE = 'PennEntertainment/ImageMetadata'
+# name of the logger the embedded metric format lines are written to
+METRICS_LOGGER_NAME = 'lambda_code.metrics'
+
+# upper bounds of the file size buckets used as a metric dimension
+SIZE_BUCKETS = [
+    (100 * 1024, '<100KB'),
+    (1024 * 1024, '100KB-1MB'),
+    (10 * 1024 * 1024, '1MB-10MB'),
+]
+
+# returned by stage_timer when metrics are off so timing a stage costs nothing
+NULL_TIMER = nullcontext()
+
+# metrics collected by the current thread, a stack so per record metrics can be collected inside an invocation
+metrics_state = threading.local()
+
+
+# metrics, dimensions and properties collected for one unit of work (a record or an invocation)
+class MetricsRecord:
+
+    def __init__(self, namespace, dimensions):
+        self.namespace = namespace
+        self.dimensions = dict(dimensions)
+        self.metrics = {}
+        self.properties = {}
+
+    # add a value to a metric, metrics reported more than once are emitted as a list of values
+    def put(self, name, value, unit):
+        if name in self.metrics:
+            self.metrics[name][0].append(value)
+        else:
+            self.metrics[name] = ([value], unit)
+
+    # build the cloudwatch embedded metric format document
+    def to_emf(self):
+        document = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in self.metrics.items()],
+                }],
+            },
+        }
+        document.update(self.properties)
+        document.update(self.dimensions)
+        for name, (values, _) in self.metrics.items():
+            document[name] = values[0] if len(values) == 1 else values
+        return document
+
+
+# times a stage and records the duration in milliseconds
+class StageTimer:
+
+    def __init__(self, record, stage):
+        self.record = record
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.record.put(f"{self.stage}Time", round((time.perf_counter() - self.started) * 1000, 3), 'Milliseconds')
+        return False
+
+
+# create the logger the metric lines are written to
+# the lines must be plain json for cloudwatch to extract the metrics, so the logger does not propagate to the app logger
+def get_metrics_logger():
+    logger = logging.getLogger(METRICS_LOGGER_NAME)
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+# return the metrics being collected by this thread, or None when metrics are off
+def current_metrics():
+    stack = getattr(metrics_state, 'stack', None)
+    return stack[-1] if stack else None
+
+
+# start collecting metrics for a unit of work in this thread, does nothing unless METRICS_ENABLED is set
+def start_metrics(**dimensions):
+    if os.getenv('METRICS_ENABLED', '').strip().lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    record = MetricsRecord(os.getenv('METRICS_NAMESPACE', DEFAULT_METRICS_NAMESPACE), dimensions)
+    if not hasattr(metrics_state, 'stack'):
+        metrics_state.stack = []
+    metrics_state.stack.append(record)
+    return record
+
+
+# record a metric value for the current unit of work
+def put_metric(name, value, unit='Count'):
+    record = current_metrics()
+    if record is not None:
+        record.put(name, value, unit)
+
+
+# set a dimension of the current unit of work
+def set_dimension(name, value):
+    record = current_metrics()
+    if record is not None:
+        record.dimensions[name] = str(value)
+
+
+# set a property of the current unit of work, properties are searchable in the logs but are not metrics
+def set_property(name, value):
+    record = current_metrics()
+    if record is not None:
+        record.properties[name] = value
+
+
+# return a context manager that times a stage of the current unit of work
+def stage_timer(stage):
+    record = current_metrics()
+    if record is None:
+        return NULL_TIMER
+    return StageTimer(record, stage)
+
+
+# emit the metrics of the current unit of work as an embedded metric format log line and stop collecting them
+def flush_metrics():
+    stack = getattr(metrics_state, 'stack', None)
+    if not stack:
+        return None
+    record = stack.pop()
+    if record.metrics:
+        get_metrics_logger().info(json.dumps(record.to_emf()))
+    return record
+
+
+# wrap a function that runs on a worker thread so the metrics it reports there are not lost
+# the metrics collected on a thread are only visible to that thread, so the wrapper collects them into a record of
+# their own and returns (result, record), pass the record to merge_metrics on the calling thread
+def collect_worker_metrics(func):
+    parent = current_metrics()
+    if parent is None:
+        return lambda *args: (func(*args), None)
+
+    def run(*args):
+        previous_stack = getattr(metrics_state, 'stack', None)
+        record = MetricsRecord(parent.namespace, {})
+        metrics_state.stack = [record]
+        try:
+            return func(*args), record
+        finally:
+            metrics_state.stack = previous_stack if previous_stack is not None else []
+    return run
+
+
+# add the metrics a worker thread collected to the current unit of work
+def merge_metrics(record):
+    current = current_metrics()
+    if current is None or record is None:
+        return
+    for name, (values, unit) in record.metrics.items():
+        for value in values:
+            current.put(name, value, unit)
+
+
+# bucket a file size in bytes for use as a metric dimension
+def get_size_bucket(file_size):
+    for upper_bound, label in SIZE_BUCKETS:
+        if file_size < upper_bound:
+            return label
+    return '>=10MB'
@@ -0,0 +1,264 @@
+import base64
+import json
+import os
+from datetime import date, datetime
+
+import pymysql
+
+from .db_helpers import METADATA_COLUMNS, connection_manager, is_connection_error, normalize_file_type, metadata_cache, map_shards
+from .metrics_helpers import put_metric
+from .shard_helpers import get_shard_ring
+
+# largest page a single query may return
+MAX_PAGE_SIZE = 1000
+
+# columns the storage stats can be grouped by, keyed by the names used in the returned dicts
+STATS_GROUP_COLUMNS = {
+    'prefix': 'image_prefix',
+    'fileType': 'file_type',
+    'day': 'day',
+}
+
+
+# encode the position after the last row of a page into an opaque cursor string
+def encode_cursor(time_stamp, image_id):
+    if isinstance(time_stamp, datetime):
+        time_stamp = time_stamp.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([time_stamp, image_id]).encode()).decode()
+
+
+# decode a cursor string back into the (timestamp, image_id) position it points after
+def decode_cursor(cursor):
+    time_stamp, image_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return time_stamp, image_id
+
+
+# convert a row of the image_metadata table into a metadata dict using the same keys as extract_metadata
+def row_to_metadata(row):
+    image_metadata = {key: value for (_, key), value in zip(METADATA_COLUMNS, row)}
+    if isinstance(image_metadata.get('timestamp'), datetime):
+        image_metadata['timestamp'] = image_metadata['timestamp'].isoformat()
+    if isinstance(image_metadata.get('renditions'), str):
+        image_metadata['renditions'] = json.loads(image_metadata['renditions'])
+    # mysql returns booleans as 0 and 1
+    if image_metadata.get('isValid') is not None:
+        image_metadata['isValid'] = bool(image_metadata['isValid'])
+    return image_metadata
+
+
+# list image metadata newest first, filtered by file type, time range and folder prefix
+# pages are read with keyset pagination on (timestamp, image_id), so a page costs the same no matter how deep it is
+# each filter combination is served by an index: (file_type, timestamp), (image_prefix(255), timestamp) or (timestamp)
+# returns the metadata of the page and the cursor of the next page, which is None on the last page
+def list_image_metadata(logger, file_type=None, start_time=None, end_time=None, prefix=None, limit=100, cursor=None, manager=None):
+    manager = manager or connection_manager
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    conditions, args = [], []
+    if file_type is not None:
+        conditions.append("file_type = %s")
+        args.append(normalize_file_type(file_type))
+    if prefix is not None:
+        # the folder part of the key, including the trailing slash
+        conditions.append("image_prefix = %s")
+        args.append(prefix)
+    if start_time is not None:
+        conditions.append("timestamp >= %s")
+        args.append(start_time)
+    if end_time is not None:
+        conditions.append("timestamp < %s")
+        args.append(end_time)
+    if cursor is not None:
+        # continue after the last row of the previous page
+        last_timestamp, last_image_id = decode_cursor(cursor)
+        conditions.append("(timestamp < %s OR (timestamp = %s AND image_id < %s))")
+        args.extend([last_timestamp, last_timestamp, last_image_id])
+
+    columns = ', '.join(column for column, _ in METADATA_COLUMNS)
+    sql = f"SELECT {columns} FROM image_metadata"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    # fetch one extra row to know whether there is a next page
+    sql += " ORDER BY timestamp DESC, image_id DESC LIMIT %s"
+    args.append(limit + 1)
+
+    try:
+        connection = manager.get_connection(logger)
+        if connection is None:
+            return [], None
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, tuple(args))
+            rows = db_cursor.fetchall()
+        # end the read so the next page sees fresh data
+        connection.commit()
+    except pymysql.MySQLError as e:
+        logger.error("Error listing image metadata: %s", e)
+        if is_connection_error(e):
+            manager.close()
+        return [], None
+
+    page = [row_to_metadata(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_cursor(page[-1]['timestamp'], page[-1]['imageId'])
+    return page, next_cursor
+
+
+# read storage stats from the image_metadata_rollup table instead of scanning image_metadata
+# prefix matches every folder starting with it, start_day and end_day bound the day buckets (end_day excluded)
+# returns a list of dicts with the group_by keys, imageCount, totalBytes and the dimension bounds, or None on error
+def get_storage_stats(logger, prefix=None, file_type=None, start_day=None, end_day=None, group_by=('prefix', 'fileType'), manager=None):
+    manager = manager or connection_manager
+    group_columns = [STATS_GROUP_COLUMNS[key] for key in group_by]
+
+    conditions, args = [], []
+    if prefix is not None:
+        conditions.append("image_prefix LIKE %s")
+        args.append(prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+    if file_type is not None:
+        conditions.append("file_type = %s")
+        args.append(normalize_file_type(file_type))
+    if start_day is not None:
+        conditions.append("day >= %s")
+        args.append(start_day)
+    if end_day is not None:
+        conditions.append("day < %s")
+        args.append(end_day)
+
+    columns = group_columns + ["SUM(image_count)", "SUM(total_bytes)", "MIN(min_width)", "MAX(max_width)", "MIN(min_height)", "MAX(max_height)"]
+    sql = f"SELECT {', '.join(columns)} FROM image_metadata_rollup"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    if group_columns:
+        sql += f" GROUP BY {', '.join(group_columns)} ORDER BY {', '.join(group_columns)}"
+
+    try:
+        connection = manager.get_connection(logger)
+        if connection is None:
+            return None
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(sql, tuple(args))
+            rows = db_cursor.fetchall()
+        connection.commit()
+    except pymysql.MySQLError as e:
+        logger.error("Error reading storage stats: %s", e)
+        if is_connection_error(e):
+            manager.close()
+        return None
+
+    stats = []
+    for row in rows:
+        entry = dict(zip(group_by, row))
+        if isinstance(entry.get('day'), date):
+            entry['day'] = entry['day'].isoformat()
+        # groups whose images were all replaced into other groups are left at zero
+        count, total_bytes, min_width, max_width, min_height, max_height = row[len(group_by):]
+        if not count:
+            continue
+        entry.update({
+            'imageCount': int(count),
+            'totalBytes': int(total_bytes or 0),
+            'minWidth': min_width,
+            'maxWidth': max_width,
+            'minHeight': min_height,
+            'maxHeight': max_height,
+        })
+        stats.append(entry)
+    return stats
+
+
+# read the metadata of a list of image ids from rds with batched IN queries, routed to their shards when sharding is on
+# returns a dict of image id to metadata, images that are not in the table are left out, None if the read failed
+def read_metadata_by_ids(image_ids, logger, manager=None):
+    ring = get_shard_ring()
+    if manager is None and ring is not None:
+        results = map_shards(ring.group_by_node(image_ids), lambda shard_ids, shard_manager: read_metadata_by_ids(shard_ids, logger, shard_manager))
+        if any(shard_metadata is None for shard_metadata in results.values()):
+            return None
+        return {image_id: image_metadata for shard_metadata in results.values() for image_id, image_metadata in shard_metadata.items()}
+
+    manager = manager or connection_manager
+    columns = ', '.join(column for column, _ in METADATA_COLUMNS)
+    found = {}
+    try:
+        connection = manager.get_connection(logger)
+        if connection is None:
+            return None
+        with connection.cursor() as db_cursor:
+            for start in range(0, len(image_ids), MAX_PAGE_SIZE):
+                chunk = image_ids[start:start + MAX_PAGE_SIZE]
+                placeholders = ', '.join(['%s'] * len(chunk))
+                db_cursor.execute(f"SELECT {columns} FROM image_metadata WHERE image_id IN ({placeholders})", tuple(chunk))
+                for row in db_cursor.fetchall():
+                    image_metadata = row_to_metadata(row)
+                    found[image_metadata['imageId']] = image_metadata
+        # end the read so the next lookup sees fresh data
+        connection.commit()
+    except pymysql.MySQLError as e:
+        logger.error("Error reading image metadata: %s", e)
+        if is_connection_error(e):
+            manager.close()
+        return None
+    return found
+
+
+# fetch an image from s3 and extract its metadata like the handler does, without writing it to rds
+def extract_metadata_from_s3(s3_client, bucket_name, image_id, logger):
+    from .s3_helpers import fetch_file_contents
+    from .utils import extract_metadata
+    s3_response, s3_file_contents = fetch_file_contents(s3_client, bucket_name, image_id, logger)
+    if s3_response is None or s3_file_contents is None:
+        return None
+    try:
+        image_metadata = extract_metadata(s3_response, s3_file_contents, image_id, logger)
+    finally:
+        # large objects are memory mapped from /tmp
+        if hasattr(s3_file_contents, 'close'):
+            s3_file_contents.close()
+    if image_metadata is not None:
+        image_metadata['fileType'] = normalize_file_type(image_metadata['fileType'])
+    return image_metadata
+
+
+# look up the metadata of a list of images, the in-process cache first, then one batched query for the rest
+# with extract_missing the images that are not in rds either are fetched from s3 and extracted, which is expensive
+# returns a dict of image id to metadata, images that could not be found are left out
+def get_many(image_ids, logger, extract_missing=False, s3_client=None, bucket_name=None, manager=None):
+    found, missing = {}, []
+    for image_id in dict.fromkeys(image_ids):
+        cached = metadata_cache.get(image_id)
+        if cached is not None:
+            found[image_id] = dict(cached)
+        else:
+            missing.append(image_id)
+    put_metric('MetadataCacheHits', len(found))
+    put_metric('MetadataCacheMisses', len(missing))
+
+    if missing:
+        stored = read_metadata_by_ids(missing, logger, manager) or {}
+        for image_id, image_metadata in stored.items():
+            metadata_cache.put(image_id, image_metadata)
+            found[image_id] = dict(image_metadata)
+        missing = [image_id for image_id in missing if image_id not in stored]
+
+    if missing and extract_missing:
+        import boto3
+        s3_client = s3_client or boto3.client('s3')
+        bucket_name = bucket_name or os.getenv('BUCKET_NAME')
+        for image_id in missing:
+            image_metadata = extract_metadata_from_s3(s3_client, bucket_name, image_id, logger)
+            if image_metadata is not None:
+                metadata_cache.put(image_id, image_metadata)
+                found[image_id] = dict(image_metadata)
+    return found
+
+
+# look up the metadata of one image, see get_many
+# returns the metadata dict, or None if the image could not be found
+def get_metadata(image_id, logger, extract_missing=False, s3_client=None, bucket_name=None, manager=None):
+    return get_many([image_id], logger, extract_missing, s3_client, bucket_name, manager).get(image_id)
+
+
+# return the hit, miss, expiry and eviction counters of the metadata cache with its hit rate
+def get_metadata_cache_stats():
+    return metadata_cache.get_stats()
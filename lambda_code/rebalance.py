@@ -0,0 +1,139 @@
+# move the image metadata rows whose shard changed after shards were added to or removed from SHARD_SECRET_NAMES
+#
+# usage:
+#   SHARD_SECRET_NAMES=<secret-a>,<secret-b>,<secret-c> python -m lambda_code.rebalance
+#   python -m lambda_code.rebalance --shards <secret-a>,<secret-b> --source <removed-secret> --dry-run
+#
+# deploy the new SHARD_SECRET_NAMES first so new writes already go to the new owners, then run the rebalance
+# every shard is scanned in image_id order, only the rows that hash to another shard on the new ring are copied to it
+# and deleted from the shard they were found on, which is about 1/N of the rows when a shard is added to N-1
+# rows already on the target were written there after the deploy and are newer, so they are kept and the old copy is
+# only deleted, which also makes running the rebalance again after an interruption safe
+# the rollups are not moved with the rows, run python -m lambda_code.schema --rebuild-rollups on every shard afterwards
+import argparse
+import sys
+
+import pymysql
+
+from .db_helpers import METADATA_COLUMNS, get_shard_manager, write_batch_to_rds
+from .logging_helpers import create_logger
+from .query_helpers import row_to_metadata
+from .shard_helpers import HashRing, get_shard_names
+
+# image ids read from a shard per page
+DEFAULT_REBALANCE_PAGE_SIZE = 1000
+
+
+# read the next page of image ids of a shard after the last id of the previous page
+def read_image_id_page(connection, last_image_id, page_size):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT image_id FROM image_metadata WHERE image_id > %s ORDER BY image_id LIMIT %s", (last_image_id, page_size))
+        rows = cursor.fetchall()
+    connection.commit()
+    return [row[0] for row in rows]
+
+
+# read the full rows of a list of image ids as metadata dicts
+def read_metadata(connection, image_ids):
+    columns = ', '.join(column for column, _ in METADATA_COLUMNS)
+    placeholders = ', '.join(['%s'] * len(image_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {columns} FROM image_metadata WHERE image_id IN ({placeholders})", tuple(image_ids))
+        rows = cursor.fetchall()
+    connection.commit()
+    return [row_to_metadata(row) for row in rows]
+
+
+# return the image ids of the list that are already stored in a shard
+def read_existing_ids(connection, image_ids):
+    placeholders = ', '.join(['%s'] * len(image_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT image_id FROM image_metadata WHERE image_id IN ({placeholders})", tuple(image_ids))
+        rows = cursor.fetchall()
+    connection.commit()
+    return {row[0] for row in rows}
+
+
+def delete_image_ids(connection, image_ids):
+    placeholders = ', '.join(['%s'] * len(image_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM image_metadata WHERE image_id IN ({placeholders})", tuple(image_ids))
+    connection.commit()
+
+
+# move the rows of the scanned shards that the ring of the new shards assigns to another shard
+# sources are shards being removed, they are scanned too but no longer own any keys
+# returns a dict with the rows scanned, moved, already on their target and failed
+def rebalance(shards, logger, sources=(), page_size=DEFAULT_REBALANCE_PAGE_SIZE, dry_run=False):
+    ring = HashRing(shards)
+    totals = {'scanned': 0, 'moved': 0, 'already_moved': 0, 'failed': 0}
+    for source in list(shards) + [source for source in sources if source not in shards]:
+        source_manager = get_shard_manager(source)
+        last_image_id = ''
+        try:
+            source_connection = source_manager.get_connection(logger)
+            if source_connection is None:
+                logger.error("Could not connect to shard %s to rebalance it...", source)
+                return totals
+            while True:
+                image_ids = read_image_id_page(source_connection, last_image_id, page_size)
+                if not image_ids:
+                    break
+                last_image_id = image_ids[-1]
+                totals['scanned'] += len(image_ids)
+
+                # only the keys whose owner changed move, the ring keeps every other key on the shard it is on
+                moves = ring.group_by_node([image_id for image_id in image_ids if ring.get_node(image_id) != source])
+                for target, target_ids in moves.items():
+                    if dry_run:
+                        totals['moved'] += len(target_ids)
+                        continue
+                    target_manager = get_shard_manager(target)
+                    target_connection = target_manager.get_connection(logger)
+                    if target_connection is None:
+                        logger.error("Could not connect to shard %s to move %s rows to it...", target, len(target_ids))
+                        totals['failed'] += len(target_ids)
+                        continue
+                    existing = read_existing_ids(target_connection, target_ids)
+                    to_copy = read_metadata(source_connection, [image_id for image_id in target_ids if image_id not in existing])
+                    written_ids, failed_ids = write_batch_to_rds(to_copy, logger, batch_size=page_size, manager=target_manager)
+                    # the source copy is only deleted once the target holds the row
+                    done = written_ids + sorted(existing)
+                    if done:
+                        delete_image_ids(source_connection, done)
+                    totals['moved'] += len(written_ids)
+                    totals['already_moved'] += len(existing)
+                    totals['failed'] += len(failed_ids)
+                logger.info("Rebalancing shard %s... %s", source, totals)
+        except pymysql.MySQLError as e:
+            logger.error("Error rebalancing shard %s after %s: %s", source, last_image_id, e)
+            source_manager.close()
+            totals['failed'] += 1
+            return totals
+
+    logger.info("Rebalance %s... %s", 'planned' if dry_run else 'complete', totals)
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Move the image metadata rows whose shard changed to the shard that owns them")
+    parser.add_argument('--shards', default=None, help="comma separated shard secrets of the new ring, defaults to SHARD_SECRET_NAMES")
+    parser.add_argument('--source', action='append', default=[], help="shard being removed, its rows are moved to the new ring")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_REBALANCE_PAGE_SIZE, help="image ids read from a shard per page")
+    parser.add_argument('--dry-run', action='store_true', help="count the rows that would move without moving them")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logger = create_logger()
+    shards = [name.strip() for name in args.shards.split(',') if name.strip()] if args.shards else get_shard_names()
+    if not shards:
+        logger.error("No shards configured, pass --shards or set SHARD_SECRET_NAMES...")
+        return 1
+    totals = rebalance(shards, logger, sources=args.source, page_size=args.page_size, dry_run=args.dry_run)
+    return 0 if totals['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import io
+import os
+
+from .metrics_helpers import stage_timer, put_metric
+from .utils import PILLOW_FORMATS, is_within_pixel_limit, load_pillow
+
+# renditions written next to the metadata, set with RENDITIONS as a comma separated list of
+# name:<width>x<height>:<format>:<quality>, e.g. "thumbnail:256x256:WEBP:80,preview:1024x1024:JPEG:85"
+# every rendition fits within its size, keeps the aspect ratio and is never larger than the original
+# no renditions are written when RENDITIONS is not set
+# renditions are written to <RENDITION_PREFIX><name>/<object key> in RENDITION_BUCKET, or the bucket of the original
+DEFAULT_RENDITION_PREFIX = 'renditions/'
+DEFAULT_RENDITION_QUALITY = 85
+
+# content type and file extension of the formats renditions can be written in
+RENDITION_FORMATS = {
+    'JPEG': ('image/jpeg', 'jpg'),
+    'WEBP': ('image/webp', 'webp'),
+    'PNG': ('image/png', 'png'),
+}
+
+
+# parse the RENDITIONS setting into a list of dicts, largest rendition first
+# raises ValueError on a malformed setting
+def parse_renditions(setting):
+    renditions = []
+    for entry in filter(None, (entry.strip() for entry in (setting or '').split(','))):
+        parts = entry.split(':')
+        name, size = parts[0], parts[1]
+        image_format = parts[2].upper() if len(parts) > 2 else 'JPEG'
+        if image_format not in RENDITION_FORMATS:
+            raise ValueError(f"Unsupported rendition format {image_format}")
+        width, height = (int(value) for value in size.lower().split('x'))
+        quality = int(parts[3]) if len(parts) > 3 else DEFAULT_RENDITION_QUALITY
+        renditions.append({'name': name, 'size': (width, height), 'format': image_format, 'quality': quality})
+    return sorted(renditions, key=lambda rendition: rendition['size'][0] * rendition['size'][1], reverse=True)
+
+
+# return the renditions configured in the environment, an empty list turns them off
+def get_renditions(logger):
+    try:
+        return parse_renditions(os.getenv('RENDITIONS'))
+    except (ValueError, IndexError) as e:
+        logger.error("Invalid RENDITIONS setting, no renditions are written: %s...", e)
+        return []
+
+
+# open the image once for the metadata, the perceptual hash and the renditions
+# the dimensions are read from the header, then the decoder is told the largest size that is needed so jpeg files are
+# decoded at a reduced scale by draft(), the image is only decoded when the hash or a rendition first needs its pixels
+# returns the image and its original dimensions, or None values if it could not be opened or is too large
+def open_rendition_source(s3_file_contents, renditions, logger):
+    try:
+        with stage_timer('ImageDecode'):
+            source = io.BytesIO(s3_file_contents) if isinstance(s3_file_contents, bytes) else s3_file_contents
+            image = load_pillow().open(source, formats=PILLOW_FORMATS)
+            width, height = image.size
+        if not is_within_pixel_limit(width, height, logger):
+            return None, None
+        largest = max(rendition['size'][0] for rendition in renditions), max(rendition['size'][1] for rendition in renditions)
+        image.draft('RGB', largest)
+        return image, (width, height)
+    except Exception as e:
+        logger.error("Error opening image for renditions: %s...", e)
+        return None, None
+
+
+# return the size that fits within the box and keeps the aspect ratio, never larger than the image
+def fit_within(image_size, box):
+    scale = min(box[0] / image_size[0], box[1] / image_size[1], 1.0)
+    return max(1, round(image_size[0] * scale)), max(1, round(image_size[1] * scale))
+
+
+# build the key a rendition is written to, the original key under the rendition's folder with the rendition's extension
+def get_rendition_key(object_key, rendition, prefix):
+    base_key = object_key.rsplit('.', 1)[0] if '.' in object_key.split('/')[-1] else object_key
+    return f"{prefix}{rendition['name']}/{base_key}.{RENDITION_FORMATS[rendition['format']][1]}"
+
+
+# scale the image down to a rendition and encode it
+# resize with reducing_gap shrinks by whole factors with reduce() first, which is much cheaper than resampling at full size
+def encode_rendition(image, rendition):
+    Image = load_pillow()
+    target_size = fit_within(image.size, rendition['size'])
+    resized = image.resize(target_size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    # jpeg has no alpha channel, the other formats keep it
+    if rendition['format'] == 'JPEG' and resized.mode != 'RGB':
+        resized = resized.convert('RGB')
+    buffer = io.BytesIO()
+    resized.save(buffer, format=rendition['format'], quality=rendition['quality'])
+    return buffer.getvalue(), resized.size
+
+
+# write every rendition of an opened image to s3
+# returns a list of dicts with the name, key, width and height of every rendition written, or None if they failed
+# a failed rendition does not fail the record, like a failed perceptual hash
+def create_renditions(s3_client, bucket_name, object_key, image, renditions, logger):
+    bucket_name = os.getenv('RENDITION_BUCKET') or bucket_name
+    prefix = os.getenv('RENDITION_PREFIX', DEFAULT_RENDITION_PREFIX)
+    try:
+        with stage_timer('Renditions'):
+            # palette and other modes are converted once instead of for every rendition, resizing them would use nearest neighbour
+            if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                image = image.convert('RGBA' if 'transparency' in image.info or image.mode.endswith('A') else 'RGB')
+            written = []
+            for rendition in renditions:
+                body, (width, height) = encode_rendition(image, rendition)
+                rendition_key = get_rendition_key(object_key, rendition, prefix)
+                s3_client.put_object(Bucket=bucket_name, Key=rendition_key, Body=body, ContentType=RENDITION_FORMATS[rendition['format']][0])
+                written.append({'name': rendition['name'], 'key': rendition_key, 'width': width, 'height': height})
+        logger.info("Wrote %s renditions of %s...", len(written), object_key)
+        put_metric('RenditionsWritten', len(written))
+        return written
+    except Exception as e:
+        logger.error("Error writing renditions of %s: %s...", object_key, e)
+        return None
@@ -1,20 +1,229 @@
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import tempfile
+
+from .metrics_helpers import put_metric, stage_timer
+from .utils import INCOMPLETE_HEADER, get_env_int, parse_image_header
+
+# number of leading bytes requested by the first ranged get when probing the image header
+PROBE_INITIAL_BYTES = 16 * 1024
+# largest range the header probe will widen to before falling back to a full fetch
+PROBE_MAX_BYTES = 1024 * 1024
+# factor the range is multiplied by each time the header is incomplete
+PROBE_GROWTH_FACTOR = 4
+
+# objects larger than this are downloaded in parallel parts to a memory mapped file in /tmp instead of into memory
+LARGE_OBJECT_THRESHOLD_BYTES = 32 * 1024 * 1024
+# size of each ranged part of a large object download
+LARGE_OBJECT_PART_BYTES = 8 * 1024 * 1024
+# number of parts downloaded at the same time
+LARGE_OBJECT_WORKERS = 4
+# objects larger than this are rejected, the default /tmp of a lambda holds 512 MB
+MAX_OBJECT_BYTES = 400 * 1024 * 1024
+# size of the reads used to copy a part into the mapped file
+STREAM_CHUNK_BYTES = 1024 * 1024
+
 
 # fetch file contents from S3
-def fetch_file_contents(s3_client, bucket_name, object_key, logger):
+# retry fetches the object again once when it was replaced while a large object was downloading in parts
+def fetch_file_contents(s3_client, bucket_name, object_key, logger, retry=True):
     try:
-        logger.info(f"Fetching file contents from {bucket_name}/{object_key}...")
-        # fetch the file from s3 and assign the request response to s3_response variable
-        s3_response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-        # extract the file contents from the s3_response 
-        s3_file_contents = s3_response['Body'].read()
-        logger.info(f"File {object_key} read successfully from {bucket_name}... Size: {len(s3_file_contents)} bytes...")
+        logger.info("Fetching file contents from %s/%s...", bucket_name, object_key)
+        with stage_timer('S3Fetch'):
+            # fetch the file from s3 and assign the request response to s3_response variable
+            s3_response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
+
+            # check the size before reading the body so large objects never have to fit in memory
+            content_length = s3_response.get('ContentLength') or 0
+            if content_length > get_env_int('MAX_OBJECT_BYTES', MAX_OBJECT_BYTES):
+                s3_response['Body'].close()
+                logger.error("Skipping file %s... Size %s bytes is over the limit...", object_key, content_length)
+                return None, None
+            if content_length > get_env_int('LARGE_OBJECT_THRESHOLD_BYTES', LARGE_OBJECT_THRESHOLD_BYTES):
+                # stop the single stream and download the object in parallel parts instead
+                s3_response['Body'].close()
+                s3_file_contents = download_to_mapped_file(s3_client, bucket_name, object_key, content_length, logger,
+                    etag=s3_response.get('ETag'), version_id=s3_response.get('VersionId'))
+            else:
+                # extract the file contents from the s3_response 
+                s3_file_contents = s3_response['Body'].read()
+        put_metric('BytesRead', len(s3_file_contents), 'Bytes')
+        logger.info("File %s read successfully from %s... Size: %s bytes...", object_key, bucket_name, len(s3_file_contents))
         return s3_response, s3_file_contents
     except ClientError as e:
         # check to see if the error was due to lack of permissions
         if e.response['Error']['Code'] == 'AccessDenied':
-            logger.error(f"Access denied for {object_key} in {bucket_name}...")
+            logger.error("Access denied for %s in %s...", object_key, bucket_name)
             return None, None
+        # the parts are pinned to the object that was first read, a newer upload in between fails them
+        elif e.response['Error']['Code'] in ('PreconditionFailed', '412') and retry:
+            logger.info("File %s changed while it was downloading, fetching it again...", object_key)
+            return fetch_file_contents(s3_client, bucket_name, object_key, logger, retry=False)
         else:
-            logger.error(f"Error fetching file {object_key} from {bucket_name}: {e}...")
-            return None, None
\ No newline at end of file
+            logger.error("Error fetching file %s from %s: %s...", object_key, bucket_name, e)
+            return None, None
+
+
+# get the full object size from a ranged get response, the ContentRange header looks like "bytes 0-16383/5242880"
+def get_total_object_size(s3_response, bytes_read):
+    content_range = s3_response.get('ContentRange')
+    if content_range and '/' in content_range:
+        total_size = content_range.rsplit('/', 1)[1]
+        if total_size.isdigit():
+            return int(total_size)
+    # without a content range s3 returned the whole object
+    return bytes_read
+
+
+# return the get_object arguments that pin a read to one object, its version on a versioned bucket or its etag otherwise
+# s3 answers 412 PreconditionFailed when the object no longer has the etag
+def get_object_pin(etag=None, version_id=None):
+    return {'VersionId': version_id} if version_id else {'IfMatch': etag} if etag else {}
+
+
+# fetch only the leading bytes of a file from S3 and parse the width and height from the image header
+# the range is widened step by step when the dimensions sit further into the file (e.g. a late jpeg SOF marker), every
+# step only requests the bytes after the ones already read and is pinned to the object the first step read
+# returns the s3 response with ContentLength set to the full object size plus the width and height,
+# or None values when the header could not be parsed and the caller should fall back to a full fetch
+def probe_image_size(s3_client, bucket_name, object_key, logger):
+    range_end = get_env_int('PROBE_INITIAL_BYTES', PROBE_INITIAL_BYTES)
+    max_bytes = get_env_int('PROBE_MAX_BYTES', PROBE_MAX_BYTES)
+    header = b''
+    pin = {}
+    try:
+        while True:
+            logger.info("Probing image header of %s/%s with the first %s bytes...", bucket_name, object_key, range_end)
+            with stage_timer('HeaderProbe'):
+                # only request the bytes of the range that were not read yet
+                s3_response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=f"bytes={len(header)}-{range_end - 1}", **pin)
+                chunk = s3_response['Body'].read()
+            put_metric('BytesRead', len(chunk), 'Bytes')
+            header += chunk
+            total_size = get_total_object_size(s3_response, len(header))
+            if not pin:
+                pin = get_object_pin(s3_response.get('ETag'), s3_response.get('VersionId'))
+
+            result = parse_image_header(header)
+            # the format is not supported by the header parsers
+            if result is None:
+                logger.info("Header of %s could not be parsed... Falling back to a full fetch...", object_key)
+                return None, None, None
+
+            if result != INCOMPLETE_HEADER:
+                width, height = result
+                logger.info("Image height: %s and width: %s read from the first %s bytes of %s...", height, width, len(header), object_key)
+                # report the size of the whole object rather than the size of the range
+                return dict(s3_response, ContentLength=total_size), width, height
+
+            # stop widening once the whole file or the maximum range has been read
+            if len(header) >= total_size or range_end >= max_bytes:
+                logger.info("Dimensions of %s not found in the first %s bytes... Falling back to a full fetch...", object_key, len(header))
+                return None, None, None
+            range_end = min(range_end * PROBE_GROWTH_FACTOR, max_bytes)
+    # the probe is only a shortcut, any failure (an empty object cannot satisfy a range request, the object changed
+    # between two steps, a dropped stream) is left to the full fetch
+    except Exception as e:
+        logger.error("Error probing image header of %s from %s: %s...", object_key, bucket_name, e)
+        return None, None, None
+
+
+# download one byte range of an object straight into the mapped file
+# the part is pinned to the object given so every part comes from the same object even when it is overwritten during
+# the download
+def download_part(s3_client, bucket_name, object_key, mapped_file, start, end, etag=None, version_id=None):
+    s3_response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=f"bytes={start}-{end - 1}", **get_object_pin(etag, version_id))
+    body = s3_response['Body']
+    position = start
+    # copy the part in chunks so only one chunk per part is held in memory
+    while position < end:
+        chunk = body.read(min(STREAM_CHUNK_BYTES, end - position))
+        if not chunk:
+            raise IOError(f"Part {start}-{end - 1} of {object_key} ended early at byte {position}")
+        mapped_file[position:position + len(chunk)] = chunk
+        position += len(chunk)
+
+
+# download a large object in parallel ranged parts into a memory mapped temporary file under /tmp
+# returns the mmap, which pillow and the header parsers can read like a file without copying it into memory
+# the temporary file is deleted as soon as it is created, closing the mmap releases the disk space
+# etag and version_id are those of the response the size was read from, the parts are pinned to that object
+def download_to_mapped_file(s3_client, bucket_name, object_key, content_length, logger, etag=None, version_id=None):
+    part_size = get_env_int('LARGE_OBJECT_PART_BYTES', LARGE_OBJECT_PART_BYTES)
+    workers = get_env_int('LARGE_OBJECT_WORKERS', LARGE_OBJECT_WORKERS)
+    logger.info("Downloading %s (%s bytes) in %s byte parts to /tmp...", object_key, content_length, part_size)
+
+    with tempfile.TemporaryFile(dir=tempfile.gettempdir()) as temp_file:
+        # size the file up front so every part can be written to its own region of the mapping
+        temp_file.truncate(content_length)
+        # the mapping keeps its own handle on the file, so the file object can be closed here
+        mapped_file = mmap.mmap(temp_file.fileno(), content_length)
+
+    try:
+        ranges = [(start, min(start + part_size, content_length)) for start in range(0, content_length, part_size)]
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ranges)))) as executor:
+            # list() re-raises the first error of any part
+            list(executor.map(lambda part: download_part(s3_client, bucket_name, object_key, mapped_file, *part, etag=etag, version_id=version_id), ranges))
+    except Exception:
+        mapped_file.close()
+        raise
+    return mapped_file
+
+
+# write-only file object that streams what is written to an s3 object with a multipart upload
+# at most one part is held in memory, so objects of any size are written in constant memory
+# the upload is only completed by close(), abort() discards the parts already uploaded
+class MultipartUploadWriter:
+
+    # s3 rejects parts smaller than 5 MB except the last one
+    MIN_PART_BYTES = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket_name, object_key, part_size=LARGE_OBJECT_PART_BYTES, content_type='application/octet-stream'):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.object_key = object_key
+        self.part_size = max(part_size, self.MIN_PART_BYTES)
+        self.buffer = bytearray()
+        self.parts = []
+        self.bytes_written = 0
+        self.closed = False
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket_name, Key=object_key, ContentType=content_type)['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= self.part_size:
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def upload_part(self, body):
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+
+    # upload the rest of the buffer as the last part and complete the upload
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer or not self.parts:
+            self.upload_part(bytes(self.buffer))
+            self.buffer.clear()
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+        self.closed = True
+
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket_name, Key=self.object_key, UploadId=self.upload_id)
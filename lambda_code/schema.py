@@ -0,0 +1,240 @@
+# schema management for the image metadata database
+#
+# usage:
+#   RDS_SECRET_NAME=<secret> python -m lambda_code.schema
+#   RDS_SECRET_NAME=<secret> python -m lambda_code.schema --rebuild-rollups
+#
+# migrations are applied in order and recorded in the schema_migrations table, so running this again is a no-op
+# ddl commits implicitly in mysql, so a migration that fails half way cannot be rolled back, every step is either safe
+# to run again or guarded by an information_schema check so the migration can simply be run again
+import sys
+
+import pymysql
+
+from .db_helpers import FILE_TYPES, connection_manager, rollback
+from .logging_helpers import create_logger
+
+# table recording which migrations were applied
+CREATE_MIGRATIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INT UNSIGNED NOT NULL PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6)
+) ENGINE=InnoDB
+"""
+
+# the table as the lambda wrote to it before migrations were added, databases set up by hand already have it and
+# this is a no-op on them, so every later change has to be an ALTER that runs on both
+CREATE_IMAGE_METADATA_SQL = """
+CREATE TABLE IF NOT EXISTS image_metadata (
+    image_id VARCHAR(255) NOT NULL,
+    file_name VARCHAR(255) NOT NULL,
+    file_size INT NOT NULL,
+    file_type VARCHAR(255) NOT NULL,
+    width INT NOT NULL,
+    height INT NOT NULL,
+    timestamp VARCHAR(32) NOT NULL,
+    PRIMARY KEY (image_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+"""
+
+# content types stored before the enum are mapped onto it the same way normalize_file_type does
+NORMALIZE_FILE_TYPES_SQL = f"""
+UPDATE image_metadata
+SET file_type = IF(LOWER(TRIM(SUBSTRING_INDEX(file_type, ';', 1))) IN ({', '.join(f"'{file_type}'" for file_type in FILE_TYPES)}),
+                   LOWER(TRIM(SUBSTRING_INDEX(file_type, ';', 1))), 'other')
+"""
+
+# image_id holds the s3 object key, 768 utf8mb4 characters is the longest key innodb can index (3072 bytes)
+# image_prefix is derived from image_id and holds the folder part of the key, e.g. "images/2024/"
+# image_prefix is indexed on its first 255 characters to stay under the same limit, rows sharing those are told
+# apart by the comparison on the full column
+# the timestamps were stored as iso strings, mysql parses them into the DATETIME(6) column as they are
+# note on partitioning: mysql requires the partitioning column in every unique key, so range partitioning by month
+# would need (image_id, timestamp) as primary key and break the overwrite on re-upload done by the upsert on image_id
+NATIVE_TYPES_SQL = f"""
+ALTER TABLE image_metadata
+    MODIFY image_id VARCHAR(768) NOT NULL,
+    MODIFY file_name VARCHAR(768) NOT NULL,
+    MODIFY file_size BIGINT UNSIGNED NOT NULL,
+    MODIFY file_type ENUM({', '.join(f"'{file_type}'" for file_type in FILE_TYPES)}) NOT NULL,
+    MODIFY width INT UNSIGNED NOT NULL,
+    MODIFY height INT UNSIGNED NOT NULL,
+    MODIFY timestamp DATETIME(6) NOT NULL
+"""
+IMAGE_PREFIX_DEFINITION = (
+    "VARCHAR(768) GENERATED ALWAYS AS "
+    "(SUBSTRING(image_id, 1, CHAR_LENGTH(image_id) - CHAR_LENGTH(SUBSTRING_INDEX(image_id, '/', -1)))) STORED"
+)
+
+# storage stats per folder, file type and day, kept up to date by the write path when MAINTAIN_ROLLUPS is set
+# the counts are signed so a delta that subtracts a replaced image can never underflow in the middle of a statement
+# the dimension bounds only ever widen, rebuild_rollups recomputes them exactly
+# a key on the full image_prefix would be longer than the 3072 bytes innodb allows, so the groups are keyed on its md5
+# which mysql fills in from the image_prefix the writes and the backfill insert
+CREATE_IMAGE_METADATA_ROLLUP_SQL = f"""
+CREATE TABLE IF NOT EXISTS image_metadata_rollup (
+    image_prefix VARCHAR(768) NOT NULL,
+    prefix_hash BINARY(16) GENERATED ALWAYS AS (UNHEX(MD5(image_prefix))) STORED NOT NULL,
+    file_type ENUM({', '.join(f"'{file_type}'" for file_type in FILE_TYPES)}) NOT NULL,
+    day DATE NOT NULL,
+    image_count BIGINT NOT NULL,
+    total_bytes BIGINT NOT NULL,
+    min_width INT UNSIGNED NULL,
+    max_width INT UNSIGNED NULL,
+    min_height INT UNSIGNED NULL,
+    max_height INT UNSIGNED NULL,
+    PRIMARY KEY (prefix_hash, file_type, day),
+    KEY idx_image_prefix_day (image_prefix(255), day),
+    KEY idx_day (day)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_bin
+"""
+
+# fill the rollups from the rows already in image_metadata
+BACKFILL_IMAGE_METADATA_ROLLUP_SQL = """
+INSERT INTO image_metadata_rollup (image_prefix, file_type, day, image_count, total_bytes, min_width, max_width, min_height, max_height)
+SELECT image_prefix, file_type, DATE(timestamp), COUNT(*), SUM(file_size), MIN(width), MAX(width), MIN(height), MAX(height)
+FROM image_metadata
+GROUP BY image_prefix, file_type, DATE(timestamp)
+"""
+
+# guards of the migration steps, a step is skipped when its guard counts a row
+COLUMN_EXISTS_SQL = "SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s"
+KEY_EXISTS_SQL = "SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s"
+TABLE_COLLATION_SQL = "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND TABLE_COLLATION = %s"
+
+
+# migration step adding a column, skipped when a previous run already added it
+def add_column(table, column, definition):
+    return COLUMN_EXISTS_SQL, (table, column), f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+
+
+# migration step adding a key, skipped when a previous run already added it
+def add_key(table, key, columns):
+    return KEY_EXISTS_SQL, (table, key), f"ALTER TABLE {table} ADD KEY {key} ({columns})"
+
+
+# ordered list of (version, description, steps), append new migrations to the end and never change what an applied
+# one does, every step is a statement that is safe to run again or a (guard sql, guard args, statement) tuple
+# one ddl change per step, so a migration that failed half way skips the changes it already made when it is run again
+MIGRATIONS = [
+    (1, 'create image_metadata', [CREATE_IMAGE_METADATA_SQL]),
+    # keys and dimensions of the renditions written next to the metadata, see rendition_helpers
+    (2, 'add renditions to image_metadata', [add_column('image_metadata', 'renditions', 'JSON NULL')]),
+    # identity of the stored object version, used to skip notifications for objects that were already processed
+    (3, 'add object identity to image_metadata', [
+        add_column('image_metadata', 'etag', 'VARCHAR(64) NULL'),
+        add_column('image_metadata', 'version_id', 'VARCHAR(255) NULL'),
+        add_column('image_metadata', 'sequencer', 'VARCHAR(64) NULL'),
+    ]),
+    # 64 bit perceptual hash, see similarity
+    (4, 'add perceptual hash to image_metadata', [add_column('image_metadata', 'phash', 'BIGINT UNSIGNED NULL')]),
+    # the normalization and the type changes give the same result when they run again
+    (5, 'use native types and add indexes to image_metadata', [
+        NORMALIZE_FILE_TYPES_SQL,
+        # binary collation so keys that differ only in case or accents are different images, like in s3
+        (TABLE_COLLATION_SQL, ('image_metadata', 'utf8mb4_bin'), "ALTER TABLE image_metadata CONVERT TO CHARACTER SET utf8mb4 COLLATE utf8mb4_bin"),
+        NATIVE_TYPES_SQL,
+        add_column('image_metadata', 'image_prefix', IMAGE_PREFIX_DEFINITION),
+        add_key('image_metadata', 'idx_file_type_timestamp', 'file_type, timestamp'),
+        add_key('image_metadata', 'idx_timestamp', 'timestamp'),
+        add_key('image_metadata', 'idx_image_prefix_timestamp', 'image_prefix(255), timestamp'),
+    ]),
+    # the backfill runs before MAINTAIN_ROLLUPS is turned on, see rebuild_rollups for writes that raced it
+    # the backfill is committed together with the version, so it never runs twice
+    (6, 'create image_metadata_rollup', [CREATE_IMAGE_METADATA_ROLLUP_SQL, BACKFILL_IMAGE_METADATA_ROLLUP_SQL]),
+    # result of the full decode done with VERIFY_IMAGES, NULL for images that were not verified, see verify_helpers
+    (7, 'add verification result to image_metadata', [
+        add_column('image_metadata', 'is_valid', 'BOOLEAN NULL'),
+        add_column('image_metadata', 'validation_error', 'VARCHAR(255) NULL'),
+    ]),
+    # time mysql last wrote the row, the incremental export and the similarity index read the rows written after
+    # their high water mark from it, the rows already in the table get the time of the migration
+    (8, 'add updated_at to image_metadata', [
+        add_column('image_metadata', 'updated_at', 'DATETIME(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)'),
+        add_key('image_metadata', 'idx_updated_at', 'updated_at'),
+    ]),
+]
+
+
+# apply every migration that is not recorded in schema_migrations yet
+# returns the versions that were applied
+def apply_migrations(logger, manager=None, migrations=None):
+    manager = manager or connection_manager
+    migrations = migrations or MIGRATIONS
+    applied = []
+    connection = manager.get_connection(logger)
+    if connection is None:
+        logger.error("Could not connect to RDS to apply migrations...")
+        return applied
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(CREATE_MIGRATIONS_TABLE_SQL)
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied_versions = {row[0] for row in cursor.fetchall()}
+
+        for version, description, steps in sorted(migrations, key=lambda migration: migration[0]):
+            if version in applied_versions:
+                continue
+            logger.info("Applying migration %s: %s...", version, description)
+            # ddl commits implicitly in mysql, so every step is applied on its own and the version recorded last
+            with connection.cursor() as cursor:
+                for step in steps:
+                    guard_sql, guard_args, statement = step if isinstance(step, tuple) else (None, None, step)
+                    if guard_sql is not None:
+                        cursor.execute(guard_sql, guard_args)
+                        if cursor.fetchone()[0]:
+                            logger.info("Skipping a step of migration %s that was already applied: %s...", version, ' '.join(statement.split())[:100])
+                            continue
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+            connection.commit()
+            applied.append(version)
+    except pymysql.MySQLError as e:
+        logger.error("Error applying migrations: %s", e)
+        rollback(connection, manager, logger)
+        raise
+
+    logger.info("Schema is up to date... Applied %s migrations...", len(applied))
+    return applied
+
+
+# recompute the rollups from image_metadata in one transaction, which also tightens the dimension bounds
+# the image_metadata rows are locked while the rollups are rebuilt so no write can apply a delta in between
+def rebuild_rollups(logger, manager=None):
+    manager = manager or connection_manager
+    connection = manager.get_connection(logger)
+    if connection is None:
+        logger.error("Could not connect to RDS to rebuild the rollups...")
+        return False
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM image_metadata FOR UPDATE")
+            cursor.execute("DELETE FROM image_metadata_rollup")
+            cursor.execute(BACKFILL_IMAGE_METADATA_ROLLUP_SQL)
+        connection.commit()
+    except pymysql.MySQLError as e:
+        logger.error("Error rebuilding the rollups: %s", e)
+        rollback(connection, manager, logger)
+        return False
+
+    logger.info("Rebuilt the image metadata rollups...")
+    return True
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    logger = create_logger()
+    apply_migrations(logger)
+    if '--rebuild-rollups' in argv:
+        return 0 if rebuild_rollups(logger) else 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
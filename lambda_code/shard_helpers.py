@@ -0,0 +1,64 @@
+# consistent hashing of image ids onto the database shards
+#
+# with SHARD_SECRET_NAMES set to a comma separated list of secrets manager secrets, one per mysql database, every
+# image_id is written to and read from the shard it hashes to instead of the single RDS_SECRET_NAME database
+# every shard is placed on the ring many times (virtual nodes) so the keys spread evenly, and adding a shard only
+# moves the keys that now hash to it, see rebalance.py
+import bisect
+import hashlib
+import os
+import threading
+
+# positions every shard takes on the ring
+DEFAULT_VIRTUAL_NODES = 128
+
+
+# hash a string onto the ring, md5 is used for its even spread and is the same in every process unlike hash()
+def hash_key(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+# ring of virtual nodes mapping keys to shards
+class HashRing:
+
+    def __init__(self, nodes, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        if not nodes:
+            raise ValueError("A hash ring needs at least one node")
+        self.nodes = list(nodes)
+        points = sorted((hash_key(f"{node}#{index}"), node) for node in self.nodes for index in range(virtual_nodes))
+        self.positions = [position for position, _ in points]
+        self.owners = [node for _, node in points]
+
+    # return the node owning a key, the first virtual node clockwise from the key's position
+    def get_node(self, key):
+        index = bisect.bisect(self.positions, hash_key(key)) % len(self.positions)
+        return self.owners[index]
+
+    # group items by the node owning their key, keeping the order of the items within every group
+    def group_by_node(self, items, key=lambda item: item):
+        groups = {}
+        for item in items:
+            groups.setdefault(self.get_node(key(item)), []).append(item)
+        return groups
+
+
+# return the shard secrets configured in SHARD_SECRET_NAMES, an empty list when sharding is off
+def get_shard_names():
+    return [name.strip() for name in os.getenv('SHARD_SECRET_NAMES', '').split(',') if name.strip()]
+
+
+# ring of the configured shards, rebuilt when SHARD_SECRET_NAMES changes
+shard_ring = None
+shard_ring_lock = threading.Lock()
+
+
+# return the ring of the configured shards, or None when sharding is off
+def get_shard_ring():
+    global shard_ring
+    names = get_shard_names()
+    if not names:
+        return None
+    with shard_ring_lock:
+        if shard_ring is None or shard_ring.nodes != names:
+            shard_ring = HashRing(names)
+        return shard_ring
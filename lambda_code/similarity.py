@@ -0,0 +1,157 @@
+import threading
+
+import pymysql
+
+from .db_helpers import get_all_managers, is_connection_error
+
+# number of rows fetched from rds per round trip when loading the index
+LOAD_FETCH_SIZE = 10000
+# rows written in the last seconds are loaded again by the next load, a write still in flight when they were read
+# commits behind them with an earlier updated_at
+LOAD_SETTLE_SECONDS = 60
+
+
+# number of bits that differ between two hashes
+def hamming_distance(first_hash, second_hash):
+    return (first_hash ^ second_hash).bit_count()
+
+
+# bk-tree over 64 bit perceptual hashes using the hamming distance
+# a search for hashes within distance k only visits children whose edge distance is within k of the query distance,
+# so it touches a small part of the tree instead of every hash
+class BKTree:
+
+    def __init__(self):
+        # every node is [hash, set of image ids with that hash, dict of edge distance to child node]
+        self.root = None
+        self.size = 0
+
+    # add an image id under its hash
+    def add(self, image_hash, image_id):
+        if self.root is None:
+            self.root = [image_hash, {image_id}, {}]
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(image_hash, node[0])
+            if distance == 0:
+                node[1].add(image_id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, {image_id}, {}]
+                self.size += 1
+                return
+            node = child
+
+    # remove an image id from a hash, the node itself stays in the tree so the structure remains valid
+    def discard(self, image_hash, image_id):
+        node = self.root
+        while node is not None:
+            distance = hamming_distance(image_hash, node[0])
+            if distance == 0:
+                node[1].discard(image_id)
+                return
+            node = node[2].get(distance)
+
+    # return (image id, distance) for every image whose hash is within max_distance of the query hash
+    def search(self, image_hash, max_distance):
+        matches = []
+        pending = [self.root] if self.root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(image_hash, node[0])
+            if distance <= max_distance:
+                matches.extend((image_id, distance) for image_id in node[1])
+            # by the triangle inequality only children with an edge in this range can hold matches
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    pending.append(child)
+        return sorted(matches, key=lambda match: (match[1], match[0]))
+
+
+# near duplicate index over the perceptual hashes stored in the image_metadata table
+# the index is built once from rds and then kept current with incremental loads of the rows written since
+class NearDuplicateIndex:
+
+    def __init__(self):
+        self.tree = BKTree()
+        # current hash of every indexed image, used to move an image when it is re-uploaded with new content
+        self.hashes = {}
+        # (updated_at, image_id) of the newest settled row loaded from every database keyed by its connection manager,
+        # the next incremental load of a database starts after it, the shards write on their own clocks
+        self.high_water_marks = {}
+        self.lock = threading.Lock()
+
+    # add or update the hash of an image
+    def add(self, image_id, image_hash):
+        with self.lock:
+            previous_hash = self.hashes.get(image_id)
+            if previous_hash == image_hash:
+                return
+            if previous_hash is not None:
+                self.tree.discard(previous_hash, image_id)
+            self.hashes[image_id] = image_hash
+            self.tree.add(image_hash, image_id)
+
+    # return (image id, distance) for every image within max_distance bits of the hash
+    def find_within(self, image_hash, max_distance):
+        with self.lock:
+            return self.tree.search(image_hash, max_distance)
+
+    # return the near duplicates of an indexed image, leaving the image itself out
+    def find_similar(self, image_id, max_distance):
+        image_hash = self.hashes.get(image_id)
+        if image_hash is None:
+            return []
+        return [match for match in self.find_within(image_hash, max_distance) if match[0] != image_id]
+
+    # load the rows written since the last load, or every row on the first call
+    # reads every shard when sharding is on, or only the database of the manager passed in
+    # returns the number of rows loaded
+    def load_from_rds(self, logger, manager=None):
+        managers = [manager] if manager else get_all_managers()
+        return sum(self.load_from_database(logger, database_manager) for database_manager in managers)
+
+    # load the rows one database wrote since the last load of it
+    # rows are read in the order mysql wrote them (updated_at, see migration 8), the extraction timestamp is set before
+    # the write and a retried or replayed write can land long after it
+    def load_from_database(self, logger, manager):
+        sql = "SELECT image_id, phash, updated_at, updated_at < NOW(6) - INTERVAL %s SECOND FROM image_metadata WHERE phash IS NOT NULL"
+        args = (LOAD_SETTLE_SECONDS,)
+        high_water_mark = self.high_water_marks.get(manager)
+        if high_water_mark is not None:
+            # keyset condition on (updated_at, image_id) so rows sharing a time are not skipped
+            sql += " AND (updated_at > %s OR (updated_at = %s AND image_id > %s))"
+            args += (high_water_mark[0], high_water_mark[0], high_water_mark[1])
+        sql += " ORDER BY updated_at, image_id"
+
+        loaded = 0
+        try:
+            connection = manager.get_connection(logger)
+            if connection is None:
+                return 0
+            # stream the rows instead of buffering the whole table on the client
+            with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+                cursor.execute(sql, args)
+                while True:
+                    rows = cursor.fetchmany(LOAD_FETCH_SIZE)
+                    if not rows:
+                        break
+                    for image_id, image_hash, updated_at, settled in rows:
+                        self.add(image_id, int(image_hash))
+                        # only settled rows move the mark, the newer ones are read again next time
+                        if settled:
+                            self.high_water_marks[manager] = (updated_at, image_id)
+                    loaded += len(rows)
+            connection.commit()
+            logger.info("Loaded %s perceptual hashes into the near duplicate index...", loaded)
+        except pymysql.MySQLError as e:
+            logger.error("Error loading perceptual hashes from RDS: %s", e)
+            if is_connection_error(e):
+                manager.close()
+        return loaded
+
+    def __len__(self):
+        return len(self.hashes)
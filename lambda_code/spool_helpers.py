@@ -0,0 +1,232 @@
+# write-behind spool for metadata that could not be written to rds
+#
+# when rds is down or saturated the circuit breaker opens and the handler spills the extracted metadata to jsonl
+# objects under the spool prefix instead of failing the records, the replayer drains the spool back into rds with
+# large batched upserts once the database recovers
+#
+# usage:
+#   RDS_SECRET_NAME=<secret> python -m lambda_code.spool_helpers --bucket penn-entertainment-bucket
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import boto3
+
+from .db_helpers import is_rds_available, write_batch_to_rds
+from .logging_helpers import create_logger
+from .metrics_helpers import put_metric
+from .utils import get_env_int
+
+# prefix the spooled metadata is written under, outside the images folder so it never triggers the lambda
+DEFAULT_SPOOL_PREFIX = 'spool/'
+# prefix the records rds rejects during a replay are moved to, outside the spool prefix so they are not replayed again
+DEFAULT_DEAD_LETTER_PREFIX = 'spool-dead-letter/'
+# consecutive failed or slow batch writes before the circuit opens
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 3
+# seconds the circuit stays open before a single trial write is let through
+DEFAULT_CIRCUIT_RESET_SECONDS = 30
+# batch writes slower than this count as failures, 0 turns the latency check off
+DEFAULT_CIRCUIT_LATENCY_THRESHOLD_MS = 5000
+# number of rows per multi-row upsert when replaying, a spool object holds a whole invocation's records
+DEFAULT_REPLAY_BATCH_SIZE = 1000
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+
+
+# circuit breaker around the rds writes, shared by the warm invocations of this container
+# closed lets every write through, open sends every write to the spool, half open lets one trial write through
+# and closes again if it succeeds or re-opens if it fails
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=None, reset_seconds=None, latency_threshold_ms=None):
+        self.failure_threshold = failure_threshold or get_env_int('CIRCUIT_FAILURE_THRESHOLD', DEFAULT_CIRCUIT_FAILURE_THRESHOLD)
+        self.reset_seconds = reset_seconds if reset_seconds is not None else get_env_int('CIRCUIT_RESET_SECONDS', DEFAULT_CIRCUIT_RESET_SECONDS)
+        self.latency_threshold_ms = latency_threshold_ms if latency_threshold_ms is not None else get_env_int('CIRCUIT_LATENCY_THRESHOLD_MS', DEFAULT_CIRCUIT_LATENCY_THRESHOLD_MS)
+        self.lock = threading.Lock()
+        self.reset()
+
+    # close the circuit and forget the failures
+    def reset(self):
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+
+    # check if a write to rds should be attempted, moving an open circuit to half open once the reset time passed
+    def allow_request(self):
+        with self.lock:
+            if self.state == CIRCUIT_OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = CIRCUIT_HALF_OPEN
+                self.trial_in_flight = False
+            if self.state == CIRCUIT_HALF_OPEN:
+                # only one trial write at a time while the database is recovering
+                if self.trial_in_flight:
+                    return False
+                self.trial_in_flight = True
+                return True
+            return self.state == CIRCUIT_CLOSED
+
+    # record the outcome of a write, a write slower than the latency threshold counts as a failure
+    def record_result(self, succeeded, latency_ms, logger):
+        if succeeded and self.latency_threshold_ms and latency_ms > self.latency_threshold_ms:
+            logger.info("RDS write took %.0f ms, over the %s ms threshold...", latency_ms, self.latency_threshold_ms)
+            succeeded = False
+        with self.lock:
+            self.trial_in_flight = False
+            if succeeded:
+                if self.state != CIRCUIT_CLOSED:
+                    logger.info("RDS write succeeded, closing the circuit...")
+                self.reset()
+                return
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != CIRCUIT_OPEN:
+                    logger.error("Opening the RDS circuit after %s failed writes... Spooling metadata for %s s...", self.failures, self.reset_seconds)
+                    put_metric('CircuitOpened', 1)
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.monotonic()
+
+    def get_state(self):
+        return self.state
+
+
+# circuit breaker shared by the warm invocations of this container
+rds_circuit_breaker = CircuitBreaker()
+
+
+# return the bucket and prefix of the spool, the spool lives in the ingest bucket unless SPOOL_BUCKET is set
+def get_spool_location():
+    return os.getenv('SPOOL_BUCKET') or os.getenv('BUCKET_NAME'), os.getenv('SPOOL_PREFIX', DEFAULT_SPOOL_PREFIX)
+
+
+# return the prefix the records rejected during a replay are moved to
+def get_dead_letter_prefix():
+    return os.getenv('SPOOL_DEAD_LETTER_PREFIX', DEFAULT_DEAD_LETTER_PREFIX)
+
+
+# write a list of metadata records to a new jsonl object in the spool
+# the key starts with the hour it was written so the replayer drains the oldest records first
+# returns True if the records are durably stored, False otherwise
+def spool_metadata(s3_client, image_metadata_list, logger, bucket_name=None, prefix=None):
+    if not image_metadata_list:
+        return True
+    default_bucket, default_prefix = get_spool_location()
+    bucket_name = bucket_name or default_bucket
+    prefix = default_prefix if prefix is None else prefix
+    if not bucket_name:
+        logger.error("No spool bucket configured, %s metadata records cannot be spooled...", len(image_metadata_list))
+        return False
+
+    object_key = f"{prefix}{datetime.now(timezone.utc).strftime('%Y/%m/%d/%H%M%S')}-{uuid.uuid4().hex}.jsonl"
+    body = ''.join(json.dumps(image_metadata) + '\n' for image_metadata in image_metadata_list)
+    try:
+        s3_client.put_object(Bucket=bucket_name, Key=object_key, Body=body.encode('utf-8'), ContentType='application/x-ndjson')
+    except Exception as e:
+        logger.error("Error spooling %s metadata records to %s/%s: %s...", len(image_metadata_list), bucket_name, object_key, e)
+        return False
+    logger.info("Spooled %s metadata records to %s/%s...", len(image_metadata_list), bucket_name, object_key)
+    put_metric('RecordsSpooled', len(image_metadata_list))
+    return True
+
+
+# read the metadata records of a spool object
+def read_spool_object(s3_client, bucket_name, object_key):
+    body = s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body'].read().decode('utf-8')
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+# drain the spool into rds, oldest objects first
+# every object is deleted once its records are written, the failed records of a chunk are retried one at a time
+# records rds still rejects while it is reachable are moved to the dead letter prefix so a bad record cannot block the spool
+# stops at the first object that cannot be written because the database is unavailable
+# returns a dict with the number of objects and records replayed
+def replay_spool(s3_client, logger, bucket_name=None, prefix=None, batch_size=DEFAULT_REPLAY_BATCH_SIZE, max_objects=None, manager=None, dead_letter_prefix=None):
+    default_bucket, default_prefix = get_spool_location()
+    bucket_name = bucket_name or default_bucket
+    prefix = default_prefix if prefix is None else prefix
+    dead_letter_prefix = get_dead_letter_prefix() if dead_letter_prefix is None else dead_letter_prefix
+    totals = {'objects_replayed': 0, 'records_written': 0, 'records_failed': 0, 'records_dead_lettered': 0}
+
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for s3_object in page.get('Contents', []):
+            if max_objects is not None and totals['objects_replayed'] >= max_objects:
+                return totals
+            object_key = s3_object['Key']
+            try:
+                image_metadata_list = read_spool_object(s3_client, bucket_name, object_key)
+            except Exception as e:
+                # leave an unreadable object in place so it can be inspected
+                logger.error("Error reading spool object %s: %s...", object_key, e)
+                continue
+
+            written_ids, failed_ids = write_batch_to_rds(image_metadata_list, logger, batch_size=batch_size, manager=manager)
+            if failed_ids and is_rds_available(logger, manager):
+                # a rejected record fails its whole chunk, retry the failed records alone so only the bad ones are left
+                failed = set(failed_ids)
+                retry_list = [image_metadata for image_metadata in image_metadata_list if image_metadata['imageId'] in failed]
+                retried_ids, failed_ids = write_batch_to_rds(retry_list, logger, batch_size=1, manager=manager)
+                written_ids = written_ids + retried_ids
+            totals['records_written'] += len(written_ids)
+            totals['records_failed'] += len(failed_ids)
+            if failed_ids and not is_rds_available(logger, manager):
+                logger.error("Could not replay spool object %s... Stopping until RDS recovers...", object_key)
+                return totals
+
+            # rds is up and still rejects the failed records, move them aside then remove the replayed object
+            failed = set(failed_ids)
+            rejected = [image_metadata for image_metadata in image_metadata_list if image_metadata['imageId'] in failed]
+            if rejected:
+                logger.error("RDS rejected %s records of spool object %s... Moving them to %s...", len(rejected), object_key, dead_letter_prefix)
+                if not spool_metadata(s3_client, rejected, logger, bucket_name, dead_letter_prefix):
+                    return totals
+                totals['records_dead_lettered'] += len(rejected)
+                put_metric('RecordsDeadLettered', len(rejected))
+            s3_client.delete_object(Bucket=bucket_name, Key=object_key)
+            totals['objects_replayed'] += 1
+            logger.info("Replayed spool object %s... Written: %s Failed: %s...", object_key, len(written_ids), len(failed_ids))
+
+    return totals
+
+
+# lambda entry point for the scheduled replay of the spool
+def replay_handler(event, context=None):
+    logger = create_logger()
+    logger.info("Replaying spooled image metadata...")
+    totals = replay_spool(boto3.client('s3'), logger)
+    logger.info("Spool replay finished... %s...", totals)
+    return totals
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Write the spooled image metadata to rds")
+    parser.add_argument('--bucket', default=None, help="bucket holding the spool, defaults to SPOOL_BUCKET or BUCKET_NAME")
+    parser.add_argument('--prefix', default=None, help="prefix of the spool objects, defaults to SPOOL_PREFIX or spool/")
+    parser.add_argument('--dead-letter-prefix', default=None, help="prefix the rejected records are moved to, defaults to SPOOL_DEAD_LETTER_PREFIX or spool-dead-letter/")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_REPLAY_BATCH_SIZE, help="rows per multi-row upsert")
+    parser.add_argument('--max-objects', type=int, default=None, help="stop after replaying this many spool objects")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logger = create_logger()
+    totals = replay_spool(boto3.client('s3'), logger,
+        bucket_name=args.bucket,
+        prefix=args.prefix,
+        dead_letter_prefix=args.dead_letter_prefix,
+        batch_size=args.batch_size,
+        max_objects=args.max_objects,
+    )
+    return 0 if totals['records_failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
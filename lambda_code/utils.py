@@ -1,24 +1,336 @@
 from datetime import datetime, timedelta, timezone
-from PIL import Image
+import importlib
 import io
-import pdb
+import math
+import os
+import statistics
+import struct
+
+from .metrics_helpers import stage_timer
+
+# returned by the header parsers when the image dimensions sit beyond the bytes read so far
+INCOMPLETE_HEADER = 'incomplete'
+
+# jpeg start of frame markers, these hold the image height and width
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# jpeg markers that are not followed by a segment length
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+# image formats pillow is allowed to open, only their plugins are imported
+PILLOW_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP', 'TIFF', 'BMP')
+PILLOW_PLUGINS = ('JpegImagePlugin', 'PngImagePlugin', 'GifImagePlugin', 'WebPImagePlugin', 'TiffImagePlugin', 'BmpImagePlugin')
+
+# images with more pixels than this are rejected before any pixels are decoded, the same default as pillow
+MAX_IMAGE_PIXELS = 89478485
+
+# perceptual hashes are 64 bits, computed from an 8x8 grid
+HASH_SIZE = 8
+# images are shrunk to this size with draft/reduce before hashing so full resolution is never decoded
+HASH_DRAFT_SIZE = (64, 64)
+# the phash dct is computed over a 32x32 grayscale image
+PHASH_IMAGE_SIZE = 32
+# values of the PERCEPTUAL_HASH environment variable
+PERCEPTUAL_HASH_ALGORITHMS = ('dhash', 'phash')
+
+# pillow is imported on first use, records handled by the header probe never need it
+pillow_image = None
+
+
+# import pillow and the plugins of the supported formats once
+# passing the formats to Image.open keeps pillow from importing all of its other plugins when a file is not recognised
+def load_pillow():
+    global pillow_image
+    if pillow_image is None:
+        from PIL import Image
+        for plugin in PILLOW_PLUGINS:
+            importlib.import_module(f"PIL.{plugin}")
+        # make pillow refuse decompression bombs at the same limit
+        Image.MAX_IMAGE_PIXELS = get_env_int('MAX_IMAGE_PIXELS', MAX_IMAGE_PIXELS)
+        pillow_image = Image
+    return pillow_image
+
+
+# read a boolean flag from the environment variables
+def get_env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None or value == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# read an integer setting from the environment variables, fall back to the default if it is missing or invalid
+def get_env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+# check the dimensions of an image against the pixel limit so decompression bombs are rejected before decoding
+def is_within_pixel_limit(width, height, logger):
+    max_pixels = get_env_int('MAX_IMAGE_PIXELS', MAX_IMAGE_PIXELS)
+    if width * height > max_pixels:
+        logger.error("Image of %sx%s pixels is over the limit of %s pixels...", width, height, max_pixels)
+        return False
+    return True
+
 
 # use pillow library to get the height and width of an image
+# s3_file_contents is either bytes or a memory mapped file of a large object, the mapping is read in place
 def get_image_size(s3_file_contents, logger):
     try:
-        logger.info(f"Getting image height and width...")
-        # read the s3 file contents as an image using pillow
-        image = Image.open(io.BytesIO(s3_file_contents))
-        # get the width and height of the image
-        width, height = image.size
-        logger.info(f"Image height: {height} and width: {width}...")
+        logger.info("Getting image height and width...")
+        with stage_timer('ImageDecode'):
+            # wrap bytes in a file object, a memory mapped file already behaves like one
+            source = io.BytesIO(s3_file_contents) if isinstance(s3_file_contents, bytes) else s3_file_contents
+            # read the s3 file contents as an image using pillow, this only reads the header
+            image = load_pillow().open(source, formats=PILLOW_FORMATS)
+            # get the width and height of the image
+            width, height = image.size
+        if not is_within_pixel_limit(width, height, logger):
+            return None, None
+        logger.info("Image height: %s and width: %s...", height, width)
         return width, height
     except Exception as e:
         # log an errors occur while attempting to get the image size
-        logger.error(f"Error getting image size: {e}...")
+        logger.error("Error getting image size: %s...", e)
         return None, None
 
 
+# parse the width and height of a png from the IHDR chunk
+def parse_png_header(header):
+    if len(header) < 24:
+        return INCOMPLETE_HEADER
+    if header[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', header[16:24])
+
+
+# parse the width and height of a gif from the logical screen descriptor
+def parse_gif_header(header):
+    if len(header) < 10:
+        return INCOMPLETE_HEADER
+    return struct.unpack('<HH', header[6:10])
+
+
+# parse the width and height of a bmp from the DIB header
+def parse_bmp_header(header):
+    if len(header) < 26:
+        return INCOMPLETE_HEADER
+    dib_header_size = struct.unpack('<I', header[14:18])[0]
+    # old OS/2 bitmaps store the dimensions as unsigned shorts
+    if dib_header_size == 12:
+        return struct.unpack('<HH', header[18:22])
+    width, height = struct.unpack('<ii', header[18:26])
+    # a negative height marks a top-down bitmap
+    return abs(width), abs(height)
+
+
+# parse the width and height of a webp from its first chunk (lossy, lossless or extended)
+def parse_webp_header(header):
+    if len(header) < 30:
+        return INCOMPLETE_HEADER
+    chunk_type = header[12:16]
+    if chunk_type == b'VP8 ':
+        # lossy frames start with the 9d 01 2a start code followed by 14 bit dimensions
+        if header[23:26] != b'\x9d\x01\x2a':
+            return None
+        width, height = struct.unpack('<HH', header[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk_type == b'VP8L':
+        # lossless bitstreams pack the dimensions minus one into 14 bits each
+        if header[20] != 0x2F:
+            return None
+        bits = struct.unpack('<I', header[21:25])[0]
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk_type == b'VP8X':
+        # extended files store the canvas dimensions minus one as 24 bit integers
+        width = int.from_bytes(header[24:27], 'little') + 1
+        height = int.from_bytes(header[27:30], 'little') + 1
+        return width, height
+    return None
+
+
+# parse the width and height of a jpeg by walking the segments until a start of frame marker is found
+def parse_jpeg_header(header):
+    offset = 2
+    while True:
+        if offset + 4 > len(header):
+            return INCOMPLETE_HEADER
+        if header[offset] != 0xFF:
+            return None
+        marker = header[offset + 1]
+        # skip any fill bytes between segments
+        if marker == 0xFF:
+            offset += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            offset += 2
+            continue
+        # the image data starts at the start of scan marker, a valid file has its frame header before it
+        if marker in (0xD9, 0xDA):
+            return None
+        if marker in JPEG_SOF_MARKERS:
+            if offset + 9 > len(header):
+                return INCOMPLETE_HEADER
+            height, width = struct.unpack('>HH', header[offset + 5:offset + 9])
+            return width, height
+        segment_length = struct.unpack('>H', header[offset + 2:offset + 4])[0]
+        offset += 2 + segment_length
+
+
+# parse the width and height of a tiff from the tags of its first image file directory
+def parse_tiff_header(header):
+    endian = '<' if header[:2] == b'II' else '>'
+    if len(header) < 8:
+        return INCOMPLETE_HEADER
+    ifd_offset = struct.unpack(endian + 'I', header[4:8])[0]
+    if ifd_offset + 2 > len(header):
+        return INCOMPLETE_HEADER
+    entry_count = struct.unpack(endian + 'H', header[ifd_offset:ifd_offset + 2])[0]
+    if ifd_offset + 2 + entry_count * 12 > len(header):
+        return INCOMPLETE_HEADER
+
+    dimensions = {}
+    for index in range(entry_count):
+        entry = header[ifd_offset + 2 + index * 12:ifd_offset + 14 + index * 12]
+        tag, field_type = struct.unpack(endian + 'HH', entry[:4])
+        # 256 is the image width tag and 257 is the image length (height) tag
+        if tag not in (256, 257):
+            continue
+        # the value is either a short (type 3) or a long (type 4) stored inline
+        if field_type == 3:
+            dimensions[tag] = struct.unpack(endian + 'H', entry[8:10])[0]
+        elif field_type == 4:
+            dimensions[tag] = struct.unpack(endian + 'I', entry[8:12])[0]
+
+    if 256 not in dimensions or 257 not in dimensions:
+        return None
+    return dimensions[256], dimensions[257]
+
+
+# parse the width and height from the leading bytes of an image without decoding it
+# returns (width, height), INCOMPLETE_HEADER when more bytes are needed, or None when the format is not supported
+def parse_image_header(header):
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return parse_png_header(header)
+    if header.startswith((b'GIF87a', b'GIF89a')):
+        return parse_gif_header(header)
+    if header.startswith(b'\xff\xd8'):
+        return parse_jpeg_header(header)
+    if header.startswith(b'RIFF') and header[8:12] == b'WEBP':
+        return parse_webp_header(header)
+    if header.startswith((b'II*\x00', b'MM\x00*')):
+        return parse_tiff_header(header)
+    if header.startswith(b'BM'):
+        return parse_bmp_header(header)
+    # a truncated header may still turn out to be one of the formats above
+    if len(header) < 12:
+        return INCOMPLETE_HEADER
+    return None
+
+
+# remove the quotes s3 puts around etags so etags from responses and notifications can be compared
+def normalize_etag(etag):
+    if etag is None:
+        return None
+    return etag.strip('"')
+
+
+# open an image and shrink it for hashing without decoding it at full resolution
+# jpeg files are decoded at a reduced scale by draft(), thumbnail() then uses reduce() before the final resample
+# an image that is already open, e.g. for the renditions, is shrunk with resize() instead so it is not copied or decoded again
+def load_hash_image(s3_file_contents, size, image=None):
+    Image = load_pillow()
+    if image is None:
+        source = io.BytesIO(s3_file_contents) if isinstance(s3_file_contents, bytes) else s3_file_contents
+        image = Image.open(source, formats=PILLOW_FORMATS)
+        image.draft('L', HASH_DRAFT_SIZE)
+        image.thumbnail(HASH_DRAFT_SIZE, reducing_gap=2.0)
+    else:
+        scale = min(HASH_DRAFT_SIZE[0] / image.width, HASH_DRAFT_SIZE[1] / image.height, 1.0)
+        thumbnail_size = max(1, round(image.width * scale)), max(1, round(image.height * scale))
+        image = image.resize(thumbnail_size, Image.Resampling.BICUBIC, reducing_gap=2.0)
+    return image.convert('L').resize(size, Image.Resampling.BILINEAR)
+
+
+# pack a sequence of booleans into an integer, the first value is the most significant bit
+def bits_to_int(bits):
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+# difference hash, every bit tells whether a pixel is brighter than its right neighbour
+def compute_dhash(s3_file_contents, image=None):
+    image = load_hash_image(s3_file_contents, (HASH_SIZE + 1, HASH_SIZE), image)
+    try:
+        import numpy
+    except ImportError:
+        # compare the pixels row by row without numpy
+        pixels = list(image.tobytes())
+        rows = [pixels[row * (HASH_SIZE + 1):(row + 1) * (HASH_SIZE + 1)] for row in range(HASH_SIZE)]
+        return bits_to_int(row[column + 1] > row[column] for row in rows for column in range(HASH_SIZE))
+    pixels = numpy.asarray(image, dtype=numpy.int16)
+    return bits_to_int((pixels[:, 1:] > pixels[:, :-1]).flatten())
+
+
+# dct based perceptual hash, every bit tells whether a low frequency coefficient is above their median
+def compute_phash(s3_file_contents, image=None):
+    image = load_hash_image(s3_file_contents, (PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), image)
+    try:
+        import numpy
+    except ImportError:
+        # numpy is not in the layer by default, only the low frequencies are needed so the dct is cheap without it
+        pixels = list(image.tobytes())
+        rows = [pixels[row * PHASH_IMAGE_SIZE:(row + 1) * PHASH_IMAGE_SIZE] for row in range(PHASH_IMAGE_SIZE)]
+        basis = [[math.cos(math.pi * (2 * n + 1) * k / (2 * PHASH_IMAGE_SIZE)) for n in range(PHASH_IMAGE_SIZE)] for k in range(HASH_SIZE)]
+        row_coefficients = [[sum(value * weight for value, weight in zip(row, basis[k])) for k in range(HASH_SIZE)] for row in rows]
+        low_frequencies = [
+            sum(basis[u][n] * row_coefficients[n][v] for n in range(PHASH_IMAGE_SIZE))
+            for u in range(HASH_SIZE) for v in range(HASH_SIZE)
+        ][1:]
+        median = statistics.median(low_frequencies)
+        return bits_to_int([False] + [coefficient > median for coefficient in low_frequencies])
+    pixels = numpy.asarray(image, dtype=numpy.float64)
+    # type II dct basis, applying it to the rows and the columns gives the 2d dct
+    n = numpy.arange(PHASH_IMAGE_SIZE)
+    basis = numpy.cos(numpy.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * PHASH_IMAGE_SIZE))
+    coefficients = basis @ pixels @ basis.T
+    # keep the lowest frequencies and drop the dc term, which only carries the average brightness
+    low_frequencies = coefficients[:HASH_SIZE, :HASH_SIZE].flatten()[1:]
+    median = numpy.median(low_frequencies)
+    return bits_to_int(numpy.concatenate(([False], low_frequencies > median)))
+
+
+# check the PERCEPTUAL_HASH setting, an unknown algorithm fails the cold start instead of every image
+# returns the algorithm, or None when hashing is off
+def get_perceptual_hash_algorithm():
+    algorithm = os.getenv('PERCEPTUAL_HASH', '').strip().lower()
+    if algorithm and algorithm not in PERCEPTUAL_HASH_ALGORITHMS:
+        raise ValueError(f"Unknown PERCEPTUAL_HASH {algorithm}, expected one of {', '.join(PERCEPTUAL_HASH_ALGORITHMS)}")
+    return algorithm or None
+
+
+# compute the perceptual hash selected by the PERCEPTUAL_HASH environment variable (dhash or phash)
+# returns None when hashing is off or failed, a missing hash does not fail the record
+# image is the already opened image when one is shared with the renditions
+def compute_perceptual_hash(s3_file_contents, logger, image=None):
+    algorithm = get_perceptual_hash_algorithm()
+    if not algorithm or s3_file_contents is None:
+        return None
+    try:
+        logger.info("Computing %s perceptual hash...", algorithm)
+        with stage_timer('PerceptualHash'):
+            if algorithm == 'phash':
+                return compute_phash(s3_file_contents, image)
+            return compute_dhash(s3_file_contents, image)
+    except Exception as e:
+        logger.error("Error computing perceptual hash: %s...", e)
+        return None
+
+
 # calculate current time in EST
 def get_current_est_timestamp():
     # set UTC offset to -5 which represents the EST, get the current time in EST
@@ -29,8 +341,10 @@ def get_current_est_timestamp():
 
 
 # extract image metadata from S3 response
-def extract_metadata(s3_response, s3_file_contents, object_key, logger):
-    logger.info(f"Extracting metadata from {object_key}...")
+# image_size can be passed in when the width and height were already parsed from the image header, in that case s3_file_contents is not needed
+# image is the already opened image when one is shared with the renditions, the perceptual hash is computed from it
+def extract_metadata(s3_response, s3_file_contents, object_key, logger, image_size=None, image=None):
+    logger.info("Extracting metadata from %s...", object_key)
     
     # extract the image metadata
     image_id = object_key # set the image_id to the s3 object key per instructions
@@ -38,14 +352,15 @@ def extract_metadata(s3_response, s3_file_contents, object_key, logger):
     file_size = s3_response['ContentLength'] # get the file size from s3 response
     file_type = s3_response['ContentType'] # get the file type from s3 response
     time_stamp = get_current_est_timestamp() # get the current time 
-    width, height = get_image_size(s3_file_contents, logger) # get the width and height of the image
+    # get the width and height of the image, use the dimensions from the header probe if we have them
+    width, height = image_size if image_size is not None else get_image_size(s3_file_contents, logger)
     
     # check if any metadata values are none, if so log an error and skip the file
     if any(value is None for value in [image_id, file_name, file_size, file_type, time_stamp, width, height]):
-        logger.error(f"Skipping {object_key} due to image metadata extraction failure...")
+        logger.error("Skipping %s due to image metadata extraction failure...", object_key)
         return None
     
-    logger.info(f"Extracting metadata from {object_key}...")
+    logger.info("Extracting metadata from %s...", object_key)
 
     # return the image metadata as dict
     return {
@@ -55,5 +370,8 @@ def extract_metadata(s3_response, s3_file_contents, object_key, logger):
         'fileType': file_type,
         'width': width,
         'height': height,
-        'timestamp': time_stamp
+        'timestamp': time_stamp,
+        'etag': normalize_etag(s3_response.get('ETag')),
+        'versionId': s3_response.get('VersionId'),
+        'perceptualHash': compute_perceptual_hash(s3_file_contents, logger, image)
     }
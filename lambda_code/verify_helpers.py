@@ -0,0 +1,192 @@
+# optional full decode of every image so truncated and corrupt uploads are flagged instead of recorded as valid
+#
+# reading the dimensions only parses the header, so an upload cut short still has a width and height
+# with VERIFY_IMAGES set every image is checked with Image.verify() and fully decoded with Image.load(), the result is
+# stored in the is_valid and validation_error columns
+#
+# the decode is cpu bound and would hold the gil, so the images are verified in a pool of worker processes
+# lambda has no /dev/shm, which multiprocessing and ProcessPoolExecutor need for their locks, so the workers are plain
+# subprocesses started with a new interpreter (like the spawn start method) and fed over pipes, nothing is forked from
+# the threaded handler so no lock held by another thread is inherited; the workers stay up across warm invocations
+#   VERIFY_WORKERS - worker processes verifying at the same time, defaults to the number of cpus lambda gives the memory size
+#   VERIFY_CPU_SECONDS - cpu time a worker may use on one image before it is stopped with SIGXCPU
+#   VERIFY_TIMEOUT_SECONDS - wall time to wait for a worker before it is killed
+#   MAX_IMAGE_PIXELS - images with more pixels are rejected before they are decoded
+import io
+import json
+import math
+import os
+import queue
+import select
+import signal
+import struct
+import subprocess
+import sys
+import threading
+
+from .metrics_helpers import put_metric, stage_timer
+from .utils import MAX_IMAGE_PIXELS, PILLOW_FORMATS, get_env_int, load_pillow
+
+DEFAULT_VERIFY_CPU_SECONDS = 10
+DEFAULT_VERIFY_TIMEOUT_SECONDS = 30
+# longest error stored in the validation_error column
+MAX_VALIDATION_ERROR_LENGTH = 255
+# every job sent to a worker starts with its cpu limit in seconds and the length of the image
+JOB_HEADER = struct.Struct('>II')
+
+# worker processes of this container, created on first use
+verify_pool = None
+verify_pool_lock = threading.Lock()
+
+
+# return the number of images verified at the same time
+def get_verify_workers():
+    return max(get_env_int('VERIFY_WORKERS', os.cpu_count() or 1), 1)
+
+
+# pool of worker processes verifying images, a job waits for an idle worker
+# a worker is started on its first job and replaced after it was killed or stopped by its cpu limit
+class VerifyPool:
+
+    def __init__(self, workers, command=None):
+        self.command = command or [sys.executable, '-m', __name__]
+        self.idle = queue.Queue()
+        for _ in range(workers):
+            self.idle.put(None)
+        self.workers = workers
+
+    # start a worker with the same module path as this process so it finds the package and the layer
+    def start_worker(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        return subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+
+    # verify an image on an idle worker, returns None if the image is intact, or the reason it is not
+    def verify(self, s3_file_contents, cpu_seconds, timeout_seconds):
+        worker = self.idle.get()
+        try:
+            if worker is None or worker.poll() is not None:
+                worker = self.start_worker()
+            return self.run_job(worker, s3_file_contents, cpu_seconds, timeout_seconds)
+        finally:
+            self.idle.put(worker)
+
+    # send an image to a worker and wait at most timeout_seconds for its answer
+    def run_job(self, worker, s3_file_contents, cpu_seconds, timeout_seconds):
+        try:
+            worker.stdin.write(JOB_HEADER.pack(cpu_seconds, len(s3_file_contents)))
+            worker.stdin.write(s3_file_contents)
+            worker.stdin.flush()
+        except OSError:
+            return self.exit_error(worker, cpu_seconds)
+
+        ready, _, _ = select.select([worker.stdout], [], [], timeout_seconds)
+        if not ready:
+            worker.kill()
+            worker.wait()
+            return f"verification timed out after {timeout_seconds} s"
+        line = worker.stdout.readline()
+        if not line:
+            return self.exit_error(worker, cpu_seconds)
+        return json.loads(line)['error']
+
+    # the reason a worker stopped without answering
+    def exit_error(self, worker, cpu_seconds):
+        status = worker.wait()
+        if status == -signal.SIGXCPU:
+            return f"verification used more than {cpu_seconds} s of cpu time"
+        return f"verification process exited with status {status}"
+
+    # stop the idle workers, the pool starts new ones on its next jobs
+    def close(self):
+        for _ in range(self.workers):
+            worker = self.idle.get()
+            if worker is not None and worker.poll() is None:
+                worker.stdin.close()
+                worker.wait()
+            self.idle.put(None)
+
+
+# return the worker pool of this container
+def get_verify_pool():
+    global verify_pool
+    with verify_pool_lock:
+        if verify_pool is None:
+            verify_pool = VerifyPool(get_verify_workers())
+    return verify_pool
+
+
+# stop the worker pool of this container
+def close_verify_pool():
+    global verify_pool
+    with verify_pool_lock:
+        if verify_pool is not None:
+            verify_pool.close()
+        verify_pool = None
+
+
+# check the structure of an image and decode all of its pixels
+# returns None if the image is intact, or the reason it is not
+def verify_image(s3_file_contents):
+    Image = load_pillow()
+    source = io.BytesIO(s3_file_contents) if isinstance(s3_file_contents, bytes) else s3_file_contents
+    try:
+        with Image.open(source, formats=PILLOW_FORMATS) as image:
+            width, height = image.size
+            max_pixels = get_env_int('MAX_IMAGE_PIXELS', MAX_IMAGE_PIXELS)
+            if width * height > max_pixels:
+                return f"image of {width}x{height} pixels is over the limit of {max_pixels} pixels"
+            # verify checks the chunk checksums of a png without decoding, and leaves the image unusable
+            image.verify()
+        source.seek(0)
+        with Image.open(source, formats=PILLOW_FORMATS) as image:
+            # decoding every pixel finds truncated and corrupt image data
+            image.load()
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"[:MAX_VALIDATION_ERROR_LENGTH]
+    return None
+
+
+# main loop of a worker process, verifies the images written to stdin and answers with one json line each
+# every image gets cpu_seconds on top of the cpu time the worker already used, past that the kernel stops it with SIGXCPU
+def run_verify_worker(verify=None):
+    import resource
+    verify = verify or verify_image
+    load_pillow()
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    while True:
+        header = stdin.read(JOB_HEADER.size)
+        if len(header) < JOB_HEADER.size:
+            return 0
+        cpu_seconds, size = JOB_HEADER.unpack(header)
+        s3_file_contents = stdin.read(size)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        _, hard_limit = resource.getrlimit(resource.RLIMIT_CPU)
+        soft_limit = math.ceil(usage.ru_utime + usage.ru_stime) + cpu_seconds
+        if hard_limit != resource.RLIM_INFINITY:
+            soft_limit = min(soft_limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, hard_limit))
+        error = verify(s3_file_contents)
+        stdout.write(json.dumps({'error': error}).encode('utf-8') + b'\n')
+        stdout.flush()
+
+
+# verify an image, in the worker pool where the platform has pipes select can wait on
+# returns whether the image is valid and the reason it is not
+def verify_image_contents(s3_file_contents, object_key, logger):
+    with stage_timer('Verify'):
+        if os.name == 'posix':
+            error = get_verify_pool().verify(s3_file_contents,
+                get_env_int('VERIFY_CPU_SECONDS', DEFAULT_VERIFY_CPU_SECONDS),
+                get_env_int('VERIFY_TIMEOUT_SECONDS', DEFAULT_VERIFY_TIMEOUT_SECONDS))
+        else:
+            error = verify_image(s3_file_contents)
+
+    if error is not None:
+        logger.error("Image %s failed verification: %s...", object_key, error)
+        put_metric('ImagesInvalid', 1)
+        return False, error
+    return True, None
+
+
+if __name__ == '__main__':
+    sys.exit(run_verify_worker())
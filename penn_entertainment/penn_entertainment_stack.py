@@ -6,15 +6,27 @@ from aws_cdk import (
     aws_rds as rds,
     aws_ec2 as ec2,
     aws_iam as iam,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
+    aws_events as events,
+    aws_events_targets as targets,
+    Duration,
+    IgnoreMode,
     RemovalPolicy,
 )
 from constructs import Construct
 
+from .performance_profiles import get_performance_profile
+
 class PennEntertainmentStack(Stack):
 
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # performance profile sizing the lambda, rds and their connection, "dev" unless set with -c performance_profile=<name>
+        profile = get_performance_profile(self.node.try_get_context("performance_profile"))
+        architecture = _lambda.Architecture.ARM_64 if profile["architecture"] == "arm64" else _lambda.Architecture.X86_64
+
         # VPC for RDS with 2 availability zones 
         vpc = ec2.Vpc(self, "PennEntertainmentVpc", max_azs=2)
 
@@ -26,8 +38,8 @@ class PennEntertainmentStack(Stack):
             engine=rds.DatabaseInstanceEngine.mysql(version=rds.MysqlEngineVersion.VER_8_0_39),
             # attach the RDS instance to the VPC 
             vpc=vpc,
-            # instance type setup for small workloads
-            instance_type=ec2.InstanceType.of(ec2.InstanceClass.BURSTABLE2, ec2.InstanceSize.MICRO),
+            # instance type from the performance profile
+            instance_type=ec2.InstanceType.of(profile["instance_class"], profile["instance_size"]),
             # genrate credentials for MySQL db with dbadmin as the username
             credentials=rds.Credentials.from_generated_secret("dbadmin"),
             # db name  
@@ -38,6 +50,18 @@ class PennEntertainmentStack(Stack):
             deletion_protection=True,
         )
 
+        # pool the lambda connections through an rds proxy when the profile asks for one
+        # the proxy is only reachable from inside the vpc, so the lambdas are placed in the vpc as well
+        rds_proxy = None
+        if profile["rds_proxy"]:
+            rds_proxy = rds_instance.add_proxy("PennEntertainmentRdsProxy",
+                secrets=[rds_instance.secret],
+                vpc=vpc,
+                # the lambda connects with the secret's password and without tls, like it does directly to the instance
+                require_tls=False
+            )
+        rds_endpoint = rds_proxy.endpoint if rds_proxy else rds_instance.db_instance_endpoint_address
+
         # create S3 bucket
         bucket = s3.Bucket(self,
             "PennEntertainmentBucket",
@@ -53,41 +77,121 @@ class PennEntertainmentStack(Stack):
         lambda_layer = _lambda.LayerVersion(self,
             "PennEntertainmentLayer",
             # path to the zip conaining dependencies
-            code=_lambda.Code.from_asset("lambda_layer.zip"), 
+            code=_lambda.Code.from_asset(self.node.try_get_context("layer_asset") or "lambda_layer.zip"), 
             # specify compatible runtime to match lambda runtime 
             compatible_runtimes=[_lambda.Runtime.PYTHON_3_12],  
+            # the layer holds compiled packages, it has to be built for the profile's architecture
+            compatible_architectures=[architecture],
             description="Layer containing dependencies"
         )
 
+        # ship the lambda_code folder as a package so the handlers and their relative imports resolve on lambda
+        lambda_code = _lambda.Code.from_asset(".", exclude=["*", "!lambda_code", "**/__pycache__"], ignore_mode=IgnoreMode.DOCKER)
+
         # create Lambda function
         lambda_function = _lambda.Function(self,
             "PennEntertainmentFunction",
             # set the runtime to python 3.12 per instructions
             runtime=_lambda.Runtime.PYTHON_3_12,
             # set the entry point for the lambda
-            handler="lambda_function.handler",
+            handler="lambda_code.lambda_function.handler",
             # specify the location of the lambda handler
-            code=_lambda.Code.from_asset("lambda_code"), 
+            code=lambda_code,
             # add needed enviornment variables for db and bucket connection
             environment={
                 "BUCKET_NAME": bucket.bucket_name,
-                "RDS_ENDPOINT": rds_instance.db_instance_endpoint_address,
+                "RDS_ENDPOINT": rds_endpoint,
                 "RDS_PORT": rds_instance.db_instance_endpoint_port,
                 "DB_NAME": "metadataDB",
                 "DB_USER": "dbadmin",
                 "RDS_SECRET_NAME": rds_instance.secret.secret_name if rds_instance.secret else "",
+                # spill metadata to the spool prefix of the bucket while rds is unavailable, set by the performance profile
+                "WRITE_BEHIND_SPOOL": "true" if profile["write_behind_spool"] else "false",
+                "SPOOL_PREFIX": "spool/",
             },
             # attach lambda layer with dependencies
             layers=[lambda_layer],
-            # set the memory size to handle multiple simultaneous uploads
-            memory_size=128,
-            # set the reserved concurrency to handle 100 concurrent executions without throttling
-            reserved_concurrent_executions=100
+            # size the lambda from the performance profile, cpu is allocated in proportion to the memory
+            architecture=architecture,
+            memory_size=profile["memory_size"],
+            timeout=Duration.seconds(profile["timeout_seconds"]) if profile["timeout_seconds"] else None,
+            # cap the concurrent executions so a spike of uploads cannot exhaust the rds connections
+            reserved_concurrent_executions=profile["reserved_concurrency"],
+            # run inside the vpc when connecting through the rds proxy
+            vpc=vpc if rds_proxy else None
         )
 
+        # events invoke the function directly, or a live alias with pre-initialized environments when provisioned
+        invoke_target = lambda_function
+        if profile["provisioned_concurrency"]:
+            min_capacity, max_capacity = profile["provisioned_concurrency"]
+            live_alias = _lambda.Alias(self,
+                "PennEntertainmentLiveAlias",
+                alias_name="live",
+                version=lambda_function.current_version,
+                provisioned_concurrent_executions=min_capacity
+            )
+            # scale the provisioned environments with their utilization
+            live_alias.add_auto_scaling(min_capacity=min_capacity, max_capacity=max_capacity).scale_on_utilization(
+                utilization_target=profile["provisioned_utilization_target"]
+            )
+            invoke_target = live_alias
+
         # give Lambda permissions to read from the s3 bucket
         bucket.grant_read(lambda_function)
 
+        # give lambda permission to write metadata to the spool, outside the images folder so it does not trigger the lambda
+        bucket.grant_put(lambda_function, "spool/*")
+
+        # give lambda permission to write the renditions configured with the RENDITIONS environment variable
+        bucket.grant_put(lambda_function, "renditions/*")
+
+        # create a Lambda function that drains the spool into rds once the database recovers
+        spool_replay_function = _lambda.Function(self,
+            "PennEntertainmentSpoolReplayFunction",
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            # same code as the ingest lambda with the replay entry point
+            handler="lambda_code.spool_helpers.replay_handler",
+            code=lambda_code,
+            environment={
+                "BUCKET_NAME": bucket.bucket_name,
+                "RDS_ENDPOINT": rds_endpoint,
+                "RDS_PORT": rds_instance.db_instance_endpoint_port,
+                "DB_NAME": "metadataDB",
+                "DB_USER": "dbadmin",
+                "RDS_SECRET_NAME": rds_instance.secret.secret_name if rds_instance.secret else "",
+                "SPOOL_PREFIX": "spool/",
+                "SPOOL_DEAD_LETTER_PREFIX": "spool-dead-letter/",
+            },
+            layers=[lambda_layer],
+            architecture=architecture,
+            # a spool object holds a whole batch, give the replay room for large upserts
+            memory_size=256,
+            timeout=Duration.minutes(5),
+            # a single replayer keeps the spool drained in order without competing for connections
+            reserved_concurrent_executions=1,
+            vpc=vpc if rds_proxy else None
+        )
+
+        # give the replay lambda permission to read and remove the spooled metadata
+        bucket.grant_read(spool_replay_function, "spool/*")
+        bucket.grant_put(spool_replay_function, "spool/*")
+        bucket.grant_delete(spool_replay_function, "spool/*")
+        # records rds rejects are moved to the dead letter prefix so they do not block the replay
+        bucket.grant_put(spool_replay_function, "spool-dead-letter/*")
+
+        # give the replay lambda permission to connect to rds and read its credentials
+        rds_instance.grant_connect(spool_replay_function)
+        if rds_instance.secret:
+            rds_instance.secret.grant_read(spool_replay_function)
+
+        # drain the spool every five minutes, the replay stops right away while rds is still unavailable
+        events.Rule(self,
+            "PennEntertainmentSpoolReplaySchedule",
+            schedule=events.Schedule.rate(Duration.minutes(5)),
+            targets=[targets.LambdaFunction(spool_replay_function)]
+        )
+
         # give lambda permission to connect to rds
         rds_instance.grant_connect(lambda_function)
 
@@ -100,13 +204,59 @@ class PennEntertainmentStack(Stack):
         if rds_instance.secret: 
             rds_instance.secret.grant_read(lambda_function)
 
-        # create S3 event notification for Lambda
-        # this event notification is specefic to objects created within the images folder in s3
-        bucket.add_event_notification(
-            # trigger lambda when an object is created
-            s3.EventType.OBJECT_CREATED,
-            # define the lambda function that will be triggered as the one created above
-            s3n.LambdaDestination(lambda_function),
-            # only trigger when an object is created in the images folder
-            s3.NotificationKeyFilter(prefix="images/")
-        )
+        # allow both lambdas to reach the rds proxy, and the proxy to reach the instance
+        # add_proxy already opens the instance to the proxy, the rule is repeated so it does not depend on that
+        if rds_proxy:
+            rds_instance.connections.allow_default_port_from(rds_proxy)
+            rds_proxy.connections.allow_from(lambda_function, ec2.Port.tcp(3306))
+            rds_proxy.connections.allow_from(spool_replay_function, ec2.Port.tcp(3306))
+
+        # choose how uploads reach the lambda, "s3" invokes it directly for every upload,
+        # "sqs" buffers the notifications in a queue so the lambda consumes them in batches
+        ingestion_mode = self.node.try_get_context("ingestion_mode") or "s3"
+
+        if ingestion_mode == "sqs":
+            # queue holding the notifications that failed processing too many times
+            dead_letter_queue = sqs.Queue(self,
+                "PennEntertainmentDeadLetterQueue",
+                # keep failed notifications around long enough to investigate them
+                retention_period=Duration.days(14)
+            )
+
+            # the sqs_batch_size context overrides the batch size of the profile
+            sqs_batch_size = int(self.node.try_get_context("sqs_batch_size") or profile["sqs_batch_size"])
+            sqs_batching_window = int(self.node.try_get_context("sqs_batching_window_seconds") or 5)
+
+            # queue buffering the s3 notifications in front of the lambda
+            ingest_queue = sqs.Queue(self,
+                "PennEntertainmentIngestQueue",
+                # aws recommends a visibility timeout of at least six times the function timeout (3 seconds by default) plus the batching window
+                visibility_timeout=Duration.seconds(6 * (lambda_function.timeout.to_seconds() if lambda_function.timeout else 3) + sqs_batching_window),
+                # move notifications to the dead letter queue after five failed attempts
+                dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=5, queue=dead_letter_queue)
+            )
+
+            # send s3 notifications for objects created within the images folder to the queue
+            bucket.add_event_notification(
+                s3.EventType.OBJECT_CREATED,
+                s3n.SqsDestination(ingest_queue),
+                s3.NotificationKeyFilter(prefix="images/")
+            )
+
+            # consume the queue in batches, the lambda reports failed messages so only those are retried
+            invoke_target.add_event_source(lambda_event_sources.SqsEventSource(ingest_queue,
+                batch_size=sqs_batch_size,
+                max_batching_window=Duration.seconds(sqs_batching_window),
+                report_batch_item_failures=True
+            ))
+        else:
+            # create S3 event notification for Lambda
+            # this event notification is specefic to objects created within the images folder in s3
+            bucket.add_event_notification(
+                # trigger lambda when an object is created
+                s3.EventType.OBJECT_CREATED,
+                # define the lambda function that will be triggered as the one created above
+                s3n.LambdaDestination(invoke_target),
+                # only trigger when an object is created in the images folder
+                s3.NotificationKeyFilter(prefix="images/")
+            )
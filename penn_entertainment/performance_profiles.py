@@ -0,0 +1,69 @@
+from aws_cdk import aws_ec2 as ec2
+
+# named performance profiles for the stack, selected with the "performance_profile" context
+#   cdk deploy -c performance_profile=steady
+#
+# memory_size - lambda memory in MB, cpu is allocated in proportion to it
+# architecture - "x86_64" or "arm64", the layer has to be built for the same architecture
+# timeout_seconds - lambda timeout, None keeps the 3 second default
+# sqs_batch_size - most notifications handed to one invocation with the sqs ingestion mode, sized so a batch finishes within the timeout
+# reserved_concurrency - most concurrent executions of the lambda
+# provisioned_concurrency - (min, max) pre-initialized environments scaled on utilization, None turns it off
+# provisioned_utilization_target - fraction of the provisioned environments in use before scaling out
+# write_behind_spool - spill the metadata to the spool prefix of the bucket while rds is unavailable instead of failing the records
+# rds_proxy - connect through an rds proxy that pools connections across lambda environments
+# instance_class / instance_size - rds instance type
+PERFORMANCE_PROFILES = {
+    # the original small setup, cheapest for development and testing
+    "dev": {
+        "memory_size": 128,
+        "architecture": "x86_64",
+        "timeout_seconds": None,
+        "sqs_batch_size": 10,
+        "reserved_concurrency": 100,
+        "provisioned_concurrency": None,
+        "provisioned_utilization_target": None,
+        "write_behind_spool": False,
+        "rds_proxy": False,
+        "instance_class": ec2.InstanceClass.BURSTABLE2,
+        "instance_size": ec2.InstanceSize.MICRO,
+    },
+    # constant upload traffic, warm environments and pooled connections on graviton
+    "steady": {
+        "memory_size": 1024,
+        "architecture": "arm64",
+        "timeout_seconds": 30,
+        "sqs_batch_size": 100,
+        "reserved_concurrency": 100,
+        "provisioned_concurrency": (2, 10),
+        "provisioned_utilization_target": 0.7,
+        "write_behind_spool": True,
+        "rds_proxy": True,
+        "instance_class": ec2.InstanceClass.BURSTABLE4_GRAVITON,
+        "instance_size": ec2.InstanceSize.MEDIUM,
+    },
+    # large spikes of uploads, more memory and concurrency with a proxy so the spikes do not exhaust rds connections
+    "burst": {
+        "memory_size": 2048,
+        "architecture": "arm64",
+        "timeout_seconds": 60,
+        "sqs_batch_size": 100,
+        "reserved_concurrency": 500,
+        "provisioned_concurrency": (5, 50),
+        "provisioned_utilization_target": 0.6,
+        "write_behind_spool": True,
+        "rds_proxy": True,
+        "instance_class": ec2.InstanceClass.MEMORY6_GRAVITON,
+        "instance_size": ec2.InstanceSize.LARGE,
+    },
+}
+
+DEFAULT_PERFORMANCE_PROFILE = "dev"
+
+
+# return the settings of a named profile
+def get_performance_profile(name):
+    name = name or DEFAULT_PERFORMANCE_PROFILE
+    if name not in PERFORMANCE_PROFILES:
+        raise ValueError(f"Unknown performance profile {name}, expected one of {', '.join(PERFORMANCE_PROFILES)}")
+    return PERFORMANCE_PROFILES[name]
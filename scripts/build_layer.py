@@ -0,0 +1,256 @@
+# build lambda_layer.zip with only the packages the lambda needs at runtime, and report its size and import time
+#
+# usage:
+#   python scripts/build_layer.py
+#   python scripts/build_layer.py --architecture arm64 --extra numpy --report layer-report.json
+#
+# the packages are installed from prebuilt manylinux wheels for the lambda runtime, so the same layer is built on
+# any machine, and are precompiled to .pyc files so the first import in a cold start does not compile them
+import argparse
+import compileall
+import csv
+import fnmatch
+import json
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from lambda_code.utils import PILLOW_PLUGINS
+from measure_import_time import measure_once
+
+# python version of the lambda runtime the layer is built for
+DEFAULT_PYTHON_VERSION = '3.12'
+# wheel platform of each lambda architecture
+PLATFORMS = {
+    'x86_64': 'manylinux2014_x86_64',
+    'arm64': 'manylinux2014_aarch64',
+}
+# machine names reported by platform.machine() for each lambda architecture
+MACHINES = {
+    'x86_64': ('x86_64', 'amd64'),
+    'arm64': ('aarch64', 'arm64'),
+}
+
+# packages the lambda python runtime already provides, a copy in the layer only adds size
+RUNTIME_PROVIDED_PACKAGES = ('boto3', 'botocore', 's3transfer', 'jmespath', 'dateutil', 'python_dateutil', 'six', 'urllib3')
+
+# test suites shipped inside a package, only removed directly under the top level folders an installed distribution owns,
+# a runtime subpackage with the same name deeper down (e.g. numpy.testing) is kept
+STRIP_TEST_FOLDERS = ('tests', 'test')
+# files removed from every package, none of them are imported at runtime
+STRIP_FILE_PATTERNS = ('*.pyi', 'py.typed', '*.c', '*.h', '*.pyx', '*.pxd')
+
+# pillow plugins kept on top of the ones the lambda opens images with
+# preinit imports the ppm plugin and the jpeg plugin imports the mpo plugin for multi picture jpegs
+EXTRA_PILLOW_PLUGINS = ('PpmImagePlugin', 'MpoImagePlugin')
+# pillow modules for gui toolkits and formats the lambda never opens
+PILLOW_UNUSED_MODULES = ('ImageTk.py', 'ImageQt.py', 'ImageGrab.py', 'ImageShow.py', '_tkinter_finder.py', '_imagingtk.*', '_avif.*')
+
+# modules imported to measure the import time of the layer
+MEASURED_MODULES = 'PIL.Image, pymysql'
+
+# zip entries get a fixed timestamp so the same packages always build the same zip
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+
+# install the runtime requirements from wheels for the lambda platform into the target folder
+def install_requirements(target, requirements, extras, architecture, python_version):
+    command = [
+        sys.executable, '-m', 'pip', 'install',
+        '--target', target,
+        '--platform', PLATFORMS[architecture],
+        '--python-version', python_version,
+        '--implementation', 'cp',
+        '--only-binary=:all:',
+        '--no-compile',
+        '--upgrade',
+        '--requirement', requirements,
+    ] + list(extras)
+    subprocess.run(command, check=True)
+
+
+# return the total size in bytes of the files under a folder
+def get_folder_size(path):
+    total = 0
+    for folder, _, file_names in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(folder, file_name)) for file_name in file_names)
+    return total
+
+
+# remove a file or folder
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+# return the top level folders owned by the distributions installed in the target, read from their RECORD files
+def get_distribution_folders(target):
+    folders = set()
+    for entry in os.listdir(target):
+        record_path = os.path.join(target, entry, 'RECORD')
+        if not entry.endswith('.dist-info') or not os.path.exists(record_path):
+            continue
+        with open(record_path, newline='') as record_file:
+            for row in csv.reader(record_file):
+                top_level = row[0].replace('\\', '/').split('/')[0] if row else ''
+                if top_level and not top_level.endswith(('.dist-info', '.data')) and os.path.isdir(os.path.join(target, top_level)):
+                    folders.add(top_level)
+    return sorted(folders)
+
+
+# remove the packages the runtime provides, their dist-info, the top level test suites of the installed packages,
+# the __pycache__ folders and the files matching the strip patterns
+# returns the relative paths that were removed
+def strip_packages(target):
+    removed = []
+    for entry in os.listdir(target):
+        package_name = entry.split('-')[0].lower()
+        if package_name in RUNTIME_PROVIDED_PACKAGES:
+            remove_path(os.path.join(target, entry))
+            removed.append(entry)
+
+    for package_folder in get_distribution_folders(target):
+        for name in STRIP_TEST_FOLDERS:
+            path = os.path.join(target, package_folder, name)
+            if os.path.isdir(path):
+                remove_path(path)
+                removed.append(os.path.relpath(path, target))
+
+    for folder, folder_names, file_names in os.walk(target, topdown=False):
+        for name in folder_names:
+            if name == '__pycache__':
+                remove_path(os.path.join(folder, name))
+                removed.append(os.path.relpath(os.path.join(folder, name), target))
+        for name in file_names:
+            if any(fnmatch.fnmatch(name, pattern) for pattern in STRIP_FILE_PATTERNS):
+                remove_path(os.path.join(folder, name))
+                removed.append(os.path.relpath(os.path.join(folder, name), target))
+    return removed
+
+
+# remove the pillow plugins and modules for formats and toolkits the lambda never uses
+# pillow imports its plugins inside try/except ImportError blocks, so the removed plugins are skipped
+def strip_pillow(target):
+    removed = []
+    pillow_folder = os.path.join(target, 'PIL')
+    if not os.path.isdir(pillow_folder):
+        return removed
+    kept_plugins = {f"{plugin}.py" for plugin in PILLOW_PLUGINS + EXTRA_PILLOW_PLUGINS}
+    for file_name in os.listdir(pillow_folder):
+        unused_plugin = file_name.endswith('ImagePlugin.py') and file_name not in kept_plugins
+        unused_module = any(fnmatch.fnmatch(file_name, pattern) for pattern in PILLOW_UNUSED_MODULES)
+        if unused_plugin or unused_module:
+            remove_path(os.path.join(pillow_folder, file_name))
+            removed.append(os.path.join('PIL', file_name))
+    return removed
+
+
+# compile every module to a .pyc next to its source
+# unchecked hash pycs are used as they are without comparing them to the source's timestamp,
+# which the layer zip does not keep reliably
+def precompile(target, python_version):
+    if f"{sys.version_info.major}.{sys.version_info.minor}" != python_version:
+        print(f"Skipping precompile... Building with python {sys.version_info.major}.{sys.version_info.minor}, "
+              f"the .pyc files would not match python {python_version}...")
+        return False
+    return compileall.compile_dir(target, quiet=1, workers=0, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+# zip the layer folder with sorted entries and fixed timestamps so the zip is reproducible
+def write_zip(layer_root, output):
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as layer_zip:
+        for folder, folder_names, file_names in os.walk(layer_root):
+            folder_names.sort()
+            for file_name in sorted(file_names):
+                path = os.path.join(folder, file_name)
+                entry = zipfile.ZipInfo(os.path.relpath(path, layer_root), date_time=ZIP_TIMESTAMP)
+                entry.external_attr = (os.stat(path).st_mode & 0o777) << 16
+                entry.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, 'rb') as source:
+                    layer_zip.writestr(entry, source.read())
+
+
+# measure the import time of the layer's packages in fresh interpreters that only see the layer and the standard library
+# returns the median wall time in ms, or None when this machine cannot run the layer
+def measure_layer_import(target, architecture, python_version, runs):
+    import platform
+    import statistics
+    if platform.machine().lower() not in MACHINES[architecture] or f"{sys.version_info.major}.{sys.version_info.minor}" != python_version:
+        print(f"Skipping import time... The layer is built for python {python_version} on {architecture}...")
+        return None
+    # -S leaves out the site packages of this interpreter so only the layer is imported
+    environment = dict(os.environ, PYTHONPATH=target)
+    wall_times = [measure_once(MEASURED_MODULES, sys.executable, flags=['-S'], env=environment)[1] for _ in range(runs)]
+    return statistics.median(wall_times)
+
+
+# build the report of the layer, the largest packages first
+def build_report(target, output, removed, import_ms):
+    packages = {}
+    for entry in os.listdir(target):
+        path = os.path.join(target, entry)
+        packages[entry] = get_folder_size(path) if os.path.isdir(path) else os.path.getsize(path)
+    return {
+        'zip_bytes': os.path.getsize(output),
+        'unzipped_bytes': get_folder_size(target),
+        'packages': dict(sorted(packages.items(), key=lambda item: item[1], reverse=True)),
+        'removed': len(removed),
+        'import_ms': import_ms,
+        'measured_modules': MEASURED_MODULES,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build a slim, precompiled lambda layer with the runtime dependencies")
+    parser.add_argument('--requirements', default=os.path.join(PROJECT_ROOT, 'requirements-lambda.txt'), help="runtime requirements to install")
+    parser.add_argument('--extra', action='append', default=[], help="additional package to install, e.g. numpy to speed up PERCEPTUAL_HASH")
+    parser.add_argument('--architecture', choices=sorted(PLATFORMS), default='x86_64', help="lambda architecture the layer is built for")
+    parser.add_argument('--python-version', default=DEFAULT_PYTHON_VERSION, help="python version of the lambda runtime")
+    parser.add_argument('--output', default=os.path.join(PROJECT_ROOT, 'lambda_layer.zip'), help="layer zip to write")
+    parser.add_argument('--report', default=None, help="write the size and import time report to this json file")
+    parser.add_argument('--runs', type=int, default=5, help="number of fresh interpreters to measure the import time over")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory() as build_folder:
+        # lambda adds the python folder of every layer to the import path
+        target = os.path.join(build_folder, 'python')
+        install_requirements(target, args.requirements, args.extra, args.architecture, args.python_version)
+        installed_bytes = get_folder_size(target)
+
+        removed = strip_packages(target) + strip_pillow(target)
+        precompile(target, args.python_version)
+        write_zip(build_folder, args.output)
+        import_ms = measure_layer_import(target, args.architecture, args.python_version, args.runs)
+        report = build_report(target, args.output, removed, import_ms)
+
+    print(f"Layer written to {args.output} for python {args.python_version} on {args.architecture}")
+    print(f"  installed  {installed_bytes / 1024 / 1024:>8.1f} MB")
+    print(f"  final      {report['unzipped_bytes'] / 1024 / 1024:>8.1f} MB ({report['removed']} files and folders removed, .pyc files added)")
+    print(f"  zipped     {report['zip_bytes'] / 1024 / 1024:>8.1f} MB")
+    if import_ms is not None:
+        print(f"  import of {MEASURED_MODULES}: median {import_ms:.1f} ms")
+    print(f"\nLargest packages (unzipped MB):")
+    for name, size in list(report['packages'].items())[:10]:
+        print(f"  {size / 1024 / 1024:>8.1f}  {name}")
+
+    if args.report:
+        report['installed_bytes'] = installed_bytes
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# measure how long importing the lambda takes in a fresh interpreter, which is what a cold start pays for
+#
+# usage:
+#   python scripts/measure_import_time.py
+#   python scripts/measure_import_time.py --module lambda_code.lambda_function --runs 10 --top 20
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# import the module in a new interpreter with -X importtime and return the per module timings
+# returns a list of (self microseconds, cumulative microseconds, module name) and the total wall time in ms
+# flags are extra interpreter options and env replaces the environment, e.g. to import from a built layer only
+def measure_once(module, python, flags=(), env=None):
+    code = f"import time; started = time.perf_counter(); import {module}; print((time.perf_counter() - started) * 1000)"
+    result = subprocess.run(
+        [python, *flags, '-X', 'importtime', '-c', code],
+        capture_output=True, text=True, cwd=PROJECT_ROOT, check=True, env=env,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        # lines look like "import time:       336 |     352655 |   lambda_code"
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        timings.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return timings, float(result.stdout.strip().splitlines()[-1])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the import time of the lambda handler")
+    parser.add_argument('--module', default='lambda_code.lambda_function', help="module to import")
+    parser.add_argument('--runs', type=int, default=5, help="number of fresh interpreters to average over")
+    parser.add_argument('--top', type=int, default=15, help="number of slowest top level imports to list")
+    parser.add_argument('--python', default=sys.executable, help="python interpreter to measure with")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    wall_times = []
+    for _ in range(args.runs):
+        timings, wall_ms = measure_once(args.module, args.python)
+        wall_times.append(wall_ms)
+
+    print(f"Import of {args.module} over {args.runs} runs: "
+          f"median {statistics.median(wall_times):.1f} ms, min {min(wall_times):.1f} ms, max {max(wall_times):.1f} ms")
+
+    # list the slowest imports made directly by the measured module, nested imports are indented by two spaces per level
+    direct_imports = [timing for timing in timings if len(timing[2]) - len(timing[2].lstrip()) == 3]
+    print(f"\nSlowest direct imports of the last run (cumulative ms):")
+    for self_us, cumulative_us, name in sorted(direct_imports, key=lambda timing: timing[1], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:>9.1f}  {name.strip()}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
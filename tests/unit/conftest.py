@@ -0,0 +1,29 @@
+import pytest
+from lambda_code import db_helpers, lambda_function
+from lambda_code.db_helpers import close_shard_managers, connection_manager, invalidate_rds_credentials, metadata_cache
+from lambda_code.lambda_function import processed_etags
+from lambda_code.spool_helpers import rds_circuit_breaker
+
+
+# reset the module level state that is shared between warm invocations so every test starts cold
+@pytest.fixture(autouse=True)
+def reset_module_state():
+    connection_manager.close()
+    close_shard_managers()
+    invalidate_rds_credentials()
+    processed_etags.clear()
+    metadata_cache.clear()
+    metadata_cache.reset_stats()
+    db_helpers.secrets_client = None
+    lambda_function.s3_client = None
+    rds_circuit_breaker.reset()
+    yield
+    connection_manager.close()
+    close_shard_managers()
+    invalidate_rds_credentials()
+    processed_etags.clear()
+    metadata_cache.clear()
+    metadata_cache.reset_stats()
+    db_helpers.secrets_client = None
+    lambda_function.s3_client = None
+    rds_circuit_breaker.reset()
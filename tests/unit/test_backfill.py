@@ -0,0 +1,67 @@
+import io
+import json
+import boto3
+import pytest
+from unittest.mock import patch
+from moto import mock_aws
+from PIL import Image
+from lambda_code.backfill import backfill
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create a bucket with five images, a folder placeholder and a file that is not an image
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='test-bucket')
+        for index in range(5):
+            buffer = io.BytesIO()
+            Image.new('RGB', (10 + index, 20)).save(buffer, format='PNG')
+            s3_client.put_object(Bucket='test-bucket', Key=f'images/{index}.png', Body=buffer.getvalue(), ContentType='image/png')
+        s3_client.put_object(Bucket='test-bucket', Key='images/', Body=b'')
+        s3_client.put_object(Bucket='test-bucket', Key='images/notes.txt', Body=b'not an image', ContentType='text/plain')
+        s3_client.put_object(Bucket='test-bucket', Key='other/ignored.png', Body=b'', ContentType='image/png')
+        yield s3_client
+
+
+# record the metadata written to rds
+def fake_write_batch(written):
+    def write_batch(image_metadata_list, logger, batch_size=None):
+        written.extend(image_metadata['imageId'] for image_metadata in image_metadata_list)
+        return [image_metadata['imageId'] for image_metadata in image_metadata_list], []
+    return write_batch
+
+
+# test the backfill stops after the requested pages and resumes from its checkpoint
+def test_backfill_resumes_from_checkpoint(s3_client, mock_logger, tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    written = []
+
+    with patch('lambda_code.backfill.write_batch_to_rds', side_effect=fake_write_batch(written)):
+        # simulate a run that stops after two pages of three objects
+        first_run = backfill(s3_client, 'test-bucket', 'images/', mock_logger, checkpoint_path=checkpoint_path, workers=4, page_size=3, max_pages=2)
+        assert not first_run['complete']
+        with open(checkpoint_path) as checkpoint_file:
+            assert json.load(checkpoint_file)['continuation_token'] == first_run['continuation_token']
+
+        # the second run picks up from the checkpoint
+        second_run = backfill(s3_client, 'test-bucket', 'images/', mock_logger, checkpoint_path=checkpoint_path, workers=4, page_size=3)
+
+    # validate every image under the prefix was written exactly once
+    assert sorted(written) == [f'images/{index}.png' for index in range(5)]
+    assert second_run['complete']
+    assert second_run['objects_listed'] == 7
+    assert second_run['records_written'] == 5
+    assert second_run['failed_keys'] == ['images/notes.txt']
+
+    # a completed backfill does nothing when run again
+    with patch('lambda_code.backfill.write_batch_to_rds') as mock_write:
+        backfill(s3_client, 'test-bucket', 'images/', mock_logger, checkpoint_path=checkpoint_path)
+        mock_write.assert_not_called()
@@ -0,0 +1,67 @@
+import os
+import platform
+import subprocess
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'scripts'))
+
+import build_layer
+from lambda_code.utils import PILLOW_PLUGINS
+
+
+# write the files of a fake installed distribution and its RECORD
+def make_distribution(target, name, paths):
+    for path in paths:
+        os.makedirs(os.path.join(target, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(target, path), 'w') as source:
+            source.write('')
+    dist_info = os.path.join(target, f"{name}-1.0.dist-info")
+    os.makedirs(dist_info)
+    with open(os.path.join(dist_info, 'RECORD'), 'w') as record:
+        record.writelines(f"{path},,\n" for path in paths + [f"{name}-1.0.dist-info/RECORD"])
+
+
+# test only the top level test suites of installed packages are removed, runtime subpackages named like them are kept
+def test_strip_packages_keeps_runtime_subpackages(tmp_path):
+    target = str(tmp_path)
+    make_distribution(target, 'numpy', [
+        'numpy/__init__.py', 'numpy/tests/test_core.py', 'numpy/testing/__init__.py', 'numpy/core/tests/__init__.py',
+        'numpy/doc/__init__.py', 'numpy/core/include/numpy.h', 'numpy/__init__.pyi',
+    ])
+    make_distribution(target, 'boto3', ['boto3/__init__.py'])
+
+    removed = build_layer.strip_packages(target)
+
+    assert sorted(removed) == ['boto3', 'boto3-1.0.dist-info', os.path.join('numpy', '__init__.pyi'), os.path.join('numpy', 'core', 'include', 'numpy.h'), os.path.join('numpy', 'tests')]
+    for package in ('numpy/testing', 'numpy/doc', 'numpy/core/tests'):
+        assert os.path.exists(os.path.join(target, package, '__init__.py'))
+
+
+# install and strip the layer for this interpreter and machine, skipped when the wheels cannot be installed
+@pytest.fixture(scope="module")
+def layer_target(tmp_path_factory):
+    architecture = next((name for name, machines in build_layer.MACHINES.items() if platform.machine().lower() in machines), None)
+    if architecture is None:
+        pytest.skip(f"no lambda architecture for {platform.machine()}")
+    target = str(tmp_path_factory.mktemp("layer") / "python")
+    python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    try:
+        build_layer.install_requirements(target, os.path.join(build_layer.PROJECT_ROOT, 'requirements-lambda.txt'), [], architecture, python_version)
+    except subprocess.CalledProcessError:
+        pytest.skip("the layer requirements could not be installed")
+    build_layer.strip_packages(target)
+    build_layer.strip_pillow(target)
+    return target
+
+
+# test every packaged library, and the pillow plugins the lambda opens images with, import from the stripped layer alone
+def test_layer_packages_import(layer_target):
+    packages = [folder for folder in build_layer.get_distribution_folders(layer_target) if os.path.exists(os.path.join(layer_target, folder, '__init__.py'))]
+    modules = packages + ['PIL.Image'] + [f"PIL.{plugin}" for plugin in PILLOW_PLUGINS]
+    assert {'PIL', 'pymysql'} <= set(packages)
+
+    # -S leaves out the site packages of this interpreter so only the layer is imported
+    result = subprocess.run([sys.executable, '-S', '-c', f"import {', '.join(modules)}"],
+        env=dict(os.environ, PYTHONPATH=layer_target), capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
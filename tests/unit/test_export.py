@@ -0,0 +1,158 @@
+import csv
+import gzip
+import io
+import json
+import boto3
+import pyarrow
+import pyarrow.parquet
+import pymysql
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from lambda_code.export import export_image_metadata, get_high_water_mark_key, EXPORT_COLUMNS
+from lambda_code.s3_helpers import MultipartUploadWriter
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+@pytest.fixture
+def s3_client():
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='analytics')
+        yield s3_client
+
+
+# rows are exported in updated_at order, the extraction timestamp is an hour before the write
+def make_row(image_id, updated_at, is_valid=None):
+    return (image_id, image_id.split('/')[-1], 100, 'image/png', 10, 20, updated_at - timedelta(hours=1), 'etag', None, None,
+            None, None, is_valid, None, updated_at)
+
+
+# stand-in for a server side cursor handing out the given rows in batches, fail_after raises after that many batches
+def make_manager(rows, fail_after=None):
+    cursor = MagicMock()
+    cursor.__enter__.return_value = cursor
+    batches = iter([rows[index:index + 2] for index in range(0, len(rows), 2)] + [[]])
+
+    def fetchmany(size):
+        if fail_after is not None and cursor.fetchmany.call_count > fail_after:
+            raise pymysql.OperationalError(2013, 'Lost connection to MySQL server during query')
+        return next(batches)
+
+    cursor.fetchmany.side_effect = fetchmany
+    connection = MagicMock()
+    connection.cursor.return_value = cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = connection
+    return manager, cursor
+
+
+# read the rows of a csv.gz export object
+def read_export(s3_client, object_key):
+    body = s3_client.get_object(Bucket='analytics', Key=object_key)['Body'].read()
+    return list(csv.reader(io.StringIO(gzip.decompress(body).decode('utf-8'))))
+
+
+# test the rows are streamed into one object per day and the high water mark is stored
+def test_export_partitions_by_day(s3_client, mock_logger):
+    rows = [
+        make_row('images/a.png', datetime(2024, 5, 1, 10)),
+        make_row('images/b.png', datetime(2024, 5, 1, 11)),
+        make_row('images/c.png', datetime(2024, 5, 2, 9, 30, 0, 250)),
+    ]
+    manager, cursor = make_manager(rows)
+
+    totals = export_image_metadata(s3_client, 'analytics', 'exports/', mock_logger, export_format='csv', manager=manager)
+
+    assert totals['complete'] and totals['rows'] == 3
+    sql, args = cursor.execute.call_args.args
+    assert 'WHERE updated_at < NOW(6) - INTERVAL %s SECOND ORDER BY updated_at, image_id' in sql and args == (60,)
+    manager.get_connection.return_value.cursor.assert_called_once_with(pymysql.cursors.SSCursor)
+    first_day, second_day = totals['objects']
+    assert first_day.startswith('exports/date=2024-05-01/') and first_day.endswith('.csv.gz')
+    assert second_day.startswith('exports/date=2024-05-02/')
+    first_rows = read_export(s3_client, first_day)
+    assert first_rows[0] == EXPORT_COLUMNS
+    assert [row[0] for row in first_rows[1:]] == ['images/a.png', 'images/b.png']
+    assert read_export(s3_client, second_day)[1][-1] == '2024-05-02T09:30:00.000250'
+
+    high_water_mark = json.loads(s3_client.get_object(Bucket='analytics', Key=get_high_water_mark_key('exports/'))['Body'].read())
+    assert high_water_mark['updated_at'] == '2024-05-02 09:30:00.000250'
+    assert high_water_mark['image_id'] == 'images/c.png'
+
+
+# test the next run only reads the rows after the high water mark
+def test_export_is_incremental(s3_client, mock_logger):
+    manager, _ = make_manager([make_row('images/a.png', datetime(2024, 5, 1, 10))])
+    export_image_metadata(s3_client, 'analytics', 'exports/', mock_logger, export_format='csv', manager=manager)
+
+    manager, cursor = make_manager([])
+    totals = export_image_metadata(s3_client, 'analytics', 'exports/', mock_logger, export_format='csv', manager=manager)
+
+    sql, args = cursor.execute.call_args.args
+    assert "(updated_at > %s OR (updated_at = %s AND image_id > %s))" in sql
+    assert args[1:] == ('2024-05-01 10:00:00', '2024-05-01 10:00:00', 'images/a.png')
+    assert totals['complete'] and totals['objects'] == []
+
+
+# test the parquet export keeps the column types, with the 0 and 1 mysql returns for booleans
+def test_export_parquet(s3_client, mock_logger):
+    manager, _ = make_manager([
+        make_row('images/a.png', datetime(2024, 5, 1, 10), is_valid=1),
+        make_row('images/b.png', datetime(2024, 5, 1, 11), is_valid=0),
+        make_row('images/c.png', datetime(2024, 5, 1, 12)),
+    ])
+
+    totals = export_image_metadata(s3_client, 'analytics', 'exports/', mock_logger, export_format='parquet', manager=manager)
+
+    assert totals['complete'] and totals['objects'][0].endswith('.parquet')
+    body = s3_client.get_object(Bucket='analytics', Key=totals['objects'][0])['Body'].read()
+    table = pyarrow.parquet.read_table(pyarrow.BufferReader(body))
+    assert table.column('is_valid').to_pylist() == [True, False, None]
+    assert table.column('file_size').type == pyarrow.int64()
+    assert table.column('updated_at').to_pylist()[0] == datetime(2024, 5, 1, 10)
+
+
+# test a failed run removes what it wrote and leaves the high water mark alone
+def test_export_failure_removes_partial_objects(s3_client, mock_logger):
+    rows = [make_row(f'images/{index}.png', datetime(2024, 5, 1 + index // 2, 10, index)) for index in range(6)]
+    manager, _ = make_manager(rows, fail_after=2)
+
+    totals = export_image_metadata(s3_client, 'analytics', 'exports/', mock_logger, export_format='csv', manager=manager)
+
+    assert not totals['complete'] and totals['rows'] == 4
+    assert s3_client.list_objects_v2(Bucket='analytics').get('KeyCount') == 0
+    assert s3_client.list_multipart_uploads(Bucket='analytics').get('Uploads', []) == []
+    # the manager was passed in, so it is left open for the caller
+    manager.close.assert_not_called()
+    manager.get_connection.return_value.rollback.assert_called_once()
+
+
+# test a failed run closes the manager it created itself
+def test_export_failure_closes_own_manager(s3_client, mock_logger):
+    manager, _ = make_manager([make_row('images/a.png', datetime(2024, 5, 1, 10))], fail_after=0)
+
+    with patch("lambda_code.export.ConnectionManager", return_value=manager):
+        totals = export_image_metadata(s3_client, 'analytics', 'exports/', mock_logger, export_format='csv')
+
+    assert not totals['complete']
+    manager.close.assert_called_once()
+
+
+# test the writer uploads full parts as they fill up and the rest as the last part
+def test_multipart_upload_writer(s3_client):
+    writer = MultipartUploadWriter(s3_client, 'analytics', 'big.bin', part_size=5 * 1024 * 1024)
+    chunk = bytes(range(256)) * 4096
+    for _ in range(6):
+        writer.write(chunk)
+    writer.close()
+
+    assert len(writer.parts) == 2
+    assert s3_client.get_object(Bucket='analytics', Key='big.bin')['Body'].read() == chunk * 6
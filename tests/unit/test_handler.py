@@ -0,0 +1,265 @@
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import boto3
+import pytest
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from PIL import Image
+from lambda_code.lambda_function import handler, processed_etags, DEFAULT_PROCESSED_CACHE_TTL_SECONDS
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.lambda_function.create_logger") as mock_create_logger:
+        yield mock_create_logger.return_value
+
+
+# build an s3 event with one record per object key
+def make_s3_event(object_keys):
+    return {
+        "Records": [
+            {"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": object_key}}}
+            for object_key in object_keys
+        ]
+    }
+
+
+# return fake metadata for a record
+def fake_extract_metadata(s3_response, s3_file_contents, object_key, logger, image_size=None, image=None):
+    return {'imageId': object_key}
+
+
+# test the handler writes the metadata of every record in one batch and isolates failing records
+@pytest.mark.parametrize("workers", ['1', '4'])
+def test_handler_processes_records(mock_logger, monkeypatch, workers):
+    monkeypatch.setenv('RECORD_WORKERS', workers)
+    object_keys = [f'images/sample-{index}.jpg' for index in range(6)]
+
+    # fail the fetch of one record
+    def fake_fetch(s3_client, bucket_name, object_key, logger):
+        if object_key == 'images/sample-2.jpg':
+            raise RuntimeError("connection reset")
+        return {'ContentLength': 12}, b'fake_image_data'
+
+    with patch('boto3.client'), \
+         patch('lambda_code.lambda_function.fetch_file_contents', side_effect=fake_fetch), \
+         patch('lambda_code.lambda_function.extract_metadata', side_effect=fake_extract_metadata), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', return_value=([], [])) as mock_write:
+
+        response = handler(make_s3_event(object_keys))
+
+    assert response['statusCode'] == 200
+    # check the remaining records are written in the order of the event
+    written_metadata = mock_write.call_args.args[0]
+    assert [image_metadata['imageId'] for image_metadata in written_metadata] == [
+        object_key for object_key in object_keys if object_key != 'images/sample-2.jpg'
+    ]
+    errors = [call.args[0] % call.args[1:] for call in mock_logger.error.call_args_list]
+    assert "Error processing file images/sample-2.jpg: connection reset..." in errors
+
+
+# test records are fetched concurrently and never by more threads than configured
+def test_handler_bounds_concurrency(mock_logger, monkeypatch):
+    monkeypatch.setenv('RECORD_WORKERS', '3')
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    # simulate a slow s3 fetch while tracking how many run at once
+    def slow_fetch(s3_client, bucket_name, object_key, logger):
+        nonlocal active, peak
+        with lock:
+            active += 1
+            peak = max(peak, active)
+        time.sleep(0.05)
+        with lock:
+            active -= 1
+        return {'ContentLength': 12}, b'fake_image_data'
+
+    with patch('boto3.client'), \
+         patch('lambda_code.lambda_function.fetch_file_contents', side_effect=slow_fetch), \
+         patch('lambda_code.lambda_function.extract_metadata', side_effect=fake_extract_metadata), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', return_value=([], [])):
+
+        handler(make_s3_event([f'images/sample-{index}.jpg' for index in range(9)]))
+
+    assert peak == 3
+
+
+# convert messages received from sqs into the event lambda sends when consuming the queue
+def make_sqs_event(messages):
+    return {
+        "Records": [
+            {"messageId": message['MessageId'], "body": message['Body'], "eventSource": "aws:sqs"}
+            for message in messages
+        ]
+    }
+
+
+# test s3 notifications buffered in sqs are processed and only failed messages are reported
+@mock_aws
+def test_handler_sqs_batch_item_failures(mock_logger):
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    sqs_client = boto3.client('sqs', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test-bucket')
+    queue_url = sqs_client.create_queue(QueueName='ingest-queue')['QueueUrl']
+
+    # upload one valid image, the notification of the second points at an object that does not exist
+    image_buffer = io.BytesIO()
+    Image.new('RGB', (64, 32)).save(image_buffer, format='PNG')
+    s3_client.put_object(Bucket='test-bucket', Key='images/good.png', Body=image_buffer.getvalue(), ContentType='image/png')
+
+    # queue the s3 notifications the way s3 sends them to sqs, plus the test event sent when the notification is set up
+    for object_key in ['images/good.png', 'images/missing.png']:
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps(make_s3_event([object_key])))
+    sqs_client.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'Service': 'Amazon S3', 'Event': 's3:TestEvent'}))
+    messages = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
+    message_ids = {json.loads(message['Body']).get('Records', [{}])[0].get('s3', {}).get('object', {}).get('key'): message['MessageId'] for message in messages}
+
+    with patch('lambda_code.db_helpers.write_batch_to_rds', return_value=(['images/good.png'], [])) as mock_write:
+        response = handler(make_sqs_event(messages))
+
+    # check the valid image was written and only the message of the missing object is retried
+    assert [image_metadata['imageId'] for image_metadata in mock_write.call_args.args[0]] == ['images/good.png']
+    assert mock_write.call_args.args[0][0]['width'] == 64
+    assert response == {'batchItemFailures': [{'itemIdentifier': message_ids['images/missing.png']}]}
+
+
+# test messages are reported as failed when their record could not be written to rds
+def test_handler_sqs_write_failures(mock_logger):
+    messages = [
+        {'MessageId': 'message-1', 'Body': json.dumps(make_s3_event(['images/a.jpg']))},
+        {'MessageId': 'message-2', 'Body': json.dumps(make_s3_event(['images/b.jpg']))},
+        {'MessageId': 'message-3', 'Body': 'not json'},
+    ]
+
+    with patch('boto3.client'), \
+         patch('lambda_code.lambda_function.fetch_file_contents', return_value=({'ContentLength': 12}, b'fake_image_data')), \
+         patch('lambda_code.lambda_function.extract_metadata', side_effect=fake_extract_metadata), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', return_value=(['images/a.jpg'], ['images/b.jpg'])):
+
+        response = handler(make_sqs_event(messages))
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'message-3'}, {'itemIdentifier': 'message-2'}]}
+
+
+# build an s3 record with the etag and sequencer s3 puts in its notifications
+def make_s3_record(object_key, etag, sequencer):
+    return {"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": object_key, "eTag": etag, "sequencer": sequencer}}}
+
+
+# test duplicate notifications within a batch collapse to the latest sequencer
+def test_handler_collapses_duplicate_records(mock_logger):
+    event = {"Records": [
+        make_s3_record('images/a.jpg', 'etag-2', '0055AED6DCD9028C3B'),
+        make_s3_record('images/b.jpg', 'etag-1', '0055AED6DCD90281E5'),
+        # the shorter sequencer is compared as if padded with leading zeros
+        make_s3_record('images/a.jpg', 'etag-1', '55AED6DCD9028C3A'),
+    ]}
+
+    with patch('boto3.client'), \
+         patch('lambda_code.lambda_function.fetch_file_contents', return_value=({'ContentLength': 12}, b'fake_image_data')) as mock_fetch, \
+         patch('lambda_code.lambda_function.extract_metadata', side_effect=fake_extract_metadata), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', return_value=([], [])) as mock_write:
+
+        handler(event)
+
+    # check each object was fetched once and the sequencer of the latest notification is kept
+    assert [call.args[2] for call in mock_fetch.call_args_list] == ['images/a.jpg', 'images/b.jpg']
+    assert [image_metadata['sequencer'] for image_metadata in mock_write.call_args.args[0]] == ['0055AED6DCD9028C3B', '0055AED6DCD90281E5']
+
+
+# test unchanged objects are skipped before their body is fetched
+def test_handler_skips_unchanged_objects(mock_logger, monkeypatch):
+    monkeypatch.setenv('SKIP_UNCHANGED_OBJECTS', 'true')
+    mock_s3_client = MagicMock()
+    # the notification of images/c.jpg has no etag, so the current one is read with a HEAD request
+    mock_s3_client.head_object.return_value = {'ETag': '"etag-c"'}
+    record_without_etag = make_s3_record('images/c.jpg', None, '01')
+    del record_without_etag['s3']['object']['eTag']
+
+    # return metadata with the etag of the fetched object
+    def extract_with_etag(s3_response, s3_file_contents, object_key, logger, image_size=None, image=None):
+        return {'imageId': object_key, 'etag': s3_response['ETag']}
+
+    with patch('boto3.client', return_value=mock_s3_client), \
+         patch('lambda_code.db_helpers.get_stored_etags', return_value={'images/a.jpg': 'etag-a', 'images/c.jpg': 'etag-c'}) as mock_stored, \
+         patch('lambda_code.lambda_function.fetch_file_contents', side_effect=lambda s3_client, bucket_name, object_key, logger: ({'ETag': 'etag-new'}, b'data')) as mock_fetch, \
+         patch('lambda_code.lambda_function.extract_metadata', side_effect=extract_with_etag), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', side_effect=lambda metadata, logger: ([m['imageId'] for m in metadata], [])):
+
+        # images/a.jpg is unchanged in rds, images/b.jpg changed, images/c.jpg is unchanged per the HEAD request
+        handler({"Records": [
+            make_s3_record('images/a.jpg', 'etag-a', '01'),
+            make_s3_record('images/b.jpg', 'etag-new', '01'),
+            record_without_etag,
+        ]})
+        assert [call.args[2] for call in mock_fetch.call_args_list] == ['images/b.jpg']
+        mock_s3_client.head_object.assert_called_once_with(Bucket='test-bucket', Key='images/c.jpg')
+
+        # a repeated notification for images/b.jpg is skipped from the in-process cache without asking rds
+        mock_fetch.reset_mock()
+        handler({"Records": [make_s3_record('images/b.jpg', 'etag-new', '02')]})
+        mock_fetch.assert_not_called()
+        assert mock_stored.call_args.args[0] == []
+
+
+# test an etag this container wrote is only trusted until it expires, after that the etag in rds decides
+def test_handler_processed_etags_expire(mock_logger, monkeypatch):
+    from lambda_code import cache_helpers
+    monkeypatch.setenv('SKIP_UNCHANGED_OBJECTS', 'true')
+    now = [100.0]
+    monkeypatch.setattr(cache_helpers.time, 'monotonic', lambda: now[0])
+    processed_etags.put('images/a.jpg', 'etag-a')
+
+    with patch('boto3.client', return_value=MagicMock()), \
+         patch('lambda_code.db_helpers.get_stored_etags', return_value={}) as mock_stored, \
+         patch('lambda_code.lambda_function.fetch_file_contents', return_value=({'ETag': 'etag-a'}, b'data')) as mock_fetch, \
+         patch('lambda_code.lambda_function.extract_metadata', return_value={'imageId': 'images/a.jpg', 'etag': 'etag-a'}), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', return_value=(['images/a.jpg'], [])):
+
+        handler({"Records": [make_s3_record('images/a.jpg', 'etag-a', '01')]})
+        mock_fetch.assert_not_called()
+
+        # another container wrote a newer version in the meantime, rds no longer holds etag-a
+        mock_stored.return_value = {'images/a.jpg': 'etag-b'}
+        now[0] += DEFAULT_PROCESSED_CACHE_TTL_SECONDS
+        handler({"Records": [make_s3_record('images/a.jpg', 'etag-a', '02')]})
+        assert mock_stored.call_args.args[0] == ['images/a.jpg']
+        mock_fetch.assert_called_once()
+
+
+# test the warmup creates the clients and opens the rds connection that later invocations reuse
+def test_warmup_prepares_clients_and_connection(mock_logger):
+    from lambda_code import db_helpers, lambda_function
+    mock_connection = MagicMock()
+
+    with patch('boto3.client') as mock_boto_client, \
+         patch('lambda_code.db_helpers.get_rds_credentials', return_value=('username', 'password', 'host', 'dbname')), \
+         patch('pymysql.connect', return_value=mock_connection) as mock_connect:
+
+        lambda_function.warmup(mock_logger)
+        handler({"Records": []})
+
+        # check the s3 client and the connection were created once and reused by the invocation
+        mock_boto_client.assert_called_once_with('s3')
+        mock_connect.assert_called_once()
+        assert db_helpers.connection_manager.connection is mock_connection
+
+
+# test importing the handler leaves boto3, pymysql and the optional helpers to the code paths that need them
+def test_handler_import_is_lazy():
+    check = (
+        "import sys, lambda_code.lambda_function; "
+        "print(','.join(sorted(name for name in ('boto3', 'pymysql', 'lambda_code.db_helpers', 'lambda_code.spool_helpers', "
+        "'lambda_code.rendition_helpers', 'lambda_code.verify_helpers') if name in sys.modules)))"
+    )
+    project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    result = subprocess.run([sys.executable, '-c', check], capture_output=True, text=True, check=True, cwd=project_root)
+    assert result.stdout.strip() == ''
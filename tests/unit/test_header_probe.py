@@ -0,0 +1,111 @@
+import io
+import boto3
+import pytest
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from PIL import Image
+from lambda_code.s3_helpers import probe_image_size
+from lambda_code.utils import INCOMPLETE_HEADER, parse_image_header
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create an in memory image of the given format and size using pillow
+def make_image(image_format, width, height, **save_kwargs):
+    buffer = io.BytesIO()
+    mode = 'RGB' if image_format != 'GIF' else 'P'
+    Image.new(mode, (width, height)).save(buffer, format=image_format, **save_kwargs)
+    return buffer.getvalue()
+
+
+# test the header parsers against images written by pillow
+@pytest.mark.parametrize("image_format, save_kwargs", [
+    ('PNG', {}),
+    ('JPEG', {}),
+    ('JPEG', {'progressive': True}),
+    ('GIF', {}),
+    ('BMP', {}),
+    ('TIFF', {}),
+    ('WEBP', {}),
+    ('WEBP', {'lossless': True}),
+])
+def test_parse_image_header(image_format, save_kwargs):
+    image_bytes = make_image(image_format, 321, 123, **save_kwargs)
+
+    # validate the dimensions match the ones pillow reports
+    assert parse_image_header(image_bytes) == (321, 123)
+
+
+# test a jpeg whose frame header sits behind a large metadata segment
+def test_parse_image_header_late_jpeg_sof():
+    image_bytes = make_image('JPEG', 640, 480)
+    # insert a 60KB application segment right after the start of image marker
+    padding = b'\xff\xe2' + (60002).to_bytes(2, 'big') + b'\x00' * 60000
+    image_bytes = image_bytes[:2] + padding + image_bytes[2:]
+
+    # the first few KB are not enough to find the frame header
+    assert parse_image_header(image_bytes[:16384]) == INCOMPLETE_HEADER
+    assert parse_image_header(image_bytes) == (640, 480)
+
+
+# test unknown formats are reported as unsupported
+def test_parse_image_header_unsupported():
+    assert parse_image_header(b'this is not an image file') is None
+
+
+# test probing widens the range until the dimensions are found and reports the full object size
+@mock_aws
+def test_probe_image_size_widens_range(mock_logger):
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test-bucket')
+
+    image_bytes = make_image('JPEG', 640, 480)
+    padding = b'\xff\xe2' + (60002).to_bytes(2, 'big') + b'\x00' * 60000
+    image_bytes = image_bytes[:2] + padding + image_bytes[2:]
+    s3_client.put_object(Bucket='test-bucket', Key='images/late.jpg', Body=image_bytes, ContentType='image/jpeg')
+
+    with patch.object(s3_client, 'get_object', wraps=s3_client.get_object) as mock_get_object:
+        s3_response, width, height = probe_image_size(s3_client, 'test-bucket', 'images/late.jpg', mock_logger)
+
+    # validate the dimensions and the size of the whole object
+    assert (width, height) == (640, 480)
+    assert s3_response['ContentLength'] == len(image_bytes)
+    assert s3_response['ContentType'] == 'image/jpeg'
+    # the first range was too small, the second one only read the bytes after it and contained the frame header
+    first_call, second_call = mock_get_object.call_args_list
+    assert (first_call.kwargs['Range'], second_call.kwargs['Range']) == ('bytes=0-16383', 'bytes=16384-65535')
+    assert second_call.kwargs['IfMatch'] == s3_response['ETag']
+
+
+# test any error while probing falls back to a full fetch
+def test_probe_image_size_falls_back_on_any_error(mock_logger):
+    mock_s3_client = MagicMock()
+    mock_s3_client.get_object.return_value = {
+        'Body': MagicMock(read=MagicMock(side_effect=ConnectionResetError("Connection reset by peer"))),
+        'ContentRange': 'bytes 0-16383/5000000',
+    }
+
+    assert probe_image_size(mock_s3_client, 'test-bucket', 'images/sample.jpg', mock_logger) == (None, None, None)
+
+
+# test probing gives up on formats the header parsers do not support
+def test_probe_image_size_unsupported_format(mock_logger):
+    mock_s3_client = MagicMock()
+    mock_s3_client.get_object.return_value = {
+        'Body': MagicMock(read=MagicMock(return_value=b'x' * 16384)),
+        'ContentRange': 'bytes 0-16383/5000000',
+        'ContentLength': 16384,
+        'ContentType': 'image/heic'
+    }
+
+    s3_response, width, height = probe_image_size(mock_s3_client, 'test-bucket', 'images/sample.heic', mock_logger)
+
+    # check the caller is told to fall back to a full fetch
+    assert s3_response is None
+    assert width is None
+    assert height is None
@@ -5,7 +5,8 @@ from unittest.mock import patch, MagicMock
 from lambda_code.s3_helpers import fetch_file_contents
 from lambda_code.utils import extract_metadata
 from lambda_code.utils import get_image_size
-from lambda_code.db_helpers import get_rds_credentials, write_to_rds
+from lambda_code.db_helpers import get_rds_credentials, write_to_rds, write_batch_to_rds, ConnectionManager, get_credential_cache_stats
+import pymysql
 from botocore.exceptions import ClientError
 
 
@@ -34,7 +35,7 @@ def test_fetch_file_contents_success(mock_logger):
     # validate the respoonse
     assert response['Body'].read() == b'test_image_content'
     assert content == b'test_image_content'
-    mock_logger.info.assert_called_with("File test-key read successfully from test-bucket... Size: 18 bytes...")
+    mock_logger.info.assert_called_with("File %s read successfully from %s... Size: %s bytes...", "test-key", "test-bucket", 18)
 
 
 # test fetch_file_contents with access denied
@@ -52,7 +53,7 @@ def test_fetch_file_contents_access_denied(mock_logger):
     # check the response is None
     assert response is None
     assert content is None
-    mock_logger.error.assert_called_with("Access denied for test-key in test-bucket...")
+    mock_logger.error.assert_called_with("Access denied for %s in %s...", "test-key", "test-bucket")
 
 
 # test extract_metadata
@@ -109,7 +110,7 @@ def test_extract_metadata_with_none_values(mock_logger):
 
     # check metadata extraction failed
     assert metadata is None  
-    mock_logger.error.assert_called_with(f"Skipping {mock_object_key} due to image metadata extraction failure...")
+    mock_logger.error.assert_called_with("Skipping %s due to image metadata extraction failure...", mock_object_key)
 
 
 # test get_image_size with error
@@ -124,7 +125,8 @@ def test_get_image_size_error(mock_logger):
         # ensure height and width are none 
         assert width == None
         assert height == None
-        mock_logger.error.assert_called_with("Error getting image size: Cannot identify image file...")
+        message, *args = mock_logger.error.call_args.args
+        assert message % tuple(args) == "Error getting image size: Cannot identify image file..."
 
 
 # test get rds creds
@@ -155,7 +157,53 @@ def test_get_rds_credentials(mock_logger):
         assert password == 'test_pass'
         assert host == 'test_host'
         assert dbname == 'test_db'
-        mock_logger.info.assert_called_with(f"Done getting RDS credentials from {secret_name}...")
+        mock_logger.info.assert_called_with("Done getting RDS credentials from %s...", secret_name)
+
+
+# test rds credentials are cached until the ttl expires
+def test_get_rds_credentials_cached(mock_logger, monkeypatch):
+    monkeypatch.setenv('RDS_SECRET_TTL_SECONDS', '300')
+    mock_secrets_client = MagicMock()
+    mock_secrets_client.get_secret_value.return_value = {
+        'SecretString': json.dumps({'username': 'test_user', 'password': 'test_pass', 'host': 'test_host', 'dbname': 'test_db'})
+    }
+    stats_before = get_credential_cache_stats()
+
+    with patch('boto3.client', return_value=mock_secrets_client), \
+         patch('lambda_code.db_helpers.time.monotonic', side_effect=[1000, 1100, 1290, 1290, 1400]):
+        # first call misses the cache
+        assert get_rds_credentials('test-secret', mock_logger) == ('test_user', 'test_pass', 'test_host', 'test_db')
+        # 100 seconds later the cached credentials are served
+        get_rds_credentials('test-secret', mock_logger)
+        # 290 seconds later the credentials are about to expire and are refreshed ahead of time
+        get_rds_credentials('test-secret', mock_logger)
+        # 110 seconds after the refresh they are still fresh
+        get_rds_credentials('test-secret', mock_logger)
+
+    # check secrets manager was only called for the miss and the refresh
+    assert mock_secrets_client.get_secret_value.call_count == 2
+    stats_after = get_credential_cache_stats()
+    assert stats_after['misses'] - stats_before['misses'] == 1
+    assert stats_after['hits'] - stats_before['hits'] == 2
+    assert stats_after['refreshes'] - stats_before['refreshes'] == 1
+
+
+# test rotated credentials are refetched once when rds rejects the cached password
+def test_connection_manager_refetches_rotated_credentials(mock_logger):
+    mock_connection = MagicMock()
+    manager = ConnectionManager('test-secret')
+    access_denied = pymysql.OperationalError(1045, "Access denied for user 'dbadmin'")
+
+    with patch('lambda_code.db_helpers.fetch_rds_credentials', side_effect=[
+            ('username', 'old_password', 'host', 'dbname'),
+            ('username', 'new_password', 'host', 'dbname')]) as mock_fetch, \
+         patch('pymysql.connect', side_effect=[access_denied, mock_connection]) as mock_connect:
+
+        assert manager.get_connection(mock_logger) is mock_connection
+
+        # check the secret was fetched again and the new password was used
+        assert mock_fetch.call_count == 2
+        assert mock_connect.call_args.kwargs['password'] == 'new_password'
 
 
 # test write_to_rds
@@ -195,6 +243,201 @@ def test_write_to_rds(mock_logger):
         # check commit was called
         mock_connection.commit.assert_called_once()
 
+
+# test write_batch_to_rds with a failing chunk
+def test_write_batch_to_rds(mock_logger):
+    # define five metadata records to be written in chunks of two
+    mock_metadata_list = [{
+        'imageId': f'images/test-{index}.jpg',
+        'fileName': f'test-{index}.jpg',
+        'fileSize': 12345,
+        'fileType': 'image/jpeg',
+        'width': 100,
+        'height': 200,
+        'timestamp': '2024-01-01T00:00:00.000000'
+    } for index in range(5)]
+
+    # mock the db connection and cursor
+    mock_connection = MagicMock()
+    mock_cursor = MagicMock()
+    mock_cursor.__enter__.return_value = mock_cursor
+    mock_connection.cursor.return_value = mock_cursor
+    # fail the second chunk
+    mock_cursor.executemany.side_effect = [None, pymysql.MySQLError("Lock wait timeout exceeded"), None]
+
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=('username', 'password', 'host', 'dbname')), \
+         patch('pymysql.connect', return_value=mock_connection) as mock_connect:
+
+        # call the function
+        written_ids, failed_ids = write_batch_to_rds(mock_metadata_list, mock_logger, batch_size=2)
+
+        # validate the failed chunk is reported and the other chunks are written
+        assert written_ids == ['images/test-0.jpg', 'images/test-1.jpg', 'images/test-4.jpg']
+        assert failed_ids == ['images/test-2.jpg', 'images/test-3.jpg']
+        # check a single connection was used with one transaction per chunk
+        mock_connect.assert_called_once()
+        assert mock_cursor.executemany.call_count == 3
+        assert mock_connection.commit.call_count == 2
+        mock_connection.rollback.assert_called_once()
+        # check the rows are passed in column order
+        assert mock_cursor.executemany.call_args_list[0].args[1][0] == (
+            'images/test-0.jpg', 'test-0.jpg', 12345, 'image/jpeg', 100, 200, '2024-01-01T00:00:00.000000', None, None, None, None, None, None, None
+        )
+
+
+# test write_batch_to_rds without credentials
+def test_write_batch_to_rds_missing_credentials(mock_logger):
+    mock_metadata_list = [{'imageId': 'images/a.jpg'}, {'imageId': 'images/b.jpg'}]
+
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=(None, None, None, None)), \
+         patch('pymysql.connect') as mock_connect:
+
+        written_ids, failed_ids = write_batch_to_rds(mock_metadata_list, mock_logger)
+
+        # check nothing was written and no connection was attempted
+        assert written_ids == []
+        assert failed_ids == ['images/a.jpg', 'images/b.jpg']
+        mock_connect.assert_not_called()
+
+# test the connection is reused across warm invocations
+def test_connection_manager_reuses_connection(mock_logger):
+    mock_connection = MagicMock()
+    manager = ConnectionManager()
+
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=('username', 'password', 'host', 'dbname')), \
+         patch('pymysql.connect', return_value=mock_connection) as mock_connect:
+
+        # simulate two invocations writing metadata
+        write_to_rds({'imageId': 'images/a.jpg'}, mock_logger, manager=manager)
+        write_to_rds({'imageId': 'images/b.jpg'}, mock_logger, manager=manager)
+
+        # check only one handshake was made and the connection was health checked before reuse
+        mock_connect.assert_called_once()
+        mock_connection.ping.assert_called_once_with(reconnect=False)
+        mock_connection.close.assert_not_called()
+        assert manager.get_stats()['handshakes'] == 1
+        assert manager.get_stats()['reused'] == 1
+
+
+# test the connection goes to RDS_ENDPOINT when it is set, and shards keep the host of their own secret
+def test_connection_manager_connects_to_rds_endpoint(mock_logger, monkeypatch):
+    monkeypatch.setenv('RDS_ENDPOINT', 'proxy.example.com')
+
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=('username', 'password', 'instance.example.com', 'dbname')), \
+         patch('pymysql.connect') as mock_connect:
+
+        ConnectionManager().connect(mock_logger)
+        assert mock_connect.call_args.kwargs['host'] == 'proxy.example.com'
+
+        ConnectionManager('shard-secret').connect(mock_logger)
+        assert mock_connect.call_args.kwargs['host'] == 'instance.example.com'
+
+        monkeypatch.delenv('RDS_ENDPOINT')
+        ConnectionManager().connect(mock_logger)
+        assert mock_connect.call_args.kwargs['host'] == 'instance.example.com'
+
+
+# test a stale connection is replaced with a new one
+def test_connection_manager_reconnects_stale_connection(mock_logger):
+    stale_connection = MagicMock()
+    stale_connection.ping.side_effect = pymysql.OperationalError(2006, "MySQL server has gone away")
+    fresh_connection = MagicMock()
+    manager = ConnectionManager()
+
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=('username', 'password', 'host', 'dbname')), \
+         patch('pymysql.connect', side_effect=[stale_connection, fresh_connection]):
+
+        # the first call opens the connection, the second finds it dead
+        assert manager.get_connection(mock_logger) is stale_connection
+        assert manager.get_connection(mock_logger) is fresh_connection
+
+        stale_connection.close.assert_called_once()
+        assert manager.get_stats()['reconnects'] == 1
+        assert manager.get_stats()['handshakes'] == 2
+
+
+# test a write is retried once when the connection drops mid statement
+def test_write_to_rds_retries_after_lost_connection(mock_logger):
+    broken_connection = MagicMock()
+    broken_cursor = MagicMock()
+    broken_cursor.__enter__.return_value = broken_cursor
+    broken_cursor.execute.side_effect = pymysql.OperationalError(2013, "Lost connection to MySQL server during query")
+    broken_connection.cursor.return_value = broken_cursor
+    fresh_connection = MagicMock()
+    manager = ConnectionManager()
+
+    with patch('lambda_code.db_helpers.get_rds_credentials', return_value=('username', 'password', 'host', 'dbname')), \
+         patch('pymysql.connect', side_effect=[broken_connection, fresh_connection]):
+
+        write_to_rds({'imageId': 'images/a.jpg'}, mock_logger, manager=manager)
+
+        # check the write was committed on the new connection
+        fresh_connection.commit.assert_called_once()
+        mock_logger.info.assert_called_with("Metadata written to RDS successfully...")
+
+
+# test a statement error rolls the transaction back and keeps the connection for the next write
+def test_write_to_rds_rolls_back_on_error(mock_logger):
+    connection = MagicMock()
+    cursor = MagicMock()
+    cursor.__enter__.return_value = cursor
+    cursor.execute.side_effect = pymysql.IntegrityError(1048, "Column 'file_name' cannot be null")
+    connection.cursor.return_value = cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = connection
+
+    write_to_rds({'imageId': 'images/a.jpg'}, mock_logger, manager=manager)
+
+    connection.rollback.assert_called_once()
+    connection.commit.assert_not_called()
+    manager.close.assert_not_called()
+
+
+# test a statement error raised before a connection was handed out is logged without a rollback
+def test_write_to_rds_error_without_connection(mock_logger):
+    manager = MagicMock()
+    manager.get_connection.side_effect = pymysql.ProgrammingError(1049, "Unknown database 'metadataDB'")
+
+    write_to_rds({'imageId': 'images/a.jpg'}, mock_logger, manager=manager)
+
+    mock_logger.error.assert_called_once_with("Error writing metadata to RDS: %s", manager.get_connection.side_effect)
+
+
+# test a failed rollback closes the connection and the write's own error is still the one reported
+def test_write_to_rds_rollback_failure_keeps_write_error(mock_logger):
+    connection = MagicMock()
+    cursor = MagicMock()
+    cursor.__enter__.return_value = cursor
+    write_error = pymysql.IntegrityError(1048, "Column 'file_name' cannot be null")
+    cursor.execute.side_effect = write_error
+    connection.cursor.return_value = cursor
+    connection.rollback.side_effect = pymysql.InterfaceError(0, "")
+    manager = MagicMock()
+    manager.get_connection.return_value = connection
+
+    write_to_rds({'imageId': 'images/a.jpg'}, mock_logger, manager=manager)
+
+    manager.close.assert_called_once()
+    mock_logger.error.assert_called_with("Error writing metadata to RDS: %s", write_error)
+
+
+# test a failed rollback in a batch closes the connection and fails the remaining chunks instead of raising
+def test_write_batch_to_rds_rollback_failure(mock_logger):
+    connection = MagicMock()
+    cursor = MagicMock()
+    cursor.__enter__.return_value = cursor
+    cursor.executemany.side_effect = pymysql.IntegrityError(1048, "Column 'file_name' cannot be null")
+    connection.cursor.return_value = cursor
+    connection.rollback.side_effect = pymysql.InterfaceError(0, "")
+    manager = MagicMock()
+    manager.get_connection.return_value = connection
+
+    written_ids, failed_ids = write_batch_to_rds([{'imageId': 'images/a.jpg'}, {'imageId': 'images/b.jpg'}], mock_logger, batch_size=1, manager=manager)
+
+    assert (written_ids, failed_ids) == ([], ['images/a.jpg', 'images/b.jpg'])
+    assert cursor.executemany.call_count == 1
+    manager.close.assert_called_once()
+
 # NOTE: I had trouble getting the unit test for the handler to work, the issue seems to be with getting the image size function to work properly, this should be addressed at a later time 
 # def test_handler_success(mock_logger):
 #     with patch('boto3.client') as mock_boto_client, \
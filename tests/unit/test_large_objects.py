@@ -0,0 +1,106 @@
+import io
+import mmap
+import os
+import boto3
+import pytest
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from PIL import Image
+from lambda_code.s3_helpers import fetch_file_contents
+from lambda_code.utils import get_image_size, extract_metadata
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create a noisy png that does not compress much
+def make_png(width, height):
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (width, height), os.urandom(width * height * 3)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+# test large objects are downloaded in parallel parts to a memory mapped file that pillow reads in place
+@mock_aws
+def test_fetch_large_object_to_mapped_file(mock_logger, monkeypatch):
+    monkeypatch.setenv('LARGE_OBJECT_THRESHOLD_BYTES', str(100 * 1024))
+    monkeypatch.setenv('LARGE_OBJECT_PART_BYTES', str(64 * 1024))
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test-bucket')
+    image_bytes = make_png(400, 300)
+    s3_client.put_object(Bucket='test-bucket', Key='images/large.png', Body=image_bytes, ContentType='image/png')
+
+    with patch.object(s3_client, 'get_object', wraps=s3_client.get_object) as mock_get_object:
+        s3_response, contents = fetch_file_contents(s3_client, 'test-bucket', 'images/large.png', mock_logger)
+
+    # check the parts cover the whole object and the mapping holds the same bytes
+    ranges = sorted(call.kwargs['Range'] for call in mock_get_object.call_args_list if 'Range' in call.kwargs)
+    assert len(ranges) == -(-len(image_bytes) // (64 * 1024))
+    assert isinstance(contents, mmap.mmap)
+    assert contents[:] == image_bytes
+
+    # validate pillow reads the dimensions straight from the mapping
+    metadata = extract_metadata(s3_response, contents, 'images/large.png', mock_logger)
+    assert (metadata['width'], metadata['height']) == (400, 300)
+    assert metadata['fileSize'] == len(image_bytes)
+    contents.close()
+
+
+# test the parts are pinned to the object first read, and an object replaced during the download is fetched again
+@mock_aws
+def test_fetch_large_object_replaced_during_download(mock_logger, monkeypatch):
+    monkeypatch.setenv('LARGE_OBJECT_THRESHOLD_BYTES', str(100 * 1024))
+    monkeypatch.setenv('LARGE_OBJECT_PART_BYTES', str(64 * 1024))
+    # one part at a time so the object is replaced exactly once
+    monkeypatch.setenv('LARGE_OBJECT_WORKERS', '1')
+    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client.create_bucket(Bucket='test-bucket')
+    s3_client.put_object(Bucket='test-bucket', Key='images/large.png', Body=make_png(400, 300), ContentType='image/png')
+    new_bytes = make_png(300, 400)
+    get_object = s3_client.get_object
+    replaced = []
+
+    # overwrite the object once, right before the first part is read
+    def get_object_replaced_once(**kwargs):
+        if 'Range' in kwargs and not replaced:
+            replaced.append(s3_client.put_object(Bucket='test-bucket', Key='images/large.png', Body=new_bytes, ContentType='image/png'))
+        return get_object(**kwargs)
+
+    with patch.object(s3_client, 'get_object', side_effect=get_object_replaced_once) as mock_get_object:
+        s3_response, contents = fetch_file_contents(s3_client, 'test-bucket', 'images/large.png', mock_logger)
+
+    part_calls = [call.kwargs for call in mock_get_object.call_args_list if 'Range' in call.kwargs]
+    assert all(call['IfMatch'] for call in part_calls)
+    assert s3_response['ETag'] == replaced[0]['ETag']
+    assert contents[:] == new_bytes
+    contents.close()
+
+
+# test objects over the maximum size are rejected without reading their body
+def test_fetch_file_contents_rejects_oversized_object(mock_logger, monkeypatch):
+    monkeypatch.setenv('MAX_OBJECT_BYTES', '1000')
+    mock_body = MagicMock()
+    mock_s3_client = MagicMock()
+    mock_s3_client.get_object.return_value = {'Body': mock_body, 'ContentLength': 5000, 'ContentType': 'image/png'}
+
+    response, content = fetch_file_contents(mock_s3_client, 'test-bucket', 'images/huge.png', mock_logger)
+
+    assert response is None
+    assert content is None
+    mock_body.read.assert_not_called()
+
+
+# test decompression bombs are rejected from their header before any pixels are decoded
+def test_get_image_size_rejects_decompression_bomb(mock_logger, monkeypatch):
+    monkeypatch.setenv('MAX_IMAGE_PIXELS', str(100 * 100))
+    image_bytes = make_png(200, 200)
+
+    width, height = get_image_size(image_bytes, mock_logger)
+
+    assert width is None
+    assert height is None
+    mock_logger.error.assert_called_with("Image of %sx%s pixels is over the limit of %s pixels...", 200, 200, 10000)
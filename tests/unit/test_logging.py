@@ -0,0 +1,91 @@
+import io
+import json
+import logging
+import threading
+import pytest
+from lambda_code import logging_helpers
+from lambda_code.logging_helpers import create_logger, flush_logs, reset_logging, set_object_key, set_request_id
+
+
+# point the root logger at a buffer and restore it after the test
+# the handlers are replaced inside the test, pytest adds its own capturing handlers when the test starts
+@pytest.fixture
+def capture_logs():
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers, root.level
+
+    def capture_logs():
+        output = io.StringIO()
+        root.handlers = [logging.StreamHandler(output)]
+        return output
+    yield capture_logs
+    reset_logging()
+    root.handlers, root.level = saved_handlers, saved_level
+
+
+# an argument that counts how often it is formatted
+class CountingArgument:
+
+    def __init__(self):
+        self.formatted = 0
+
+    def __str__(self):
+        self.formatted += 1
+        return 'counted'
+
+
+# test json records carry the correlation fields and are written by the background listener once flushed
+def test_async_json_logging(capture_logs, monkeypatch):
+    log_output = capture_logs()
+    monkeypatch.setenv('LOG_FORMAT', 'json')
+    monkeypatch.setenv('ASYNC_LOGGING', 'true')
+    logger = create_logger()
+    assert logging_helpers.log_listener is not None
+
+    set_request_id('request-1')
+    set_object_key('images/a.jpg')
+    logger.info("File %s read successfully from %s... Size: %s bytes...", 'images/a.jpg', 'test-bucket', 18)
+    # the object key is kept per thread
+    thread = threading.Thread(target=lambda: logger.error("Error in %s...", 'worker'))
+    thread.start()
+    thread.join()
+    flush_logs()
+
+    first, second = [json.loads(line) for line in log_output.getvalue().splitlines()]
+    assert first['message'] == "File images/a.jpg read successfully from test-bucket... Size: 18 bytes..."
+    assert first['level'] == 'INFO'
+    assert first['requestId'] == 'request-1'
+    assert first['objectKey'] == 'images/a.jpg'
+    assert second['message'] == "Error in worker..."
+    assert second['requestId'] == 'request-1'
+    assert 'objectKey' not in second
+
+
+# test info records are sampled without being formatted while every error is kept
+def test_sampled_logging(capture_logs, monkeypatch):
+    log_output = capture_logs()
+    monkeypatch.setenv('LOG_INFO_SAMPLE_RATE', '10')
+    logger = create_logger()
+    argument = CountingArgument()
+
+    for _ in range(100):
+        logger.info("Processing %s...", argument)
+        logger.error("Failed %s...", 'record')
+
+    lines = log_output.getvalue().splitlines()
+    assert sum('Processing counted...' in line for line in lines) == 10
+    assert sum('Failed record...' in line for line in lines) == 100
+    # the dropped records were never formatted
+    assert argument.formatted == 10
+
+
+# test the queued records keep their arguments until the listener formats them, unless the arguments can still change
+def test_deferred_queue_handler_formats_mutable_arguments():
+    handler = logging_helpers.DeferredQueueHandler(None)
+    totals = {'written': 1}
+    immutable = logging.LogRecord('root', logging.INFO, __file__, 1, "Written %s of %s...", (1, 2), None)
+    mutable = logging.LogRecord('root', logging.INFO, __file__, 1, "Totals %s...", (totals,), None)
+
+    assert handler.prepare(immutable).args == (1, 2)
+    assert handler.prepare(mutable).msg == "Totals {'written': 1}..."
+    assert mutable.args is None
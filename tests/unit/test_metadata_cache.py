@@ -0,0 +1,117 @@
+import io
+import boto3
+import pymysql
+import pytest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from PIL import Image
+from lambda_code import cache_helpers
+from lambda_code.cache_helpers import LRUCache
+from lambda_code.db_helpers import write_batch_to_rds
+from lambda_code.query_helpers import get_many, get_metadata, get_metadata_cache_stats
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create a connection manager whose connection hands out the given cursor
+def make_manager(mock_cursor):
+    mock_cursor.__enter__.return_value = mock_cursor
+    mock_connection = MagicMock()
+    mock_connection.cursor.return_value = mock_cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = mock_connection
+    return manager
+
+
+def make_row(image_id):
+    return (image_id, image_id.split('/')[-1], 100, 'image/png', 10, 20, datetime(2024, 5, 1, 10), 'etag', None, None, None, None, None, None)
+
+
+def make_metadata(image_id):
+    return {'imageId': image_id, 'fileName': image_id.split('/')[-1], 'fileSize': 100, 'fileType': 'image/png; charset=binary',
+            'width': 10, 'height': 20, 'timestamp': '2024-05-01T10:00:00', 'etag': 'etag'}
+
+
+# test entries expire after their ttl and the least recently used entry is evicted, with the counters to match
+def test_lru_cache_ttl_and_stats(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(cache_helpers.time, 'monotonic', lambda: now[0])
+    cache = LRUCache(2, ttl_seconds=10)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    now[0] += 11
+    assert cache.get('a') is None
+    assert cache.get_stats() == {'hits': 1, 'misses': 2, 'expired': 1, 'evictions': 1, 'size': 1, 'hit_rate': 1 / 3}
+
+
+# test repeated lookups are served from the cache and misses are read with a single batched query
+def test_get_many_reads_through_the_cache(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [make_row('images/a.png'), make_row('images/b.png')]
+    manager = make_manager(mock_cursor)
+
+    found = get_many(['images/a.png', 'images/b.png', 'images/missing.png', 'images/a.png'], mock_logger, manager=manager)
+
+    assert sorted(found) == ['images/a.png', 'images/b.png']
+    assert found['images/a.png']['timestamp'] == '2024-05-01T10:00:00'
+    sql, args = mock_cursor.execute.call_args.args
+    assert 'WHERE image_id IN (%s, %s, %s)' in sql and args == ('images/a.png', 'images/b.png', 'images/missing.png')
+
+    # the second lookup of a cached image does not touch the database
+    assert get_metadata('images/b.png', mock_logger, manager=manager)['fileName'] == 'b.png'
+    assert mock_cursor.execute.call_count == 1
+    stats = get_metadata_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['size']) == (1, 3, 2)
+
+
+# test a write drops the cached entry so the next lookup reads the stored row, and a failed write drops it too
+# the upsert skips the metadata of an older s3 event, so what was written is not necessarily what is stored
+def test_write_path_invalidates(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [make_row('images/a.png')]
+    manager = make_manager(mock_cursor)
+    assert get_metadata('images/a.png', mock_logger, manager=manager)['width'] == 10
+
+    write_batch_to_rds([dict(make_metadata('images/a.png'), width=99)], mock_logger, manager=manager)
+    assert get_metadata('images/a.png', mock_logger, manager=manager)['width'] == 10
+    assert mock_cursor.execute.call_count == 2
+
+    # the stored row read after the write is cached again
+    assert get_metadata('images/a.png', mock_logger, manager=manager)['width'] == 10
+    assert mock_cursor.execute.call_count == 2
+
+    mock_cursor.executemany.side_effect = pymysql.IntegrityError(1062, 'Duplicate entry')
+    write_batch_to_rds([make_metadata('images/a.png')], mock_logger, manager=manager)
+    mock_cursor.fetchall.return_value = []
+    assert get_metadata('images/a.png', mock_logger, manager=manager) is None
+    assert mock_cursor.execute.call_count == 3
+
+
+# test an image that is not in rds is extracted from s3 when asked to
+def test_get_metadata_extracts_missing_from_s3(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = []
+    buffer = io.BytesIO()
+    Image.new('RGB', (30, 40)).save(buffer, format='PNG')
+
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='test-bucket')
+        s3_client.put_object(Bucket='test-bucket', Key='images/new.png', Body=buffer.getvalue(), ContentType='image/png')
+
+        assert get_metadata('images/new.png', mock_logger, manager=make_manager(mock_cursor)) is None
+        image_metadata = get_metadata('images/new.png', mock_logger, extract_missing=True, s3_client=s3_client,
+                                      bucket_name='test-bucket', manager=make_manager(mock_cursor))
+
+    assert (image_metadata['width'], image_metadata['height']) == (30, 40)
+    assert get_metadata('images/new.png', mock_logger)['fileType'] == 'image/png'
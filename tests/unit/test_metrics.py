@@ -0,0 +1,87 @@
+import json
+import logging
+import pytest
+from unittest.mock import patch, MagicMock
+from lambda_code.lambda_function import handler
+from lambda_code.metrics_helpers import NULL_TIMER, get_metrics_logger, start_metrics, flush_metrics, stage_timer, put_metric
+
+
+# capture the lines written to the metrics logger
+@pytest.fixture
+def emitted_metrics():
+    records = []
+    capture = logging.Handler()
+    capture.emit = records.append
+    metrics_logger = get_metrics_logger()
+    metrics_logger.addHandler(capture)
+    yield lambda: [json.loads(record.getMessage()) for record in records]
+    metrics_logger.removeHandler(capture)
+
+
+# test the handler emits per record and per invocation metrics in embedded metric format
+def test_handler_emits_emf_metrics(emitted_metrics, monkeypatch):
+    monkeypatch.setenv('METRICS_ENABLED', 'true')
+    event = {"Records": [
+        {"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": "images/a.jpg"}}},
+        {"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": "images/missing.jpg"}}},
+    ]}
+
+    # return a small image for the first record and nothing for the second
+    def fake_fetch(s3_client, bucket_name, object_key, logger):
+        if object_key == 'images/missing.jpg':
+            return None, None
+        return {'ContentLength': 2 * 1024 * 1024, 'ContentType': 'image/jpeg'}, b'fake_image_data'
+
+    with patch('boto3.client'), \
+         patch('lambda_code.lambda_function.create_logger'), \
+         patch('lambda_code.lambda_function.fetch_file_contents', side_effect=fake_fetch), \
+         patch('lambda_code.utils.get_image_size', return_value=(100, 200)), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', return_value=(['images/a.jpg'], [])):
+
+        handler(event)
+
+    record_metrics, failed_record_metrics, invocation_metrics = emitted_metrics()
+
+    # validate the embedded metric format of the successful record
+    definition = record_metrics['_aws']['CloudWatchMetrics'][0]
+    assert definition['Namespace'] == 'PennEntertainment/ImageMetadata'
+    assert definition['Dimensions'] == [['FileType', 'SizeBucket']]
+    assert {'Name': 'RecordTime', 'Unit': 'Milliseconds'} in definition['Metrics']
+    assert record_metrics['FileType'] == 'image/jpeg'
+    assert record_metrics['SizeBucket'] == '1MB-10MB'
+    assert record_metrics['objectKey'] == 'images/a.jpg'
+    assert record_metrics['ExtractMetadataTime'] >= 0
+
+    # the failed record has no file type to break it down by
+    assert failed_record_metrics['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [[]]
+
+    # validate the outcome counts of the invocation
+    assert invocation_metrics['RecordsSucceeded'] == 1
+    assert invocation_metrics['RecordsFailed'] == 1
+    assert invocation_metrics['RecordsSkipped'] == 0
+    assert 'RdsBatchTime' in invocation_metrics
+
+
+# test nothing is collected or emitted when metrics are off
+def test_metrics_disabled(emitted_metrics, monkeypatch):
+    monkeypatch.delenv('METRICS_ENABLED', raising=False)
+
+    assert start_metrics() is None
+    assert stage_timer('S3Fetch') is NULL_TIMER
+    put_metric('BytesRead', 10, 'Bytes')
+    assert flush_metrics() is None
+    assert emitted_metrics() == []
+
+
+# test metrics reported more than once are emitted as a list of values
+def test_metrics_repeated_values(emitted_metrics, monkeypatch):
+    monkeypatch.setenv('METRICS_ENABLED', 'true')
+
+    start_metrics(Stage='test')
+    put_metric('DbRetries', 1)
+    put_metric('DbRetries', 1)
+    flush_metrics()
+
+    (metrics,) = emitted_metrics()
+    assert metrics['DbRetries'] == [1, 1]
+    assert metrics['Stage'] == 'test'
@@ -0,0 +1,145 @@
+import os
+import subprocess
+import sys
+import zipfile
+import aws_cdk as cdk
+import pytest
+from aws_cdk.assertions import Template, Match
+from penn_entertainment.penn_entertainment_stack import PennEntertainmentStack
+from penn_entertainment.performance_profiles import get_performance_profile
+
+
+# synthesize the stack once per profile with an empty layer so the tests do not need a built layer
+@pytest.fixture(scope="module")
+def synthesize(tmp_path_factory):
+    layer_path = tmp_path_factory.mktemp("layer") / "lambda_layer.zip"
+    zipfile.ZipFile(layer_path, "w").close()
+    templates = {}
+
+    def synthesize(profile):
+        if profile not in templates:
+            app = cdk.App(context={"performance_profile": profile, "layer_asset": str(layer_path)})
+            templates[profile] = Template.from_stack(PennEntertainmentStack(app, f"PennEntertainmentStack-{profile}"))
+        return templates[profile]
+    return synthesize
+
+
+# the generated cloudformation each profile is expected to produce
+EXPECTED_PROFILES = {
+    "dev": {
+        "function": {"MemorySize": 128, "Architectures": ["x86_64"], "ReservedConcurrentExecutions": 100, "Timeout": Match.absent(), "VpcConfig": Match.absent()},
+        "instance_class": "db.t2.micro",
+        "write_behind_spool": "false",
+        "proxies": 0,
+        "provisioned": None,
+    },
+    "steady": {
+        "function": {"MemorySize": 1024, "Architectures": ["arm64"], "ReservedConcurrentExecutions": 100, "Timeout": 30, "VpcConfig": Match.any_value()},
+        "instance_class": "db.t4g.medium",
+        "write_behind_spool": "true",
+        "proxies": 1,
+        "provisioned": (2, 10, 0.7),
+    },
+    "burst": {
+        "function": {"MemorySize": 2048, "Architectures": ["arm64"], "ReservedConcurrentExecutions": 500, "Timeout": 60, "VpcConfig": Match.any_value()},
+        "instance_class": "db.r6g.large",
+        "write_behind_spool": "true",
+        "proxies": 1,
+        "provisioned": (5, 50, 0.6),
+    },
+}
+
+
+# test every profile generates its lambda sizing, rds instance, proxy and provisioned concurrency
+@pytest.mark.parametrize("profile", sorted(EXPECTED_PROFILES))
+def test_performance_profile_template(synthesize, profile):
+    template = synthesize(profile)
+    expected = EXPECTED_PROFILES[profile]
+
+    template.has_resource_properties("AWS::Lambda::Function", dict(expected["function"], Handler="lambda_code.lambda_function.handler"))
+    template.has_resource_properties("AWS::RDS::DBInstance", {"DBInstanceClass": expected["instance_class"]})
+    template.resource_count_is("AWS::RDS::DBProxy", expected["proxies"])
+    template.has_resource_properties("AWS::Lambda::LayerVersion", {"CompatibleArchitectures": expected["function"]["Architectures"]})
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "lambda_code.lambda_function.handler",
+        "Environment": {"Variables": Match.object_like({"WRITE_BEHIND_SPOOL": expected["write_behind_spool"]})},
+    })
+
+    if expected["provisioned"] is None:
+        template.resource_count_is("AWS::Lambda::Alias", 0)
+        template.resource_count_is("AWS::ApplicationAutoScaling::ScalableTarget", 0)
+        return
+
+    min_capacity, max_capacity, utilization_target = expected["provisioned"]
+    template.has_resource_properties("AWS::Lambda::Alias", {
+        "Name": "live",
+        "ProvisionedConcurrencyConfig": {"ProvisionedConcurrentExecutions": min_capacity},
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "MinCapacity": min_capacity,
+        "MaxCapacity": max_capacity,
+        "ScalableDimension": "lambda:function:ProvisionedConcurrency",
+    })
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalingPolicy", {
+        "TargetTrackingScalingPolicyConfiguration": Match.object_like({"TargetValue": utilization_target}),
+    })
+    # the lambda connects to the proxy instead of the instance
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "lambda_code.lambda_function.handler",
+        "Environment": {"Variables": Match.object_like({"RDS_ENDPOINT": {"Fn::GetAtt": [Match.string_like_regexp("RdsProxy"), "Endpoint"]}})},
+    })
+    # and the proxy can reach the instance
+    template.has_resource_properties("AWS::EC2::SecurityGroupIngress", {
+        "GroupId": {"Fn::GetAtt": [Match.string_like_regexp("RdsInstanceSecurityGroup"), "GroupId"]},
+        "SourceSecurityGroupId": {"Fn::GetAtt": [Match.string_like_regexp("ProxySecurityGroup"), "GroupId"]},
+    })
+
+
+# test events go through the provisioned alias so they use the pre-initialized environments
+def test_sqs_ingestion_uses_alias(tmp_path):
+    layer_path = tmp_path / "lambda_layer.zip"
+    zipfile.ZipFile(layer_path, "w").close()
+    app = cdk.App(context={"performance_profile": "steady", "ingestion_mode": "sqs", "layer_asset": str(layer_path)})
+    template = Template.from_stack(PennEntertainmentStack(app, "PennEntertainmentStack"))
+
+    event_source_mappings = template.find_resources("AWS::Lambda::EventSourceMapping")
+    assert len(event_source_mappings) == 1
+    function_name = next(iter(event_source_mappings.values()))["Properties"]["FunctionName"]
+    assert function_name["Fn::Join"][1][-1] == ":live"
+
+
+# test the sqs batch of every profile is sized to its timeout and the visibility timeout covers six timeouts and the batching window
+@pytest.mark.parametrize("profile, batch_size, visibility_timeout", [("dev", 10, 23), ("steady", 100, 185), ("burst", 100, 365)])
+def test_sqs_batch_matches_timeout(tmp_path, profile, batch_size, visibility_timeout):
+    layer_path = tmp_path / "lambda_layer.zip"
+    zipfile.ZipFile(layer_path, "w").close()
+    app = cdk.App(context={"performance_profile": profile, "ingestion_mode": "sqs", "layer_asset": str(layer_path)})
+    template = Template.from_stack(PennEntertainmentStack(app, "PennEntertainmentStack"))
+
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {"BatchSize": batch_size, "MaximumBatchingWindowInSeconds": 5})
+    template.has_resource_properties("AWS::SQS::Queue", {"VisibilityTimeout": visibility_timeout})
+
+
+# test every handler imports from the staged code asset the way the lambda runtime resolves it, with only the asset on the path
+def test_handlers_import_from_code_asset(tmp_path):
+    layer_path = tmp_path / "lambda_layer.zip"
+    zipfile.ZipFile(layer_path, "w").close()
+    app = cdk.App(outdir=str(tmp_path / "cdk.out"), context={"layer_asset": str(layer_path), "aws:cdk:enable-asset-metadata": True})
+    stack = PennEntertainmentStack(app, "PennEntertainmentStack")
+    resources = app.synth().get_stack_artifact(stack.artifact_id).template["Resources"]
+
+    functions = [resource for resource in resources.values() if resource["Properties"].get("Handler", "").startswith("lambda_code.")]
+    assert {function["Properties"]["Handler"] for function in functions} == {"lambda_code.lambda_function.handler", "lambda_code.spool_helpers.replay_handler"}
+    for function in functions:
+        asset_path = os.path.join(app.outdir, function["Metadata"]["aws:asset:path"])
+        module_name, function_name = function["Properties"]["Handler"].rsplit(".", 1)
+        check = f"import importlib, sys; sys.path.insert(0, {asset_path!r}); assert callable(getattr(importlib.import_module({module_name!r}), {function_name!r}))"
+        env = {name: value for name, value in os.environ.items() if name != "PYTHONPATH"}
+        result = subprocess.run([sys.executable, "-c", check], cwd=tmp_path, env=env, capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
+
+
+# test an unknown profile fails the synth with the available names
+def test_unknown_performance_profile():
+    with pytest.raises(ValueError, match="dev, steady, burst"):
+        get_performance_profile("huge")
@@ -0,0 +1,70 @@
+import io
+import boto3
+import pytest
+from unittest.mock import patch
+from moto import mock_aws
+from PIL import Image
+from lambda_code.lambda_function import process_record
+from lambda_code.rendition_helpers import parse_renditions
+from lambda_code.similarity import hamming_distance
+from lambda_code.utils import compute_dhash
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create a jpeg with a gradient so the perceptual hash has something to describe
+def make_gradient_jpeg(width, height):
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+# test the renditions setting is parsed with defaults and ordered largest first
+def test_parse_renditions():
+    renditions = parse_renditions("thumbnail:128x128:webp:80, preview:1024x768")
+
+    assert renditions == [
+        {'name': 'preview', 'size': (1024, 768), 'format': 'JPEG', 'quality': 85},
+        {'name': 'thumbnail', 'size': (128, 128), 'format': 'WEBP', 'quality': 80},
+    ]
+    assert parse_renditions(None) == []
+    with pytest.raises(ValueError):
+        parse_renditions("thumbnail:128x128:bmp")
+
+
+# test the metadata, the perceptual hash and the renditions come from a single open of the fetched image
+def test_process_record_writes_renditions(mock_logger, monkeypatch):
+    monkeypatch.setenv('RENDITIONS', 'thumbnail:128x128:WEBP:80,preview:400x400:JPEG:85')
+    monkeypatch.setenv('PERCEPTUAL_HASH', 'dhash')
+    image_bytes = make_gradient_jpeg(1600, 1200)
+    record = {"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": "images/photo.jpg"}}}
+
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='test-bucket')
+        s3_client.put_object(Bucket='test-bucket', Key='images/photo.jpg', Body=image_bytes, ContentType='image/jpeg')
+
+        with patch('PIL.Image.open', wraps=Image.open) as mock_open:
+            image_metadata = process_record(s3_client, record, mock_logger)
+
+        # the image was opened once for everything
+        assert mock_open.call_count == 1
+        # the metadata keeps the dimensions of the original, not of the reduced decode
+        assert (image_metadata['width'], image_metadata['height']) == (1600, 1200)
+        assert image_metadata['renditions'] == [
+            {'name': 'preview', 'key': 'renditions/preview/images/photo.jpg', 'width': 400, 'height': 300},
+            {'name': 'thumbnail', 'key': 'renditions/thumbnail/images/photo.webp', 'width': 128, 'height': 96},
+        ]
+        for rendition in image_metadata['renditions']:
+            s3_object = s3_client.get_object(Bucket='test-bucket', Key=rendition['key'])
+            assert Image.open(io.BytesIO(s3_object['Body'].read())).size == (rendition['width'], rendition['height'])
+        assert s3_object['ContentType'] == 'image/webp'
+
+    # the hash of the shared decode matches the hash of a separate decode within a couple of bits
+    assert hamming_distance(image_metadata['perceptualHash'], compute_dhash(image_bytes)) <= 2
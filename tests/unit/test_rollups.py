@@ -0,0 +1,144 @@
+import pytest
+from datetime import date, datetime
+from unittest.mock import patch, MagicMock
+from lambda_code.db_helpers import compute_rollup_deltas, get_rollup_key, write_batch_to_rds, ROLLUP_UPSERT_SQL
+from lambda_code.query_helpers import get_storage_stats
+from lambda_code.schema import rebuild_rollups, BACKFILL_IMAGE_METADATA_ROLLUP_SQL
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create a connection manager whose connection hands out the given cursor
+def make_manager(mock_cursor):
+    mock_cursor.__enter__.return_value = mock_cursor
+    mock_connection = MagicMock()
+    mock_connection.cursor.return_value = mock_cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = mock_connection
+    return manager
+
+
+def make_metadata(image_id, file_type='image/jpeg', timestamp='2024-05-01T10:00:00', file_size=100, width=640, height=480):
+    return {'imageId': image_id, 'fileType': file_type, 'timestamp': timestamp, 'fileSize': file_size, 'width': width, 'height': height}
+
+
+# test the rollup key uses the folder part of the key and the day of the timestamp
+def test_get_rollup_key():
+    assert get_rollup_key('images/2024/a.jpg', 'IMAGE/JPEG; charset=binary', '2024-05-01T10:00:00') == ('images/2024/', 'image/jpeg', '2024-05-01')
+    assert get_rollup_key('a.png', 'image/png', datetime(2024, 5, 1, 23, 59)) == ('', 'image/png', '2024-05-01')
+
+
+# test new images are added to their group
+def test_compute_rollup_deltas_insert():
+    deltas = compute_rollup_deltas({}, [
+        make_metadata('images/a.jpg', file_size=100, width=640, height=480),
+        make_metadata('images/b.jpg', file_size=50, width=320, height=960),
+    ])
+
+    assert deltas == {('images/', 'image/jpeg', '2024-05-01'): [2, 150, 320, 640, 480, 960]}
+
+
+# test a replaced image is subtracted from the group it was counted in, including a replace within the same batch
+def test_compute_rollup_deltas_replace():
+    stored_rows = {'images/a.jpg': ('image/png', datetime(2024, 4, 30, 8), 300, None)}
+
+    deltas = compute_rollup_deltas(stored_rows, [
+        make_metadata('images/a.jpg', file_size=100),
+        make_metadata('images/a.jpg', file_size=120),
+    ])
+
+    assert deltas == {
+        ('images/', 'image/png', '2024-04-30'): [-1, -300, None, None, None, None],
+        ('images/', 'image/jpeg', '2024-05-01'): [1, 120, 640, 640, 480, 480],
+    }
+
+
+# test an upsert carrying an older s3 event than the stored row changes nothing, like the upsert itself
+def test_compute_rollup_deltas_skips_older_events():
+    stored_rows = {'images/a.jpg': ('image/png', datetime(2024, 4, 30, 8), 300, '0055AED6DCD9028C3B')}
+
+    assert compute_rollup_deltas(stored_rows, [dict(make_metadata('images/a.jpg'), sequencer='55AED6DCD9028C3A')]) == {}
+    assert compute_rollup_deltas(stored_rows, [dict(make_metadata('images/a.jpg'), sequencer='0055AED6DCD9028C3C')]) == {
+        ('images/', 'image/png', '2024-04-30'): [-1, -300, None, None, None, None],
+        ('images/', 'image/jpeg', '2024-05-01'): [1, 100, 640, 640, 480, 480],
+    }
+    # a backfill without a sequencer applies but keeps the stored one, so an older event after it is still skipped
+    assert compute_rollup_deltas(stored_rows, [
+        dict(make_metadata('images/a.jpg'), sequencer=None),
+        dict(make_metadata('images/a.jpg', file_size=500), sequencer='55AED6DCD9028C3A'),
+    ]) == {
+        ('images/', 'image/png', '2024-04-30'): [-1, -300, None, None, None, None],
+        ('images/', 'image/jpeg', '2024-05-01'): [1, 100, 640, 640, 480, 480],
+    }
+
+
+# test the rollups are updated on the cursor of the upsert, before it and in key order
+def test_write_batch_to_rds_maintains_rollups(mock_logger, monkeypatch):
+    monkeypatch.setenv('MAINTAIN_ROLLUPS', 'true')
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [('images/a.jpg', 'image/jpeg', datetime(2024, 5, 1, 9), 80, None)]
+    manager = make_manager(mock_cursor)
+
+    written_ids, failed_ids = write_batch_to_rds([
+        make_metadata('images/b.jpg', file_type='image/png'),
+        make_metadata('images/a.jpg', file_size=100),
+    ], mock_logger, manager=manager)
+
+    assert written_ids == ['images/b.jpg', 'images/a.jpg'] and failed_ids == []
+    select_sql, select_args = mock_cursor.execute.call_args.args
+    assert 'FOR UPDATE' in select_sql and select_args == ('images/b.jpg', 'images/a.jpg')
+    rollup_call, upsert_call = mock_cursor.executemany.call_args_list
+    assert rollup_call.args == (ROLLUP_UPSERT_SQL, [
+        ('images/', 'image/jpeg', '2024-05-01', 0, 20, 640, 640, 480, 480),
+        ('images/', 'image/png', '2024-05-01', 1, 100, 640, 640, 480, 480),
+    ])
+    assert 'INSERT INTO image_metadata (' in upsert_call.args[0]
+    manager.get_connection.return_value.commit.assert_called_once()
+
+
+# test the rollups are left alone unless MAINTAIN_ROLLUPS is set
+def test_write_batch_to_rds_without_rollups(mock_logger, monkeypatch):
+    monkeypatch.delenv('MAINTAIN_ROLLUPS', raising=False)
+    mock_cursor = MagicMock()
+
+    write_batch_to_rds([make_metadata('images/a.jpg')], mock_logger, manager=make_manager(mock_cursor))
+
+    mock_cursor.execute.assert_not_called()
+    assert mock_cursor.executemany.call_count == 1
+
+
+# test the storage stats are read from the rollups with an escaped prefix match
+def test_get_storage_stats(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [
+        ('images/2024_05/', date(2024, 5, 1), 3, 600, 320, 1024, 240, 768),
+        ('images/2024_05/', date(2024, 5, 2), 0, 0, 640, 640, 480, 480),
+    ]
+
+    stats = get_storage_stats(mock_logger, prefix='images/2024_05', start_day='2024-05-01', group_by=('prefix', 'day'), manager=make_manager(mock_cursor))
+
+    sql, args = mock_cursor.execute.call_args.args
+    assert 'FROM image_metadata_rollup WHERE image_prefix LIKE %s AND day >= %s' in sql
+    assert 'GROUP BY image_prefix, day' in sql
+    assert args == ('images/2024\\_05%', '2024-05-01')
+    assert stats == [{
+        'prefix': 'images/2024_05/', 'day': '2024-05-01', 'imageCount': 3, 'totalBytes': 600,
+        'minWidth': 320, 'maxWidth': 1024, 'minHeight': 240, 'maxHeight': 768,
+    }]
+
+
+# test the rollups are rebuilt from image_metadata in one transaction
+def test_rebuild_rollups(mock_logger):
+    mock_cursor = MagicMock()
+    manager = make_manager(mock_cursor)
+
+    assert rebuild_rollups(mock_logger, manager) is True
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert statements[1:] == ["DELETE FROM image_metadata_rollup", BACKFILL_IMAGE_METADATA_ROLLUP_SQL]
+    manager.get_connection.return_value.commit.assert_called_once()
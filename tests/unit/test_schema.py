@@ -0,0 +1,232 @@
+import os
+import uuid
+import pymysql
+import pytest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+from lambda_code.db_helpers import METADATA_COLUMNS, write_batch_to_rds
+from lambda_code.schema import apply_migrations, add_column, CREATE_IMAGE_METADATA_SQL, CREATE_IMAGE_METADATA_ROLLUP_SQL, NATIVE_TYPES_SQL, MIGRATIONS
+from lambda_code.query_helpers import list_image_metadata, decode_cursor, get_storage_stats
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# create a connection manager whose connection hands out the given cursor
+def make_manager(mock_cursor):
+    mock_cursor.__enter__.return_value = mock_cursor
+    mock_connection = MagicMock()
+    mock_connection.cursor.return_value = mock_cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = mock_connection
+    return manager
+
+
+# test only the migrations that were not applied yet are run, in order
+def test_apply_migrations(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = [(1,)]
+    migrations = [
+        (3, 'third', ['ALTER TABLE image_metadata ADD COLUMN c INT']),
+        (1, 'first', [CREATE_IMAGE_METADATA_SQL]),
+        (2, 'second', ['ALTER TABLE image_metadata ADD COLUMN b INT']),
+    ]
+
+    applied = apply_migrations(mock_logger, make_manager(mock_cursor), migrations)
+
+    assert applied == [2, 3]
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list]
+    assert statements[2:] == [
+        'ALTER TABLE image_metadata ADD COLUMN b INT',
+        'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+        'ALTER TABLE image_metadata ADD COLUMN c INT',
+        'INSERT INTO schema_migrations (version, description) VALUES (%s, %s)',
+    ]
+
+
+# test a guarded step that a previous, failed run already applied is skipped and the rest of the migration still runs
+def test_apply_migrations_skips_applied_steps(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.fetchall.return_value = []
+    mock_cursor.fetchone.side_effect = [(1,), (0,)]
+    migrations = [(2, 'second', [add_column('image_metadata', 'b', 'INT'), add_column('image_metadata', 'c', 'INT')])]
+
+    assert apply_migrations(mock_logger, make_manager(mock_cursor), migrations) == [2]
+
+    statements = [call.args[0] for call in mock_cursor.execute.call_args_list][2:]
+    assert [statement for statement in statements if statement.startswith('ALTER')] == ['ALTER TABLE image_metadata ADD COLUMN c INT']
+    assert mock_cursor.execute.call_args_list[2].args[1] == ('image_metadata', 'b')
+
+
+# return the statements of the migrations, without the guards of the guarded steps
+def get_migration_statements(migrations):
+    return [step[2] if isinstance(step, tuple) else step for _, _, steps in migrations for step in steps]
+
+
+# test the migrations give the table native types and the indexes the queries rely on
+def test_image_metadata_schema():
+    statements = get_migration_statements(MIGRATIONS)
+    assert 'MODIFY timestamp DATETIME(6) NOT NULL' in NATIVE_TYPES_SQL
+    assert 'MODIFY file_size BIGINT UNSIGNED NOT NULL' in NATIVE_TYPES_SQL
+    assert "MODIFY file_type ENUM('image/jpeg'" in NATIVE_TYPES_SQL
+    assert 'ALTER TABLE image_metadata ADD KEY idx_file_type_timestamp (file_type, timestamp)' in statements
+    assert 'ALTER TABLE image_metadata ADD KEY idx_timestamp (timestamp)' in statements
+    assert 'ALTER TABLE image_metadata ADD KEY idx_image_prefix_timestamp (image_prefix(255), timestamp)' in statements
+    # every ddl change is a step of its own so a failed migration can be run again
+    assert all(statement.count('ADD ') <= 1 for statement in statements if statement.startswith('ALTER'))
+    assert 'PRIMARY KEY (prefix_hash, file_type, day)' in CREATE_IMAGE_METADATA_ROLLUP_SQL
+
+
+# test every column the write path fills is added by a migration, the create is a no-op on existing tables
+def test_every_written_column_has_a_migration():
+    statements = ' '.join(get_migration_statements(MIGRATIONS[1:]))
+    for column, _ in METADATA_COLUMNS:
+        assert column in CREATE_IMAGE_METADATA_SQL or f'ADD COLUMN {column} ' in statements, column
+
+
+# connection manager handing out a connection to the throwaway database of the mysql tests
+class MySQLTestManager:
+
+    def __init__(self, database):
+        self.connection = pymysql.connect(
+            host=os.environ['MYSQL_TEST_HOST'],
+            port=int(os.getenv('MYSQL_TEST_PORT', '3306')),
+            user=os.getenv('MYSQL_TEST_USER', 'root'),
+            password=os.getenv('MYSQL_TEST_PASSWORD', ''),
+            database=database
+        )
+
+    def get_connection(self, logger):
+        return self.connection
+
+    def close(self):
+        pass
+
+
+# throwaway database on the mysql server given by MYSQL_TEST_HOST, the tests using it are skipped without one
+@pytest.fixture
+def mysql_database():
+    if not os.getenv('MYSQL_TEST_HOST'):
+        pytest.skip("MYSQL_TEST_HOST is not set")
+    database = f"schema_test_{uuid.uuid4().hex[:12]}"
+    manager = MySQLTestManager(None)
+    with manager.connection.cursor() as cursor:
+        cursor.execute(f"CREATE DATABASE {database}")
+    manager.connection.select_db(database)
+    try:
+        yield manager
+    finally:
+        with manager.connection.cursor() as cursor:
+            cursor.execute(f"DROP DATABASE {database}")
+        manager.connection.close()
+
+
+# test the migrations run on a real mysql, upgrading rows written before them, and the write path works on the result
+def test_migrations_on_mysql(mock_logger, monkeypatch, mysql_database):
+    assert apply_migrations(mock_logger, mysql_database, MIGRATIONS[:1]) == [1]
+    with mysql_database.connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO image_metadata VALUES (%s, %s, %s, %s, %s, %s, %s)",
+            ('images/old.jpg', 'old.jpg', 100, 'image/JPEG; charset=binary', 10, 20, '2024-01-01T10:00:00.000000')
+        )
+    mysql_database.connection.commit()
+
+    assert apply_migrations(mock_logger, mysql_database) == [version for version, _, _ in MIGRATIONS[1:]]
+    assert apply_migrations(mock_logger, mysql_database) == []
+
+    monkeypatch.setenv('MAINTAIN_ROLLUPS', 'true')
+    image_metadata = {'imageId': 'images/2024/new.png', 'fileName': 'new.png', 'fileSize': 200, 'fileType': 'image/png',
+                      'width': 30, 'height': 40, 'timestamp': '2024-01-02T10:00:00.000000', 'etag': 'etag'}
+    assert write_batch_to_rds([image_metadata], mock_logger, manager=mysql_database) == (['images/2024/new.png'], [])
+
+    page, _ = list_image_metadata(mock_logger, prefix='images/2024/', manager=mysql_database)
+    assert [row['imageId'] for row in page] == ['images/2024/new.png']
+    page, _ = list_image_metadata(mock_logger, file_type='image/jpeg', manager=mysql_database)
+    assert [(row['imageId'], row['timestamp']) for row in page] == [('images/old.jpg', '2024-01-01T10:00:00')]
+
+    # the backfill counted the old row and the write added the new one to its own group
+    stats = get_storage_stats(mock_logger, group_by=('prefix',), manager=mysql_database)
+    assert [(entry['prefix'], entry['imageCount'], entry['totalBytes']) for entry in stats] == [('images/', 1, 100), ('images/2024/', 1, 200)]
+    write_batch_to_rds([dict(image_metadata, fileSize=300, sequencer='0055AED6DCD9028C3B')], mock_logger, manager=mysql_database)
+    assert get_storage_stats(mock_logger, prefix='images/2024/', group_by=(), manager=mysql_database)[0]['totalBytes'] == 300
+
+    # a replayed write from an earlier s3 event leaves the row and the rollups alone
+    write_batch_to_rds([dict(image_metadata, fileSize=400, sequencer='55AED6DCD9028C3A')], mock_logger, manager=mysql_database)
+    with mysql_database.connection.cursor() as cursor:
+        cursor.execute("SELECT file_size, sequencer FROM image_metadata WHERE image_id = %s", ('images/2024/new.png',))
+        assert cursor.fetchall() == ((300, '0055AED6DCD9028C3B'),)
+    mysql_database.connection.commit()
+    assert get_storage_stats(mock_logger, prefix='images/2024/', group_by=(), manager=mysql_database)[0]['totalBytes'] == 300
+
+
+# test a backfill write without a sequencer updates the row but keeps the sequencer of the event that wrote it,
+# so a late retry of an older event is still turned away after the backfill
+def test_backfill_keeps_event_sequencer_on_mysql(mock_logger, mysql_database):
+    apply_migrations(mock_logger, mysql_database)
+    image_metadata = {'imageId': 'images/mixed.png', 'fileName': 'mixed.png', 'fileSize': 100, 'fileType': 'image/png',
+                      'width': 30, 'height': 40, 'timestamp': '2024-01-02T10:00:00.000000', 'etag': 'etag'}
+
+    def stored_row():
+        with mysql_database.connection.cursor() as cursor:
+            cursor.execute("SELECT file_size, sequencer FROM image_metadata WHERE image_id = %s", ('images/mixed.png',))
+            row = cursor.fetchone()
+        mysql_database.connection.commit()
+        return row
+
+    write_batch_to_rds([dict(image_metadata, sequencer='0055AED6DCD9028C3B')], mock_logger, manager=mysql_database)
+    write_batch_to_rds([dict(image_metadata, fileSize=200, sequencer=None)], mock_logger, manager=mysql_database)
+    assert stored_row() == (200, '0055AED6DCD9028C3B')
+
+    write_batch_to_rds([dict(image_metadata, fileSize=300, sequencer='0055AED6DCD9028C3A')], mock_logger, manager=mysql_database)
+    assert stored_row() == (200, '0055AED6DCD9028C3B')
+
+    write_batch_to_rds([dict(image_metadata, fileSize=400, sequencer='0055AED6DCD9028C3C')], mock_logger, manager=mysql_database)
+    assert stored_row() == (400, '0055AED6DCD9028C3C')
+
+
+# test a migration that failed after some of its ddl was committed completes when it is run again
+def test_migrations_resume_after_partial_ddl_on_mysql(mock_logger, mysql_database):
+    assert apply_migrations(mock_logger, mysql_database, MIGRATIONS[:7]) == [version for version, _, _ in MIGRATIONS[:7]]
+    # the first step of migration 8 was committed before the run stopped, its version was never recorded
+    version, _, steps = MIGRATIONS[7]
+    with mysql_database.connection.cursor() as cursor:
+        cursor.execute(steps[0][2])
+
+    assert apply_migrations(mock_logger, mysql_database) == [version]
+    with mysql_database.connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND INDEX_NAME = 'idx_updated_at'")
+        assert cursor.fetchone()[0] == 1
+    mysql_database.connection.commit()
+
+
+# test listing pages through the table with keyset pagination
+def test_list_image_metadata_keyset_pagination(mock_logger):
+    mock_cursor = MagicMock()
+    rows = [
+        (f'images/{index}.jpg', f'{index}.jpg', 100, 'image/jpeg', 10, 20, datetime(2024, 1, 1, 0, 0, 10 - index), None, None, None, None)
+        for index in range(3)
+    ]
+    mock_cursor.fetchall.side_effect = [rows, rows[2:]]
+    manager = make_manager(mock_cursor)
+
+    # the first page asks for one row more than the limit to detect the next page
+    page, next_cursor = list_image_metadata(mock_logger, file_type='image/JPEG', start_time='2024-01-01', limit=2, manager=manager)
+    sql, args = mock_cursor.execute.call_args.args
+    assert 'WHERE file_type = %s AND timestamp >= %s ORDER BY timestamp DESC, image_id DESC LIMIT %s' in sql
+    assert args == ('image/jpeg', '2024-01-01', 3)
+    assert [image_metadata['imageId'] for image_metadata in page] == ['images/0.jpg', 'images/1.jpg']
+    assert page[1]['timestamp'] == '2024-01-01T00:00:09'
+    assert decode_cursor(next_cursor) == ('2024-01-01T00:00:09', 'images/1.jpg')
+
+    # the second page continues after the last row instead of using an offset
+    page, next_cursor = list_image_metadata(mock_logger, file_type='image/jpeg', limit=2, cursor=next_cursor, manager=manager)
+    sql, args = mock_cursor.execute.call_args.args
+    assert 'OFFSET' not in sql
+    assert '(timestamp < %s OR (timestamp = %s AND image_id < %s))' in sql
+    assert args == ('image/jpeg', '2024-01-01T00:00:09', '2024-01-01T00:00:09', 'images/1.jpg', 3)
+    assert [image_metadata['imageId'] for image_metadata in page] == ['images/2.jpg']
+    assert next_cursor is None
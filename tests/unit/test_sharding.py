@@ -0,0 +1,102 @@
+import pytest
+from collections import Counter
+from unittest.mock import patch
+from benchmarks.synthetic import StandInDatabase
+from lambda_code.db_helpers import write_batch_to_rds, get_stored_etags, metadata_to_row
+from lambda_code.metrics_helpers import start_metrics, flush_metrics
+from lambda_code.rebalance import rebalance
+from lambda_code.shard_helpers import HashRing
+
+SHARDS = ['shard-a', 'shard-b', 'shard-c']
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# one stand-in database per shard, the secret name of a shard is used as its host
+@pytest.fixture
+def databases():
+    databases = {name: StandInDatabase() for name in SHARDS + ['shard-d']}
+    with patch('lambda_code.db_helpers.get_rds_credentials', side_effect=lambda secret_name, logger, force_refresh=False: ('user', 'password', secret_name, 'metadataDB')), \
+         patch('pymysql.connect', side_effect=lambda host, **kwargs: databases[host].connect()):
+        yield databases
+
+
+def make_metadata(image_id):
+    return {'imageId': image_id, 'fileName': image_id.split('/')[-1], 'fileSize': 100, 'fileType': 'image/png',
+            'width': 10, 'height': 20, 'timestamp': '2024-05-01T10:00:00.000000', 'etag': f"etag-{image_id}"}
+
+
+# test the keys spread evenly and adding a shard only moves keys onto the new shard
+def test_hash_ring_moves_only_keys_to_the_new_shard():
+    keys = [f'images/{index}.png' for index in range(3000)]
+    ring = HashRing(SHARDS)
+    grown_ring = HashRing(SHARDS + ['shard-d'])
+
+    counts = Counter(ring.get_node(key) for key in keys)
+    assert all(800 < counts[shard] < 1200 for shard in SHARDS)
+    moved = [key for key in keys if ring.get_node(key) != grown_ring.get_node(key)]
+    assert all(grown_ring.get_node(key) == 'shard-d' for key in moved)
+    assert 500 < len(moved) < 1000
+    # the ring does not depend on the order the shards are listed in
+    assert all(HashRing(SHARDS[::-1]).get_node(key) == ring.get_node(key) for key in keys[:100])
+
+
+# test a batch is split by shard, written to every shard's database and lookups are routed the same way
+def test_write_batch_to_shards(mock_logger, monkeypatch, databases):
+    monkeypatch.setenv('SHARD_SECRET_NAMES', ','.join(SHARDS))
+    image_metadata_list = [make_metadata(f'images/{index}.png') for index in range(30)]
+
+    written_ids, failed_ids = write_batch_to_rds(image_metadata_list, mock_logger)
+
+    assert written_ids == [image_metadata['imageId'] for image_metadata in image_metadata_list] and failed_ids == []
+    ring = HashRing(SHARDS)
+    for shard in SHARDS:
+        assert set(databases[shard].rows) == {image_id for image_id in written_ids if ring.get_node(image_id) == shard}
+    assert get_stored_etags(['images/1.png', 'images/2.png', 'images/missing.png'], mock_logger) == {
+        'images/1.png': 'etag-images/1.png',
+        'images/2.png': 'etag-images/2.png',
+    }
+
+
+# test the metrics the shards report on their worker threads end up in the caller's metrics
+def test_write_batch_to_shards_keeps_worker_metrics(mock_logger, monkeypatch, databases):
+    monkeypatch.setenv('SHARD_SECRET_NAMES', ','.join(SHARDS))
+    monkeypatch.setenv('METRICS_ENABLED', 'true')
+
+    start_metrics()
+    write_batch_to_rds([make_metadata(f'images/{index}.png') for index in range(30)], mock_logger)
+    record = flush_metrics()
+
+    rows_written, _ = record.metrics['RowsWritten']
+    assert len(rows_written) == len(SHARDS) and sum(rows_written) == 30
+    assert len(record.metrics['RdsConnectTime'][0]) == len(SHARDS)
+
+
+# test adding a shard moves only the rows that now hash to it, and a second run has nothing left to move
+def test_rebalance_after_adding_a_shard(mock_logger, databases):
+    ring = HashRing(SHARDS)
+    for index in range(200):
+        image_metadata = make_metadata(f'images/{index}.png')
+        databases[ring.get_node(image_metadata['imageId'])].store([metadata_to_row(image_metadata)])
+    # a row written to the new shard after the deploy is newer than the copy still on the old shard
+    grown_ring = HashRing(SHARDS + ['shard-d'])
+    newer_id = next(f'images/{index}.png' for index in range(200) if grown_ring.get_node(f'images/{index}.png') == 'shard-d')
+    databases['shard-d'].store([metadata_to_row(dict(make_metadata(newer_id), fileSize=999))])
+
+    totals = rebalance(SHARDS + ['shard-d'], mock_logger, page_size=50)
+
+    expected = {f'images/{index}.png' for index in range(200) if grown_ring.get_node(f'images/{index}.png') == 'shard-d'}
+    assert set(databases['shard-d'].rows) == expected
+    # the new shard is scanned last and holds the moved rows by then
+    assert totals == {'scanned': 200 + len(expected), 'moved': len(expected) - 1, 'already_moved': 1, 'failed': 0}
+    assert databases['shard-d'].rows[newer_id][2] == 999
+    for shard in SHARDS:
+        assert all(grown_ring.get_node(image_id) == shard for image_id in databases[shard].rows)
+    assert sum(len(databases[shard].rows) for shard in SHARDS + ['shard-d']) == 200
+
+    assert rebalance(SHARDS + ['shard-d'], mock_logger)['moved'] == 0
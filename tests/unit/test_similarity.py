@@ -0,0 +1,134 @@
+import io
+import random
+import sys
+import pytest
+from unittest.mock import patch, MagicMock
+from PIL import Image, ImageDraw
+from lambda_code.similarity import BKTree, NearDuplicateIndex, hamming_distance, LOAD_SETTLE_SECONDS
+from lambda_code.utils import compute_dhash, compute_phash, compute_perceptual_hash, extract_metadata
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# draw a picture of a few shapes and encode it
+def make_picture(size, image_format='JPEG', quality=90, seed=1):
+    generator = random.Random(seed)
+    image = Image.new('RGB', size, (30, 60, 90))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = generator.randrange(size[0]), generator.randrange(size[1])
+        draw.ellipse([x, y, x + size[0] // 4, y + size[1] // 4], fill=tuple(generator.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+# test resized and re-encoded copies hash close to the original while a different picture does not
+@pytest.mark.parametrize("compute_hash", [compute_dhash, compute_phash])
+def test_perceptual_hash_near_duplicates(compute_hash):
+    original = compute_hash(make_picture((1600, 1200)))
+    copy = compute_hash(make_picture((400, 300), image_format='PNG'))
+    recompressed = compute_hash(make_picture((1600, 1200), quality=40))
+    different = compute_hash(make_picture((1600, 1200), seed=2))
+
+    assert 0 <= original < 2 ** 64
+    assert hamming_distance(original, copy) <= 6
+    assert hamming_distance(original, recompressed) <= 6
+    assert hamming_distance(original, different) > 12
+
+
+# test the hashes are the same without numpy, which is not in the layer by default
+@pytest.mark.parametrize("compute_hash", [compute_dhash, compute_phash])
+def test_perceptual_hash_without_numpy(compute_hash):
+    pytest.importorskip("numpy")
+    image_bytes = make_picture((640, 480))
+    expected = compute_hash(image_bytes)
+
+    with patch.dict(sys.modules, {'numpy': None}):
+        assert compute_hash(image_bytes) == expected
+
+
+# test an unknown algorithm is a configuration error instead of a missing hash
+def test_unknown_perceptual_hash(mock_logger, monkeypatch):
+    monkeypatch.setenv('PERCEPTUAL_HASH', 'ahash')
+    with pytest.raises(ValueError, match="dhash, phash"):
+        compute_perceptual_hash(make_picture((64, 48)), mock_logger)
+
+
+# test extract_metadata adds the hash when enabled
+def test_extract_metadata_perceptual_hash(mock_logger, monkeypatch):
+    monkeypatch.setenv('PERCEPTUAL_HASH', 'dhash')
+    image_bytes = make_picture((320, 240))
+
+    metadata = extract_metadata({'ContentLength': len(image_bytes), 'ContentType': 'image/jpeg'}, image_bytes, 'images/a.jpg', mock_logger)
+
+    assert metadata['perceptualHash'] == compute_dhash(image_bytes)
+
+
+# test the bk-tree returns the same matches as a brute force scan
+def test_bk_tree_matches_brute_force():
+    generator = random.Random(7)
+    hashes = {f'images/{index}.jpg': generator.getrandbits(64) for index in range(2000)}
+    # add near copies of a few hashes
+    for index in range(20):
+        hashes[f'images/copy-{index}.jpg'] = hashes[f'images/{index}.jpg'] ^ (1 << generator.randrange(64))
+    tree = BKTree()
+    for image_id, image_hash in hashes.items():
+        tree.add(image_hash, image_id)
+
+    query = hashes['images/3.jpg']
+    expected = sorted(((image_id, hamming_distance(query, image_hash)) for image_id, image_hash in hashes.items()
+                       if hamming_distance(query, image_hash) <= 10), key=lambda match: (match[1], match[0]))
+    assert tree.search(query, 10) == expected
+    assert ('images/copy-3.jpg', 1) in expected
+
+
+# test the index loads from rds incrementally in write order and moves re-uploaded images to their new hash
+def test_near_duplicate_index_incremental_load(mock_logger):
+    mock_cursor = MagicMock()
+    mock_cursor.__enter__.return_value = mock_cursor
+    mock_cursor.fetchmany.side_effect = [
+        [('images/a.jpg', 0b1111, '2024-01-01 00:00:00', 1), ('images/b.jpg', 0b1110, '2024-01-01 00:00:01', 0)], [],
+        [('images/b.jpg', 0b1110, '2024-01-01 00:00:01', 1), ('images/a.jpg', 0b0000, '2024-01-02 00:00:00', 1)], [],
+    ]
+    mock_connection = MagicMock()
+    mock_connection.cursor.return_value = mock_cursor
+    manager = MagicMock()
+    manager.get_connection.return_value = mock_connection
+    index = NearDuplicateIndex()
+
+    assert index.load_from_rds(mock_logger, manager) == 2
+    assert 'ORDER BY updated_at, image_id' in mock_cursor.execute.call_args.args[0]
+    assert index.find_similar('images/a.jpg', 1) == [('images/b.jpg', 1)]
+
+    # the second load asks for the rows after the newest settled one, images/b.jpg was still in the settle window
+    assert index.load_from_rds(mock_logger, manager) == 2
+    assert mock_cursor.execute.call_args.args[1] == (LOAD_SETTLE_SECONDS, '2024-01-01 00:00:00', '2024-01-01 00:00:00', 'images/a.jpg')
+    assert index.find_similar('images/a.jpg', 1) == []
+    assert index.find_within(0b1111, 0) == []
+    assert index.high_water_marks[manager] == ('2024-01-02 00:00:00', 'images/a.jpg')
+    assert len(index) == 2
+
+
+# test every shard is loaded with its own high water mark when sharding is on
+def test_near_duplicate_index_loads_every_shard(mock_logger):
+    managers = []
+    for rows in ([('images/a.jpg', 0b1111, '2024-01-01 00:00:00', 1)], [('images/b.jpg', 0b1110, '2024-01-05 00:00:00', 1)]):
+        mock_cursor = MagicMock()
+        mock_cursor.__enter__.return_value = mock_cursor
+        mock_cursor.fetchmany.side_effect = [rows, []]
+        manager = MagicMock()
+        manager.get_connection.return_value.cursor.return_value = mock_cursor
+        managers.append(manager)
+    index = NearDuplicateIndex()
+
+    with patch('lambda_code.similarity.get_all_managers', return_value=managers):
+        assert index.load_from_rds(mock_logger) == 2
+
+    assert index.find_similar('images/a.jpg', 1) == [('images/b.jpg', 1)]
+    assert index.high_water_marks == {managers[0]: ('2024-01-01 00:00:00', 'images/a.jpg'), managers[1]: ('2024-01-05 00:00:00', 'images/b.jpg')}
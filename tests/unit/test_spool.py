@@ -0,0 +1,151 @@
+import json
+import boto3
+import pytest
+from unittest.mock import patch, MagicMock
+from moto import mock_aws
+from lambda_code.db_helpers import build_upsert_sql, NEWER_SEQUENCER_SQL
+from lambda_code.lambda_function import handler
+from lambda_code.spool_helpers import CircuitBreaker, CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN, spool_metadata, replay_spool, read_spool_object
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.lambda_function.create_logger") as mock_create_logger:
+        yield mock_create_logger.return_value
+
+
+# create the bucket the spool is written to
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv('BUCKET_NAME', 'test-bucket')
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='test-bucket')
+        yield s3_client
+
+
+# return the keys of the spool objects
+def list_spool(s3_client, prefix='spool/'):
+    return [s3_object['Key'] for s3_object in s3_client.list_objects_v2(Bucket='test-bucket', Prefix=prefix).get('Contents', [])]
+
+
+# test the circuit opens after repeated failures, lets one trial through after the reset time and closes on success
+def test_circuit_breaker_transitions():
+    logger = MagicMock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30, latency_threshold_ms=1000)
+
+    with patch('lambda_code.spool_helpers.time.monotonic', return_value=100):
+        # a slow write counts as a failure
+        breaker.record_result(True, 1500, logger)
+        assert breaker.get_state() == CIRCUIT_CLOSED
+        breaker.record_result(False, 10, logger)
+        assert breaker.get_state() == CIRCUIT_OPEN
+        assert not breaker.allow_request()
+
+    with patch('lambda_code.spool_helpers.time.monotonic', return_value=130):
+        # only one trial write while half open
+        assert breaker.allow_request()
+        assert breaker.get_state() == CIRCUIT_HALF_OPEN
+        assert not breaker.allow_request()
+        breaker.record_result(True, 10, logger)
+        assert breaker.get_state() == CIRCUIT_CLOSED
+        assert breaker.allow_request()
+
+
+# test the handler spools the metadata rds could not take and stops calling rds once the circuit is open
+def test_handler_spools_failed_writes(s3_client, mock_logger, monkeypatch):
+    monkeypatch.setenv('WRITE_BEHIND_SPOOL', 'true')
+    event = {"Records": [{"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": "images/a.jpg"}}}]}
+    failing_write = lambda metadata, logger: ([], [image_metadata['imageId'] for image_metadata in metadata])
+
+    with patch('lambda_code.spool_helpers.rds_circuit_breaker', CircuitBreaker(failure_threshold=1, reset_seconds=30)), \
+         patch('lambda_code.lambda_function.get_s3_client', return_value=s3_client), \
+         patch('lambda_code.lambda_function.fetch_file_contents', return_value=({'ContentLength': 12}, b'fake_image_data')), \
+         patch('lambda_code.lambda_function.extract_metadata', side_effect=lambda *args, **kwargs: {'imageId': 'images/a.jpg', 'width': 10}), \
+         patch('lambda_code.db_helpers.write_batch_to_rds', side_effect=failing_write) as mock_write:
+
+        assert handler(event)['statusCode'] == 200
+        assert handler(event)['statusCode'] == 200
+
+    # the second invocation skipped rds because the first one opened the circuit
+    assert mock_write.call_count == 1
+    spool_keys = list_spool(s3_client)
+    assert len(spool_keys) == 2
+    assert read_spool_object(s3_client, 'test-bucket', spool_keys[0]) == [{'imageId': 'images/a.jpg', 'width': 10, 'sequencer': None}]
+    # spooled records are not reported as failed
+    assert "Error writing metadata for file images/a.jpg to RDS..." not in [call.args[0] % call.args[1:] for call in mock_logger.error.call_args_list]
+
+
+# test the replayer writes the spooled records, deletes the replayed objects and moves the records rds rejects to the dead letter prefix
+def test_replay_spool(s3_client):
+    logger = MagicMock()
+    spool_metadata(s3_client, [{'imageId': 'images/a.jpg'}, {'imageId': 'images/b.jpg'}], logger)
+    spool_metadata(s3_client, [{'imageId': 'images/c.jpg'}], logger)
+
+    # b.jpg fails the chunk it is written in
+    def write_batch(metadata, logger, batch_size=None, manager=None):
+        image_ids = [image_metadata['imageId'] for image_metadata in metadata]
+        if 'images/b.jpg' in image_ids and batch_size != 1:
+            return [], image_ids
+        return [image_id for image_id in image_ids if image_id != 'images/b.jpg'], [image_id for image_id in image_ids if image_id == 'images/b.jpg']
+
+    with patch('lambda_code.spool_helpers.write_batch_to_rds', side_effect=write_batch), \
+         patch('lambda_code.spool_helpers.is_rds_available', return_value=True):
+        totals = replay_spool(s3_client, logger)
+
+    assert totals == {'objects_replayed': 2, 'records_written': 2, 'records_failed': 1, 'records_dead_lettered': 1}
+    assert list_spool(s3_client) == []
+    dead_letter_keys = list_spool(s3_client, 'spool-dead-letter/')
+    assert len(dead_letter_keys) == 1
+    assert read_spool_object(s3_client, 'test-bucket', dead_letter_keys[0]) == [{'imageId': 'images/b.jpg'}]
+
+
+# test a spool object rds rejects entirely does not stop the replay of the objects after it
+def test_replay_spool_skips_poison_object(s3_client):
+    logger = MagicMock()
+    # the poison object sorts first so it is replayed before the good one
+    s3_client.put_object(Bucket='test-bucket', Key='spool/2024/01/01/000000-a.jsonl', Body=b'{"imageId": "images/poison.jpg"}\n')
+    s3_client.put_object(Bucket='test-bucket', Key='spool/2024/01/01/000000-b.jsonl', Body=b'{"imageId": "images/good.jpg"}\n')
+
+    def write_batch(metadata, logger, batch_size=None, manager=None):
+        image_ids = [image_metadata['imageId'] for image_metadata in metadata]
+        return [image_id for image_id in image_ids if image_id != 'images/poison.jpg'], [image_id for image_id in image_ids if image_id == 'images/poison.jpg']
+
+    with patch('lambda_code.spool_helpers.write_batch_to_rds', side_effect=write_batch) as mock_write, \
+         patch('lambda_code.spool_helpers.is_rds_available', return_value=True):
+        totals = replay_spool(s3_client, logger)
+
+    assert totals == {'objects_replayed': 2, 'records_written': 1, 'records_failed': 1, 'records_dead_lettered': 1}
+    assert [call.args[0] for call in mock_write.call_args_list][-1] == [{'imageId': 'images/good.jpg'}]
+    assert list_spool(s3_client) == []
+    dead_letter_keys = list_spool(s3_client, 'spool-dead-letter/')
+    assert read_spool_object(s3_client, 'test-bucket', dead_letter_keys[0]) == [{'imageId': 'images/poison.jpg'}]
+
+
+# test the replayer stops and keeps the spool while rds is still unavailable
+def test_replay_spool_stops_while_rds_is_down(s3_client):
+    logger = MagicMock()
+    spool_metadata(s3_client, [{'imageId': 'images/a.jpg'}], logger)
+    spool_metadata(s3_client, [{'imageId': 'images/b.jpg'}], logger)
+
+    with patch('lambda_code.spool_helpers.write_batch_to_rds', return_value=([], ['images/a.jpg'])) as mock_write, \
+         patch('lambda_code.spool_helpers.is_rds_available', return_value=False):
+        totals = replay_spool(s3_client, logger)
+
+    assert mock_write.call_count == 1
+    assert totals['objects_replayed'] == 0
+    assert len(list_spool(s3_client)) == 2
+    assert list_spool(s3_client, 'spool-dead-letter/') == []
+
+
+# test the upsert only replaces a stored row with one from the same or a later s3 event, so a replay cannot undo a newer write
+def test_upsert_keeps_rows_from_later_events():
+    sql = build_upsert_sql()
+    updates = [line.strip() for line in sql.split('ON DUPLICATE KEY UPDATE', 1)[1].strip().split(',\n')]
+
+    assert all(update.startswith(f"{update.split(' ')[0]} = IF((sequencer IS NULL OR VALUES(sequencer) IS NULL") for update in updates)
+    assert "LPAD(VALUES(sequencer), 64, '0') >= LPAD(sequencer, 64, '0')" in updates[0]
+    # the sequencer is assigned last so the other columns compare against the stored one,
+    # and a write without one (a backfill) keeps the stored sequencer
+    assert updates[-1] == f"sequencer = IF({NEWER_SEQUENCER_SQL}, COALESCE(VALUES(sequencer), sequencer), sequencer)"
@@ -0,0 +1,115 @@
+import io
+import sys
+import time
+import boto3
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from moto import mock_aws
+from PIL import Image
+from lambda_code.lambda_function import process_record, process_records
+from lambda_code.verify_helpers import VerifyPool, close_verify_pool, verify_image_contents
+
+
+# mock the logger
+@pytest.fixture
+def mock_logger():
+    with patch("lambda_code.create_logger") as mock_logger:
+        yield mock_logger
+
+
+# stop the worker processes started by a test
+@pytest.fixture(autouse=True)
+def stop_verify_pool():
+    yield
+    close_verify_pool()
+
+
+# command starting a worker that runs verify in place of verify_image, defined in the worker's own interpreter
+def make_worker_command(verify):
+    return [sys.executable, '-c', f"from lambda_code import verify_helpers\n{verify}\nverify_helpers.run_verify_worker(verify)"]
+
+
+def make_jpeg(width, height):
+    buffer = io.BytesIO()
+    Image.linear_gradient('L').resize((width, height)).convert('RGB').save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+# test an intact image passes and a truncated one is flagged with the reason
+def test_verify_image_contents(mock_logger):
+    image_bytes = make_jpeg(400, 300)
+
+    assert verify_image_contents(image_bytes, 'images/ok.jpg', mock_logger) == (True, None)
+
+    is_valid, error = verify_image_contents(image_bytes[:len(image_bytes) // 2], 'images/cut.jpg', mock_logger)
+    assert not is_valid
+    assert 'truncated' in error
+    mock_logger.error.assert_called_once_with("Image %s failed verification: %s...", 'images/cut.jpg', error)
+
+
+# test images over the pixel limit are rejected without decoding them
+def test_verify_image_pixel_limit(mock_logger, monkeypatch):
+    monkeypatch.setenv('MAX_IMAGE_PIXELS', '6000')
+
+    is_valid, error = verify_image_contents(make_jpeg(100, 100), 'images/large.jpg', mock_logger)
+
+    assert not is_valid
+    assert error == "image of 100x100 pixels is over the limit of 6000 pixels"
+
+
+# test a worker that takes too long is killed, one that uses too much cpu is stopped by its cpu limit,
+# and both are replaced by a new worker for the next image
+def test_verify_pool_limits():
+    pool = VerifyPool(1, make_worker_command("import time\ndef verify(contents):\n    time.sleep(10)"))
+    assert pool.verify(b'', cpu_seconds=5, timeout_seconds=0.5) == "verification timed out after 0.5 s"
+    assert pool.verify(b'', cpu_seconds=5, timeout_seconds=0.5) == "verification timed out after 0.5 s"
+
+    pool = VerifyPool(1, make_worker_command("def verify(contents):\n    while contents:\n        pass"))
+    assert pool.verify(b'spin', cpu_seconds=1, timeout_seconds=10) == "verification used more than 1 s of cpu time"
+    assert pool.verify(b'', cpu_seconds=1, timeout_seconds=10) is None
+    pool.close()
+
+
+# test the workers are reused across images and verify the images of a batch at the same time
+def test_verify_pool_runs_workers_in_parallel():
+    pool = VerifyPool(2, make_worker_command("import os, time\ndef verify(contents):\n    time.sleep(0.5)\n    return str(os.getpid())"))
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        started = time.monotonic()
+        pids = list(executor.map(lambda _: pool.verify(b'', cpu_seconds=5, timeout_seconds=5), range(4)))
+        elapsed = time.monotonic() - started
+    pool.close()
+
+    assert len(set(pids)) == 2
+    assert elapsed < 1.9
+
+
+# test the records default to one thread per verify worker when the images are verified
+def test_process_records_matches_verify_workers(mock_logger, monkeypatch):
+    monkeypatch.setenv('VERIFY_IMAGES', 'true')
+    monkeypatch.setenv('VERIFY_WORKERS', '3')
+    records = [{"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": f"images/{index}.jpg"}}} for index in range(5)]
+
+    with patch('lambda_code.lambda_function.process_record', return_value=None), \
+         patch('lambda_code.lambda_function.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as mock_executor:
+        process_records(None, records, mock_logger)
+
+    mock_executor.assert_called_once_with(max_workers=3)
+
+
+# test a truncated upload is still recorded, flagged as invalid
+def test_process_record_flags_truncated_upload(mock_logger, monkeypatch):
+    monkeypatch.setenv('VERIFY_IMAGES', 'true')
+    image_bytes = make_jpeg(400, 300)
+    record = {"s3": {"bucket": {"name": "test-bucket"}, "object": {"key": "images/cut.jpg"}}}
+
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket='test-bucket')
+        s3_client.put_object(Bucket='test-bucket', Key='images/cut.jpg', Body=image_bytes[:len(image_bytes) // 2], ContentType='image/jpeg')
+
+        image_metadata = process_record(s3_client, record, mock_logger)
+
+    assert (image_metadata['width'], image_metadata['height']) == (400, 300)
+    assert image_metadata['isValid'] is False
+    assert 'truncated' in image_metadata['validationError']